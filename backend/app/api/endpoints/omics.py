@@ -1,56 +1,244 @@
 from fastapi import APIRouter, HTTPException, Query
-from app.services.data_loader import data_loader
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, StreamingResponse
+from app.services.datasets import registry
 from app.services import analysis
+from app.services.result_cache import ResultCache
+from app.api.serialization import iter_ndjson
+from app.services.data_loader import table_separator
+from app.services.http_client import external_client
+from app.services import gene_sets
+from app.services import streaming_dea
+from app.services import spls
+from app.services import rarefaction
+from app.services import ingestion
+from app.services import jobs
+from app.services.jobs import job_manager
+from app.services import tracing
+from app.services.result_store import result_store
+from app.api.negotiation import NegotiatedRoute, Payload, dataset_view, response_cache
 import pandas as pd
 import numpy as np
-from pydantic import BaseModel
-from typing import List
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, create_model
+from typing import Annotated, Any, Dict, List, Optional
+import inspect
+import functools
+import itertools
+import logging
 
-router = APIRouter()
+# Endpoints return DataFrames inside Payload; the route class encodes them per Accept
+router = APIRouter(route_class=NegotiatedRoute)
+logger = logging.getLogger(__name__)
+
+# DEA results keyed by (dataset version, contrast, normalization, test)
+dea_cache = ResultCache(max_entries=32, name="dea")
+registry.on_retire(dea_cache.drop_version)
+
+# Per-group sufficient statistics keyed by (dataset version, metadata column, min_count)
+group_stats_cache = ResultCache(max_entries=8, name="group_stats")
+registry.on_retire(group_stats_cache.drop_version)
+registry.on_retire(gene_sets.clear_library_cache)
+
+# Beta-diversity distance matrices keyed by (dataset version, rank, metric)
+distance_cache = ResultCache(max_entries=32, name="distances")
+registry.on_retire(distance_cache.drop_version)
+
+# Rarefaction curves keyed by (dataset version, rank, depth grid, iterations, seed)
+rarefaction_cache = ResultCache(max_entries=16, name="rarefaction")
+registry.on_retire(rarefaction_cache.drop_version)
+
+# Sparse PLS fits (with their CV) keyed by (dataset version, rank, parameters)
+integration_cache = ResultCache(max_entries=16, name="integration")
+registry.on_retire(integration_cache.drop_version)
 
 class GeneList(BaseModel):
     genes: List[str]
 
+class GeneListBatch(BaseModel):
+    lists: Dict[str, List[str]]
+
+class SampleBatchRequest(BaseModel):
+    # One row per new sample, with the dataset's sample column (e.g. Title) and group column
+    metadata: List[Dict[str, Any]]
+    # {sample: {gene: count}}; genes a sample leaves out count as 0
+    counts: Dict[str, Dict[str, float]] = {}
+    # Long-format rows like the abundance file's: Sample, Abundance and the rank columns
+    abundance: List[Dict[str, Any]] = []
+
+class ContrastRequest(BaseModel):
+    dataset: Optional[str] = None
+    # The dataset's group column if omitted
+    column: Optional[str] = None
+    # [[group1, group2], ...]; every pairwise contrast between the column's levels if omitted
+    contrasts: Optional[List[List[str]]] = None
+    method: str = 'welch'
+    min_count: float = 10
+    max_p: Optional[float] = None
+    max_q: Optional[float] = None
+    min_abs_logfc: Optional[float] = None
+
 @router.on_event("startup")
 async def startup_event():
-    success = data_loader.load_data()
-    if not success:
-        print("WARNING: Data failed to load on startup.")
+    # Load the default dataset in the background so the app answers /healthz and
+    # /readyz while booting; the others load on first use
+    registry.start_load()
 
-@router.get("/summary")
-def get_summary():
-    if data_loader.metadata is None:
-        raise HTTPException(status_code=503, detail="Data not loaded")
-    
+@router.on_event("shutdown")
+async def shutdown_event():
+    await external_client.aclose()
+    job_manager.shutdown()
+
+# Seconds clients are told to wait before retrying while the data is still loading
+RETRY_AFTER = "5"
+
+def _require_data(dataset: str = None):
+    """
+    The loader for a dataset (the default if None), once loaded. 404 for unknown names;
+    503 until its first load has finished (a first request starts it), with Retry-After
+    unless loading failed.
+    """
+    ds = registry.acquire(dataset)
+    if ds is None:
+        raise HTTPException(status_code=404, detail=f"Unknown dataset '{dataset}'. Available: {', '.join(registry.names())}")
+    if ds.ready:
+        return ds
+    if ds.status == 'failed':
+        raise HTTPException(status_code=503, detail=f"Dataset '{ds.name}' failed to load: {ds.error}")
+    raise HTTPException(status_code=503, detail=f"Dataset '{ds.name}' is loading", headers={"Retry-After": RETRY_AFTER})
+
+def _stored(dataset: str, analysis: str, params: dict):
+    """
+    The batch pipeline's result for analysis(**params) on the dataset's current version,
+    or None. Answers before the dataset is loaded: the version comes from its files.
+    """
+    loader = registry.loader(dataset)
+    if loader is None:
+        return None
+    return result_store.get(loader.name, loader.current_version(), analysis, params)
+
+def store_params(analysis: str, kwargs: dict):
+    """The parameters a precomputed result is stored under: kwargs with defaults filled in, minus dataset."""
+    bound = inspect.signature(PRECOMPUTED[analysis]).bind(**kwargs)
+    bound.apply_defaults()
+    params = dict(bound.arguments)
+    params.pop('dataset', None)
+    if analysis == 'dea':
+        # Only what the unfiltered table depends on, as in dea_cache's key
+        params = {k: params[k] for k in ('group1', 'group2', 'method')} | (
+            {'min_count': params['min_count']} if params['method'] == 'moderated' else {})
+    return params
+
+def precomputed(analysis: str):
+    """Serve the function's result from the result store when the pipeline stored it for these exact parameters."""
+    def decorate(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs).arguments
+            stored = _stored(arguments.get('dataset'), analysis, store_params(analysis, arguments))
+            return stored if stored is not None else func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+@router.get("/datasets")
+def list_datasets():
+    return registry.stats()
+
+@router.post("/datasets/{name}/load", status_code=202)
+def load_dataset(name: str):
+    # Also the way to retry a dataset whose load failed
+    loader = registry.start_load(name)
+    if loader is None:
+        raise HTTPException(status_code=404, detail=f"Unknown dataset '{name}'")
+    return loader.state()
+
+@router.delete("/datasets/{name}")
+def evict_dataset(name: str):
+    if registry.manifest(name) is None:
+        raise HTTPException(status_code=404, detail=f"Unknown dataset '{name}'")
+    if not registry.evict(name):
+        raise HTTPException(status_code=409, detail=f"Dataset '{name}' is not loaded, still loading, or the default")
+    return {"dataset": name, "evicted": True}
+
+@router.post("/datasets/{name}/samples")
+def ingest_samples(name: str, request: SampleBatchRequest):
+    # Appends to the loaded dataset and bumps its version; see _carry_over for what is kept
+    ds = _require_data(name)
+    try:
+        batch = ingestion.SampleBatch.from_payload(request.metadata, request.counts, request.abundance)
+        previous = registry.ingest(ds.name, batch)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except OSError as e:
+        logger.exception("Could not save ingested samples")
+        raise HTTPException(status_code=500, detail=f"Could not save the batch: {e}")
     return {
-        "samples": len(data_loader.metadata),
-        "genes": len(data_loader.transcriptomics) if data_loader.transcriptomics is not None else 0,
-        "taxa": len(data_loader.metagenomics) if data_loader.metagenomics is not None else 0,
-        "groups": data_loader.metadata['Disease severity'].unique().tolist() if 'Disease severity' in data_loader.metadata.columns else []
+        "dataset": ds.name,
+        "previous_version": previous,
+        "version": ds.version,
+        "added": batch.sample_ids(ds.manifest.sample_column),
+        "with_counts": batch.count_samples,
+        "with_abundance": batch.abundance_samples,
+        "samples": len(ds.metadata),
+        "ingested_samples": len(ds.ingested),
     }
 
-@router.get("/transcriptomics/dea")
-def get_dea_results(group1: str = Query(..., description="Group 1 name"), group2: str = Query(..., description="Group 2 name")):
-    if data_loader.transcriptomics is None:
-        raise HTTPException(status_code=503, detail="Transciptomics data not loaded")
+@router.get("/summary")
+@dataset_view
+def get_summary(dataset: Optional[str] = Query(None, description="Dataset name (see /datasets); the default dataset if omitted")):
+    ds = _require_data(dataset)
+    group_column = ds.manifest.group_column
+    
+    return Payload({
+        "dataset": ds.name,
+        "samples": len(ds.metadata),
+        "genes": len(ds.transcriptomics) if ds.transcriptomics is not None else 0,
+        "taxa": len(ds.metagenomics) if ds.metagenomics is not None else 0,
+        "groups": ds.metadata[group_column].unique().tolist() if group_column in ds.metadata.columns else []
+    })
+
+def _dea_table(group1: str, group2: str, method: str = 'welch', min_count: float = 10,
+               max_p: float = None, max_q: float = None, min_abs_logfc: float = None,
+               sort: str = None, order: str = 'asc', engine: str = 'memory', memory_budget_mb: float = None,
+               dataset: str = None):
+    if method not in analysis.DEA_METHODS:
+        raise HTTPException(status_code=400, detail=f"Unknown method '{method}'. Available: {', '.join(analysis.DEA_METHODS)}")
+    if engine not in ('memory', 'stream'):
+        raise HTTPException(status_code=400, detail=f"Unknown engine '{engine}'. Available: memory, stream")
+    dea_res = None
+    if engine == 'memory':
+        dea_res = _stored(dataset, 'dea', store_params('dea', {'group1': group1, 'group2': group2, 'method': method, 'min_count': min_count}))
+    if dea_res is None:
+        dea_res = _compute_dea(group1, group2, method, min_count, engine, memory_budget_mb, dataset)
+
+    try:
+        return analysis.filter_dea_results(dea_res, max_p=max_p, max_q=max_q, min_abs_logfc=min_abs_logfc, sort_by=sort, descending=(order == 'desc'))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _dea_setup(group1: str, group2: str, method: str, min_count: float, engine: str, dataset: str):
+    """(dataset, groups, method params, engine, dea_cache key) for a two-group DEA request."""
+    ds = _require_data(dataset)
     
     # Identify samples for groups based on metadata
     # Assuming 'Disease severity' or 'Characteristics' holds the group info
     # For this specific dataset, let's look at 'Disease severity' or 'Title' to map properly.
     # The user request mentioned 'Disease vs Control'.
     
-    meta = data_loader.metadata
+    meta = ds.metadata
+    group_column, sample_column = ds.manifest.group_column, ds.manifest.sample_column
     
     # Simple logic: map group names to sample columns
     # We need to match Metadata 'Accession' or 'Title' to Count file columns.
     # Based on Step 12 output: Count columns are AS1_R1, SY1_R1 etc.
     # Metadata Title column has AS1_R1... 
     
-    g1_samples = meta[meta['Disease severity'] == group1]['Title'].tolist()
-    g2_samples = meta[meta['Disease severity'] == group2]['Title'].tolist()
+    g1_samples = meta[meta[group_column] == group1][sample_column].tolist()
+    g2_samples = meta[meta[group_column] == group2][sample_column].tolist()
     
     # Intersect with available columns
-    available_cols = data_loader.transcriptomics.columns.tolist()
+    available_cols = ds.transcriptomics.columns.tolist()
     g1_samples = [s for s in g1_samples if s in available_cols]
     g2_samples = [s for s in g2_samples if s in available_cols]
     
@@ -59,28 +247,302 @@ def get_dea_results(group1: str = Query(..., description="Group 1 name"), group2
         
     groups = {'group1': g1_samples, 'group2': g2_samples}
     
-    dea_res = analysis.perform_differential_expression(data_loader.transcriptomics, groups)
+    if engine == 'stream' and not set(ds.ingested).isdisjoint(g1_samples + g2_samples):
+        # The stream engine re-reads the source file, which lacks ingested samples
+        engine = 'memory'
+
+    if method == 'moderated':
+        if len(g1_samples) + len(g2_samples) < 3:
+            raise HTTPException(status_code=400, detail="Moderated DEA needs at least 3 samples across both groups")
+        params = {'min_count': min_count}
+    else:
+        params = {}
+    # The stream engine's result doesn't depend on the memory budget, so it is left out
+    cache_key = ('dea', ds.version, group1, group2, 'log_cpm', method, tuple(sorted(params.items())), engine)
+    return ds, groups, params, engine, cache_key
+
+def _compute_dea(group1: str, group2: str, method: str, min_count: float, engine: str, memory_budget_mb: float, dataset: str):
+    ds, groups, params, engine, cache_key = _dea_setup(group1, group2, method, min_count, engine, dataset)
+    if engine == 'stream':
+        # Re-read the count file in chunks instead of using the loaded matrix
+        path = ds.source_path('transcriptomics')
+        compute = lambda: streaming_dea.streaming_dea(
+            path, groups, method=method, min_count=min_count,
+            memory_budget_mb=memory_budget_mb, sep=table_separator(path)
+        )
+    else:
+        compute = lambda: analysis.DEA_METHODS[method](ds.transcriptomics, groups, log_cpm=ds.log_cpm, **params)
+    return dea_cache.get_or_compute(cache_key, compute)
+
+def _stream_dea_rows(group1: str, group2: str, method: str, min_count: float, max_p: float, max_q: float,
+                     min_abs_logfc: float, limit: int, offset: int, memory_budget_mb: float, dataset: str):
+    """
+    engine=stream as ndjson lines, produced block by block as the stream engine yields
+    them, with the filters and paging applied on the way; None when the table is
+    already cached (or the engine falls back to memory) and the usual path is cheaper.
+    """
+    if method not in analysis.DEA_METHODS:
+        raise HTTPException(status_code=400, detail=f"Unknown method '{method}'. Available: {', '.join(analysis.DEA_METHODS)}")
+    ds, groups, params, engine, cache_key = _dea_setup(group1, group2, method, min_count, 'stream', dataset)
+    if engine != 'stream' or dea_cache.get(cache_key) is not None:
+        return None
+    path = ds.source_path('transcriptomics')
+    blocks = streaming_dea.iter_streaming_dea(path, groups, method=method, min_count=min_count,
+                                              memory_budget_mb=memory_budget_mb, sep=table_separator(path))
+    try:
+        # Both passes run here, so their errors are still an HTTP status rather than a cut-off body
+        first = next(blocks, None)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    def lines():
+        skip, left = offset, limit
+        for block in itertools.chain([first] if first is not None else [], blocks):
+            block = analysis.filter_dea_results(block, max_p=max_p, max_q=max_q, min_abs_logfc=min_abs_logfc)
+            if skip:
+                block, skip = block.iloc[skip:], max(0, skip - len(block))
+            if left is not None:
+                block = block.iloc[:left]
+                left -= len(block)
+            if len(block):
+                yield from iter_ndjson(block.reset_index())
+            if left == 0:
+                break
+    return lines()
+
+def _dea_page(dea_res: pd.DataFrame, limit: int = None, offset: int = 0):
+    stop = offset + limit if limit is not None else None
+    return dea_res.iloc[offset:stop].reset_index()
+
+def _dea_job(group1: str, group2: str, method: str = 'welch', min_count: float = 10,
+             max_p: float = None, max_q: float = None, min_abs_logfc: float = None,
+             sort: str = None, order: str = 'asc', limit: int = None, offset: int = 0,
+             engine: str = 'memory', memory_budget_mb: float = None, dataset: str = None):
+    dea_res = _dea_table(group1, group2, method, min_count, max_p, max_q, min_abs_logfc, sort, order, engine, memory_budget_mb, dataset)
+    return {"total": len(dea_res), "results": _dea_page(dea_res, limit, offset)}
+
+@router.get("/transcriptomics/dea")
+@dataset_view
+def get_dea_results(
+    group1: str = Query(..., description="Group 1 name"),
+    group2: str = Query(..., description="Group 2 name"),
+    method: str = Query("welch", description="DEA engine: 'welch' (t-test) or 'moderated' (empirical-Bayes t)"),
+    min_count: float = Query(10, ge=0, description="moderated: low-count filter threshold in reads at median library size"),
+    max_p: Optional[float] = Query(None, ge=0, le=1, description="Keep genes with p_value <= max_p"),
+    max_q: Optional[float] = Query(None, ge=0, le=1, description="Keep genes with adj_p_value <= max_q"),
+    min_abs_logfc: Optional[float] = Query(None, ge=0, description="Keep genes with |logFC| >= min_abs_logfc"),
+    sort: Optional[str] = Query(None, description="Sort by p_value, adj_p_value, logFC, abs_logFC or gene"),
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+    limit: Optional[int] = Query(None, ge=1, description="Page size; total matches are in X-Total-Count"),
+    offset: int = Query(0, ge=0),
+    format: str = Query("json", pattern="^(json|ndjson|msgpack|arrow)$", description="'ndjson' streams one gene per line; 'msgpack'/'arrow' are the same as the Accept header"),
+    engine: str = Query("memory", pattern="^(memory|stream)$", description="'stream' re-reads the count file in chunks (out-of-core) instead of using the loaded matrix; with format=ndjson and no sort, rows are sent chunk by chunk, without X-Total-Count"),
+    memory_budget_mb: Optional[float] = Query(None, gt=0, description="stream: working-memory budget per chunk, in MB"),
+    dataset: Optional[str] = Query(None, description="Dataset name (see /datasets); the default dataset if omitted"),
+):
+    if format == 'ndjson' and engine == 'stream' and sort is None:
+        # Unsorted, the rows can go out as the stream engine computes them (no total up front)
+        rows = _stream_dea_rows(group1, group2, method, min_count, max_p, max_q, min_abs_logfc, limit, offset, memory_budget_mb, dataset)
+        if rows is not None:
+            return StreamingResponse(rows, media_type="application/x-ndjson")
+
+    dea_res = _dea_table(group1, group2, method, min_count, max_p, max_q, min_abs_logfc, sort, order, engine, memory_budget_mb, dataset)
+    
+    total = len(dea_res)
+    dea_res = _dea_page(dea_res, limit, offset)
+    
+    headers = {"X-Total-Count": str(total)}
+    if format == 'ndjson':
+        return StreamingResponse(iter_ndjson(dea_res), media_type="application/x-ndjson", headers=headers)
     
-    # Return as list of dicts for JSON
-    dea_res = dea_res.reset_index()
-    return dea_res.to_dict(orient='records')
+    return Payload(dea_res, headers=headers)
+
+def _sample_groups(ds, column: str):
+    """Map each level of a metadata column to the count-matrix columns (sample IDs) in it."""
+    meta = ds.metadata
+    if column not in meta.columns:
+        raise HTTPException(status_code=400, detail=f"Unknown metadata column '{column}'")
+    available = set(ds.transcriptomics.columns)
+    groups = {}
+    for level, titles in meta.groupby(column, sort=False)[ds.manifest.sample_column]:
+        samples = [t for t in titles if t in available]
+        if samples:
+            groups[str(level)] = samples
+    return groups
+
+def _carry_over(ds, previous: str, batch):
+    """
+    Move what a batch of new samples leaves unchanged to the dataset's new version,
+    before the previous version's results are dropped: DEA contrasts between groups
+    that gained no counted samples, and the distance matrices and rarefaction curves
+    if the batch had no abundance rows. Cached group statistics are extended with
+    the new samples instead of being recomputed. The rest (integration, enrichment
+    backgrounds, encoded responses) depends on every sample and is recomputed.
+    """
+    counted = set(batch.count_samples)
+    carried = 0
+    if counted:
+        group_column = ds.manifest.group_column
+        meta = batch.metadata.set_index(batch.metadata[ds.manifest.sample_column].astype(str))
+        changed = {str(level) for sample, level in meta.get(group_column, pd.Series(dtype=object)).dropna().items() if sample in counted}
+        carried += dea_cache.carry_over(previous, ds.version, lambda key: str(key[2]) not in changed and str(key[3]) not in changed)
+        for key, stats in group_stats_cache.entries(previous):
+            try:
+                updated = stats.add_samples(ds.transcriptomics, _sample_groups(ds, key[2]), log_cpm=ds.log_cpm)
+            except (ValueError, HTTPException) as e:
+                logger.info("Not carrying over %s: %s", key, getattr(e, 'detail', e))
+                continue
+            group_stats_cache.put(('group_stats', ds.version) + key[2:], updated)
+            carried += 1
+    else:
+        carried += dea_cache.carry_over(previous, ds.version)
+        carried += group_stats_cache.carry_over(previous, ds.version)
+    if batch.abundance.empty:
+        carried += distance_cache.carry_over(previous, ds.version)
+        carried += rarefaction_cache.carry_over(previous, ds.version)
+    logger.info("Dataset %s: carried %d cached results over to %s.", ds.name, carried, ds.version)
+
+registry.on_ingest(_carry_over)
+
+@router.post("/transcriptomics/dea/contrasts")
+def get_contrast_dea(request: ContrastRequest):
+    if request.method not in analysis.DEA_METHODS:
+        raise HTTPException(status_code=400, detail=f"Unknown method '{request.method}'. Available: {', '.join(analysis.DEA_METHODS)}")
+    ds = _require_data(request.dataset)
+    column = request.column or ds.manifest.group_column
+
+    sample_groups = _sample_groups(ds, column)
+    contrasts = request.contrasts
+    if contrasts is None:
+        names = list(sample_groups)
+        contrasts = [[a, b] for i, a in enumerate(names) for b in names[i + 1:]]
+    for pair in contrasts:
+        if len(pair) != 2 or pair[0] not in sample_groups or pair[1] not in sample_groups:
+            raise HTTPException(status_code=400, detail=f"Invalid contrast {pair}. Levels of '{column}': {', '.join(sample_groups)}")
+        if request.method == 'moderated' and len(sample_groups[pair[0]]) + len(sample_groups[pair[1]]) < 3:
+            raise HTTPException(status_code=400, detail=f"Moderated DEA needs at least 3 samples across {pair[0]} and {pair[1]}")
+
+    # Group statistics are computed once per column and reused by every contrast
+    group_stats = group_stats_cache.get_or_compute(
+        ('group_stats', ds.version, column, request.min_count),
+        lambda: analysis.GroupStatistics(ds.transcriptomics, sample_groups, log_cpm=ds.log_cpm, min_count=request.min_count)
+    )
+    results = analysis.perform_multi_contrast_dea(
+        ds.transcriptomics, sample_groups,
+        contrasts=[tuple(pair) for pair in contrasts], method=request.method, group_stats=group_stats
+    )
+
+    return Payload({
+        "dataset": ds.name,
+        "column": column,
+        "groups": {name: len(samples) for name, samples in sample_groups.items()},
+        "contrasts": [
+            {"group1": a, "group2": b, "results": analysis.filter_dea_results(
+                res, max_p=request.max_p, max_q=request.max_q, min_abs_logfc=request.min_abs_logfc
+            ).reset_index()}
+            for (a, b), res in results.items()
+        ]
+    })
+
+@router.get("/transcriptomics/dea/cache")
+def get_dea_cache_stats():
+    return {"dea": dea_cache.stats(), "group_stats": group_stats_cache.stats()}
+
+def _collect_metrics():
+    # Read at scrape time from the counters the caches, job manager and loader already keep
+    caches = [c.stats() for c in (dea_cache, group_stats_cache, distance_cache, rarefaction_cache, integration_cache, response_cache, result_store)] + [gene_sets.library_cache_stats()]
+    for field, kind, help in [
+        ("hits", "counter", "Result cache hits"),
+        ("misses", "counter", "Result cache misses"),
+        ("evictions", "counter", "Result cache LRU evictions"),
+        ("entries", "gauge", "Results currently cached"),
+    ]:
+        suffix = "_total" if kind == "counter" else ""
+        yield f"omics_cache_{field}{suffix}", kind, help, [({"cache": c["name"]}, c[field]) for c in caches]
+    job_counts = job_manager.stats()["jobs"]
+    yield "omics_jobs", "gauge", "Background jobs by status", [
+        ({"status": status}, job_counts.get(status, 0)) for status in (jobs.QUEUED, jobs.RUNNING, jobs.DONE, jobs.FAILED, jobs.CANCELLED)
+    ]
+    datasets = registry.stats()
+    loaders = {d["name"]: registry.peek(d["name"]) for d in datasets["datasets"]}
+    yield "omics_data_ready", "gauge", "1 while a version of the dataset is loaded", [
+        ({"dataset": d["name"]}, int(d["version"] is not None)) for d in datasets["datasets"]
+    ]
+    yield "omics_data_load_seconds", "gauge", "Duration of each step of the dataset's last load", [
+        ({"dataset": name, "step": step}, seconds)
+        for name, loader in loaders.items() if loader is not None for step, seconds in loader.timings.items()
+    ]
+    for field, kind, help in [
+        ("loads", "counter", "Successful dataset loads"),
+        ("load_failures", "counter", "Failed dataset loads"),
+        ("evictions", "counter", "Datasets evicted to stay under the memory budget"),
+        ("ingests", "counter", "Sample batches ingested"),
+        ("samples_ingested", "counter", "Samples ingested"),
+        ("memory_bytes", "gauge", "Estimated memory held by the loaded dataset"),
+    ]:
+        suffix = "_total" if kind == "counter" else ""
+        yield f"omics_dataset_{field}{suffix}", kind, help, [({"dataset": d["name"]}, d[field]) for d in datasets["datasets"]]
+    yield "omics_dataset_memory_budget_bytes", "gauge", "Memory budget for loaded datasets", [({}, datasets["memory_budget_bytes"])]
+
+tracing.REGISTRY.register_collector(_collect_metrics)
+
+def _enrichment_background(ds, background: str):
+    if background == 'all':
+        return None
+    return analysis.expressed_genes(ds.transcriptomics)
 
 @router.post("/transcriptomics/enrichment")
-async def get_enrichment(genes: GeneList):
+async def get_enrichment(
+    genes: GeneList,
+    source: str = Query("enrichr", pattern="^(enrichr|local)$", description="'enrichr' (remote API) or 'local' (GMT libraries on disk)"),
+    libraries: Optional[List[str]] = Query(None, description="local: GMT library names; all available if omitted"),
+    background: str = Query("all", pattern="^(all|expressed)$", description="local: gene universe for the hypergeometric test"),
+    dataset: Optional[str] = Query(None, description="Dataset name (see /datasets); the default dataset if omitted"),
+):
+    if source == 'local':
+        ds = _require_data(dataset)
+        try:
+            return analysis.perform_local_enrichment(
+                genes.genes, ds.transcriptomics.index, libraries=libraries,
+                background=_enrichment_background(ds, background), version=ds.version
+            )
+        except FileNotFoundError as e:
+            raise HTTPException(status_code=404, detail=str(e))
     try:
         results = await analysis.perform_enrichment_analysis(genes.genes)
         return results
     except Exception as e:
-        print(f"Error in enrichment analysis: {e}")
+        logger.exception("Error in enrichment analysis")
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/transcriptomics/enrichment/batch")
+def get_enrichment_batch(
+    request: GeneListBatch,
+    libraries: Optional[List[str]] = Query(None, description="GMT library names; all available if omitted"),
+    background: str = Query("all", pattern="^(all|expressed)$"),
+    top_n: int = Query(10, ge=1, le=1000),
+    dataset: Optional[str] = Query(None, description="Dataset name (see /datasets); the default dataset if omitted"),
+):
+    ds = _require_data(dataset)
+    try:
+        return analysis.perform_local_enrichment_batch(
+            request.lists, ds.transcriptomics.index, libraries=libraries,
+            background=_enrichment_background(ds, background), version=ds.version, top_n=top_n
+        )
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@router.get("/transcriptomics/enrichment/libraries")
+def get_enrichment_libraries():
+    return {"local": gene_sets.available_libraries(), "enrichr": analysis.ENRICHR_LIBRARIES}
+
 @router.post("/transcriptomics/ppi")
 async def get_ppi(genes: GeneList):
     try:
         results = await analysis.get_ppi_network(genes.genes)
         return results
     except Exception as e:
-        print(f"Error in PPI analysis: {e}")
+        logger.exception("Error in PPI analysis")
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/transcriptomics/drugs")
@@ -89,90 +551,447 @@ async def get_drugs(genes: GeneList):
         results = await analysis.get_drug_interactions(genes.genes)
         return results
     except Exception as e:
-        print(f"Error in Drug analysis: {e}")
+        logger.exception("Error in drug analysis")
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.get("/metagenomics/diversity")
-def get_diversity():
-    if data_loader.metagenomics is None:
-         raise HTTPException(status_code=503, detail="Metagenomics data not loaded")
+def _taxa_matrix(ds, rank: str):
+    taxonomy = ds.taxonomy
+    if rank not in taxonomy.ranks:
+         raise HTTPException(status_code=400, detail=f"Unknown rank '{rank}'. Available: {', '.join(taxonomy.ranks)}")
+    return taxonomy
+
+def _distance_matrix(ds, rank: str, metric: str):
+    if metric not in analysis.BETA_METRICS:
+        raise HTTPException(status_code=400, detail=f"Unknown metric '{metric}'. Available: {', '.join(analysis.BETA_METRICS)}")
+    taxonomy = _taxa_matrix(ds, rank)
+    return distance_cache.get_or_compute(
+        ('distance', ds.version, rank, metric),
+        lambda: analysis.calculate_distance_matrix(taxonomy.abundance(rank), metric=metric)
+    )
+
+def _samples(ds, columns: list):
+    # Metadata indexed by sample ID, for joining onto per-sample results
+    return ds.metadata.set_index(ds.manifest.sample_column)[columns]
+
+@precomputed('diversity')
+def _diversity(rank: str = 'Genus', metric: str = 'braycurtis', dataset: str = None):
+    ds = _require_data(dataset)
+    taxonomy = _taxa_matrix(ds, rank)
          
-    # Need to pivot metagenomics to be Taxa x Sample
-    # The file has: Sample, Abundance, Kingdom...
-    # We assume 'Sample' column matches metadata 'Title'
-    
-    df = data_loader.metagenomics
-    # Pivot: Index=Species (or Genus), Columns=Sample, Values=Abundance
-    # Let's aggregate at Genus level for robustness
-    pivot_df = df.pivot_table(index='Genus', columns='Sample', values='Abundance', aggfunc='sum').fillna(0)
+    # Taxa x Samples abundance at the requested rank, precomputed at load time
+    pivot_df = taxonomy.abundance(rank)
     
+    # calculate_diversity_indices returns index=Samples, columns 'shannon', 'simpson'
     div_df = analysis.calculate_diversity_indices(pivot_df)
     
-    # Add metadata for plotting (e.g. Group)
-    div_df = div_df.T # Samples as rows logic ?? Wait. 
-    # calculate_diversity_indices returns DataFrame with columns 'shannon', 'simpson' and index=Samples (columns of input)
-    # Check analysis.py implementation: 
-    # rel_abundance = abundance_df.div(sum, axis=1) -> cols are samples.
-    # shannon = sum(axis=0) -> result is Series with index=Samples.
-    # So div_df has index=Samples.
-    
-    # Join with metadata
-    meta = data_loader.metadata.set_index('Title')
-    
-    # Calculate Beta Diversity (PCoA)
-    beta_df = analysis.calculate_beta_diversity(pivot_df)
+    # Calculate Beta Diversity (PCoA) on the cached distance matrix
+    beta_df = analysis.calculate_beta_diversity(pivot_df, distances=_distance_matrix(ds, rank, metric))
     
     # Join everything: Alpha + Beta + Metadata
     # Alpha has index=Samples, Beta has index=Samples
-    result = div_df.join(beta_df, how='inner').join(meta[['Disease severity']], how='inner')
+    result = div_df.join(beta_df, how='inner').join(_samples(ds, [ds.manifest.group_column]), how='inner')
     
-    return result.reset_index().rename(columns={'index':'Sample'}).to_dict(orient='records')
+    return result.reset_index().rename(columns={'index':'Sample'})
 
+@router.get("/metagenomics/diversity")
+@dataset_view
+def get_diversity(
+    rank: str = Query("Genus", description="Taxonomic rank to aggregate at"),
+    metric: str = Query("braycurtis", description="Beta-diversity metric: braycurtis, jaccard or aitchison"),
+    dataset: Optional[str] = Query(None, description="Dataset name (see /datasets); the default dataset if omitted"),
+):
+    return Payload(_diversity(rank, metric, dataset))
 
-@router.get("/metagenomics/composition")
-def get_composition():
-    # Return top N genera relative abundance per sample
-    if data_loader.metagenomics is None:
-         raise HTTPException(status_code=503, detail="Metagenomics data not loaded")
+@precomputed('pcoa')
+def _pcoa(rank: str = 'Genus', metric: str = 'braycurtis', n_components: int = 2, dataset: str = None):
+    ds = _require_data(dataset)
+    distances = _distance_matrix(ds, rank, metric)
+    coords = analysis.calculate_beta_diversity(None, n_components=n_components, distances=distances)
+    result = coords.join(_samples(ds, [ds.manifest.group_column]), how='left')
+    
+    return {
+        "rank": rank,
+        "metric": metric,
+        "explained_variance": coords.attrs['explained_variance'],
+        "coordinates": result.reset_index().rename(columns={'index':'Sample'})
+    }
+
+@router.get("/metagenomics/pcoa")
+@dataset_view
+def get_pcoa(
+    rank: str = Query("Genus", description="Taxonomic rank to aggregate at"),
+    metric: str = Query("braycurtis", description="Beta-diversity metric: braycurtis, jaccard or aitchison"),
+    n_components: int = Query(2, ge=1, le=10),
+    dataset: Optional[str] = Query(None, description="Dataset name (see /datasets); the default dataset if omitted"),
+):
+    return Payload(_pcoa(rank, metric, n_components, dataset))
+
+
+def _rarefaction_curves(ds, rank: str, depths, steps: int, iterations: int, seed: int):
+    taxonomy = _taxa_matrix(ds, rank)
+    abundance = taxonomy.abundance(rank)
+    if depths is None:
+        depths = rarefaction.depth_grid(abundance.sum(axis=0), steps)
+    depths = tuple(sorted({int(d) for d in depths}))
+    try:
+        return rarefaction_cache.get_or_compute(
+            ('rarefaction', ds.version, rank, depths, iterations, seed),
+            lambda: rarefaction.rarefaction_curves(abundance, depths=depths, iterations=iterations, seed=seed)
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@precomputed('rarefaction')
+def _rarefaction(rank: str = 'Genus', depths: List[int] = None, steps: int = 20, iterations: int = 10, seed: int = 42,
+                 dataset: str = None):
+    ds = _require_data(dataset)
+    curves = _rarefaction_curves(ds, rank, depths, steps, iterations, seed)
+    group_column = ds.manifest.group_column
+    return {
+        "rank": rank,
+        "iterations": iterations,
+        "depths": curves.attrs['depths'],
+        "reads": curves.attrs['reads'],
+        "curves": curves.join(_samples(ds, [group_column]), on='Sample', how='left'),
+    }
+
+@precomputed('alpha')
+def _alpha_diversity(rank: str = 'Genus', depth: int = None, iterations: int = 10, seed: int = 42, dataset: str = None):
+    ds = _require_data(dataset)
+    if depth is None:
+        try:
+            depth = rarefaction.default_depth(_taxa_matrix(ds, rank).abundance(rank))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    alpha = rarefaction.rarefied_alpha_diversity(_rarefaction_curves(ds, rank, [depth], None, iterations, seed), depth)
+    result = alpha.join(_samples(ds, [ds.manifest.group_column]), how='left')
+    return {
+        "rank": rank,
+        "depth": alpha.attrs['depth'],
+        "iterations": iterations,
+        "excluded": alpha.attrs['excluded'],
+        "diversity": result.reset_index().rename(columns={'index': 'Sample'}),
+    }
+
+@router.get("/metagenomics/rarefaction")
+@dataset_view
+def get_rarefaction(
+    rank: str = Query("Genus", description="Taxonomic rank to aggregate at"),
+    depths: Optional[List[int]] = Query(None, description="Read depths to subsample to; a log-spaced grid up to the deepest sample if omitted"),
+    steps: int = Query(20, ge=2, le=200, description="Depths in the default grid"),
+    iterations: int = Query(10, ge=1, le=1000, description="Random subsamples averaged per sample and depth"),
+    seed: int = Query(42, description="Seed for the subsampling RNG"),
+    dataset: Optional[str] = Query(None, description="Dataset name (see /datasets); the default dataset if omitted"),
+):
+    return Payload(_rarefaction(rank, depths, steps, iterations, seed, dataset))
+
+@router.get("/metagenomics/alpha")
+@dataset_view
+def get_alpha_diversity(
+    rank: str = Query("Genus", description="Taxonomic rank to aggregate at"),
+    depth: Optional[int] = Query(None, ge=1, description="Common read depth; the shallowest sample's if omitted. Shallower samples are excluded"),
+    iterations: int = Query(10, ge=1, le=1000, description="Random subsamples averaged per sample"),
+    seed: int = Query(42, description="Seed for the subsampling RNG"),
+    dataset: Optional[str] = Query(None, description="Dataset name (see /datasets); the default dataset if omitted"),
+):
+    return Payload(_alpha_diversity(rank, depth, iterations, seed, dataset))
+
+@precomputed('permanova')
+def _permanova(rank: str = 'Genus', metric: str = 'braycurtis', column: str = None, permutations: int = 999, seed: int = 42,
+               dataset: str = None):
+    ds = _require_data(dataset)
+    distances = _distance_matrix(ds, rank, metric)
+    column = column or ds.manifest.group_column
+    if column not in ds.metadata.columns:
+        raise HTTPException(status_code=400, detail=f"Unknown metadata column '{column}'")
+    grouping = _samples(ds, column)
+    
+    try:
+        return {
+            "rank": rank,
+            "metric": metric,
+            "column": column,
+            "permanova": analysis.perform_permanova(distances, grouping, permutations=permutations, seed=seed),
+            "permdisp": analysis.perform_permdisp(distances, grouping, permutations=permutations, seed=seed),
+        }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/metagenomics/permanova")
+@dataset_view
+def get_permanova(
+    rank: str = Query("Genus", description="Taxonomic rank to aggregate at"),
+    metric: str = Query("braycurtis", description="Beta-diversity metric: braycurtis, jaccard or aitchison"),
+    column: Optional[str] = Query(None, description="Metadata column defining the groups; the dataset's group column if omitted"),
+    permutations: int = Query(999, ge=1, le=100000),
+    seed: int = Query(42, description="Seed for the permutation RNG"),
+    dataset: Optional[str] = Query(None, description="Dataset name (see /datasets); the default dataset if omitted"),
+):
+    return Payload(_permanova(rank, metric, column, permutations, seed, dataset))
+
+@precomputed('composition')
+def _composition(rank: str = 'Genus', top_n: int = 20, dataset: str = None):
+    # Return top N taxa relative abundance per sample
+    ds = _require_data(dataset)
+    taxonomy = _taxa_matrix(ds, rank)
          
-    df = data_loader.metagenomics
-    pivot_df = df.pivot_table(index='Genus', columns='Sample', values='Abundance', aggfunc='sum').fillna(0)
-    rel_abundance = pivot_df.div(pivot_df.sum(axis=0), axis=1)
+    rel_abundance = taxonomy.relative(rank)
     
-    # Get top 20 genera by mean abundance
-    top_genera = rel_abundance.mean(axis=1).sort_values(ascending=False).head(20).index
-    filtered = rel_abundance.loc[top_genera]
+    # Get top N taxa by mean abundance
+    top_taxa = taxonomy.top_taxa(rank, top_n)
+    filtered = rel_abundance.loc[top_taxa]
     
     # Format for stacked bar chart: [{sample: s1, Genus1: 0.1, Genus2: 0.2...}, ...]
-    return filtered.T.reset_index().to_dict(orient='records')
+    return filtered.T.reset_index()
 
-@router.get("/biomarkers/correlation")
-def get_correlation():
-    if data_loader.transcriptomics is None or data_loader.metagenomics is None:
-         raise HTTPException(status_code=503, detail="Data not loaded")
+@router.get("/metagenomics/composition")
+@dataset_view
+def get_composition(
+    rank: str = Query("Genus", description="Taxonomic rank to aggregate at"),
+    top_n: int = Query(20, ge=1),
+    dataset: Optional[str] = Query(None, description="Dataset name (see /datasets); the default dataset if omitted"),
+):
+    return Payload(_composition(rank, top_n, dataset))
+
+@precomputed('correlation')
+def _correlation(rank: str = 'Genus', all_pairs: bool = False, max_q: float = None, top_k: int = 500,
+                 min_samples: int = None, dataset: str = None):
+    ds = _require_data(dataset)
+    taxonomy = _taxa_matrix(ds, rank)
+
+    if all_pairs:
+        # Log-CPM, not raw counts: ranks of raw counts across samples follow library size
+        pairs = analysis.spearman_correlation_screen(ds.log_cpm, taxonomy.relative(rank), max_q=max_q, top_k=top_k,
+                                                     min_samples=min_samples)
+        return {
+            **pairs.attrs,
+            "pairs": pairs
+        }
          
-    corr_matrix = analysis.perform_correlation_analysis(data_loader.transcriptomics, data_loader.metagenomics)
+    corr_matrix = analysis.perform_correlation_analysis(ds.transcriptomics, taxonomy.abundance(rank))
     
     # Format for Heatmap: z (2D array), x (taxa), y (genes)
     return {
-        "z": corr_matrix.values.tolist(),
+        "z": corr_matrix.to_numpy(),
         "x": corr_matrix.columns.tolist(),
         "y": corr_matrix.index.tolist()
     }
 
-@router.get("/biomarkers/integration")
-def get_integration():
-    if data_loader.transcriptomics is None or data_loader.metagenomics is None:
-         raise HTTPException(status_code=503, detail="Data not loaded")
+@router.get("/biomarkers/correlation")
+@dataset_view
+def get_correlation(
+    rank: str = Query("Genus", description="Taxonomic rank to aggregate at"),
+    all_pairs: bool = Query(False, description="Screen every gene against every taxon instead of the top-variance heatmap"),
+    max_q: Optional[float] = Query(None, gt=0, le=1, description="All-pairs mode: keep pairs with BH q-value <= max_q"),
+    top_k: int = Query(500, ge=1, le=100000, description="All-pairs mode: return at most this many strongest pairs"),
+    min_samples: Optional[int] = Query(None, ge=1, description="All-pairs mode: only test genes and taxa non-zero in at least this many samples; half of them if omitted"),
+    dataset: Optional[str] = Query(None, description="Dataset name (see /datasets); the default dataset if omitted"),
+):
+    return Payload(_correlation(rank, all_pairs, max_q, top_k, min_samples, dataset))
+
+@precomputed('integration')
+def _integration(rank: str = 'Genus', dataset: str = None):
+    ds = _require_data(dataset)
+    taxonomy = _taxa_matrix(ds, rank)
     
     # PLS Analysis
-    scores = analysis.perform_pls_integration(data_loader.transcriptomics, data_loader.metagenomics)
+    scores = analysis.perform_pls_integration(ds.transcriptomics, taxonomy.abundance(rank))
     
     if scores is None:
          raise HTTPException(status_code=400, detail="Insufficient overlapping samples")
          
     # Add metadata for coloring
-    meta = data_loader.metadata.set_index('Title')
-    result = scores.join(meta[['Disease severity']], how='left')
+    result = scores.join(_samples(ds, [ds.manifest.group_column]), how='left')
     
-    return result.reset_index().rename(columns={'index':'Sample'}).to_dict(orient='records')
+    return result.reset_index().rename(columns={'index':'Sample'})
+
+@router.get("/biomarkers/integration")
+@dataset_view
+def get_integration(
+    rank: str = Query("Genus", description="Taxonomic rank to aggregate at"),
+    dataset: Optional[str] = Query(None, description="Dataset name (see /datasets); the default dataset if omitted"),
+):
+    return Payload(_integration(rank, dataset))
+
+@precomputed('spls')
+def _spls_integration(rank: str = 'Genus', n_components: int = None, max_components: int = 3, keep_genes: List[int] = None,
+                      keep_taxa: List[int] = None, max_genes: int = 5000, folds: int = 4, repeats: int = 3,
+                      min_cv_correlation: float = 0.5, seed: int = 42, dataset: str = None):
+    ds = _require_data(dataset)
+    taxonomy = _taxa_matrix(ds, rank)
+    params = {
+        'n_components': n_components, 'max_components': max_components,
+        'keep_genes': tuple(keep_genes) if keep_genes else None, 'keep_taxa': tuple(keep_taxa) if keep_taxa else None,
+        'max_genes': max_genes, 'folds': folds, 'repeats': repeats, 'min_cv_correlation': min_cv_correlation, 'seed': seed,
+    }
+    # Genes enter as log-CPM and taxa as clr(counts + 1)
+    try:
+        res = integration_cache.get_or_compute(
+            ('spls', ds.version, rank, tuple(sorted(params.items()))),
+            lambda: spls.perform_spls_integration(ds.log_cpm, taxonomy.abundance(rank), **params)
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if res is None:
+        raise HTTPException(status_code=400, detail="Insufficient overlapping samples")
+
+    scores = res['scores'].join(_samples(ds, [ds.manifest.group_column]), how='left')
+    return {
+        "rank": rank,
+        **res['params'],
+        "correlations": res['correlations'],
+        "cv": res['cv'],
+        "scores": scores.reset_index().rename(columns={'index': 'Sample'}),
+        "gene_loadings": res['gene_loadings'].rename_axis('feature').reset_index(),
+        "taxa_loadings": res['taxa_loadings'].rename_axis('feature').reset_index(),
+        "selected": res['selected'],
+    }
+
+@router.get("/biomarkers/integration/spls")
+@dataset_view
+def get_spls_integration(
+    rank: str = Query("Genus", description="Taxonomic rank to aggregate at"),
+    n_components: Optional[int] = Query(None, ge=1, le=10, description="Number of components; chosen by CV (up to max_components) if omitted"),
+    max_components: int = Query(3, ge=1, le=10),
+    keep_genes: Optional[List[Annotated[int, Field(ge=1)]]] = Query(None, description="Candidate numbers of genes selected per component; CV picks one"),
+    keep_taxa: Optional[List[Annotated[int, Field(ge=1)]]] = Query(None, description="Candidate numbers of taxa selected per component; CV picks one"),
+    max_genes: int = Query(5000, ge=1, le=spls.MAX_SCREENED_GENES, description="Pre-screen: keep this many highest-variance genes"),
+    folds: int = Query(4, ge=2, le=20),
+    repeats: int = Query(3, ge=1, le=50),
+    min_cv_correlation: float = Query(0.5, ge=-1, le=1, description="Stop adding components once the held-out score correlation falls below this"),
+    seed: int = Query(42),
+    dataset: Optional[str] = Query(None, description="Dataset name (see /datasets); the default dataset if omitted"),
+):
+    return Payload(_spls_integration(rank, n_components, max_components, keep_genes, keep_taxa, max_genes, folds, repeats, min_cv_correlation, seed, dataset))
+
+# Analyses that can run as background jobs in the worker pool. The functions are
+# module-level so workers can unpickle them by reference.
+JOB_ANALYSES = {
+    'dea': _dea_job,
+    'diversity': _diversity,
+    'rarefaction': _rarefaction,
+    'alpha': _alpha_diversity,
+    'permanova': _permanova,
+    'correlation': _correlation,
+    'integration': _integration,
+    'spls': _spls_integration,
+}
+
+# Analyses the batch pipeline (pipeline.py) precomputes into the result store, by the
+# name their results are stored under. 'dea' is the unfiltered table _dea_table() filters.
+PRECOMPUTED = {
+    'dea': _dea_table,
+    'diversity': _diversity,
+    'pcoa': _pcoa,
+    'permanova': _permanova,
+    'composition': _composition,
+    'rarefaction': _rarefaction,
+    'alpha': _alpha_diversity,
+    'correlation': _correlation,
+    'integration': _integration,
+    'spls': _spls_integration,
+}
+
+def precompute_stages(ds, ranks=('Genus',), metrics=('braycurtis',)):
+    """
+    (analysis, kwargs) for every result the pipeline stores for a loaded dataset: each
+    DEA contrast between levels of the group column with every method, and each
+    per-rank analysis at the endpoints' default parameters. Slowest first, so a pool
+    finishes them sooner.
+    """
+    stages = []
+    for rank in ranks:
+        stages += [('spls', {'rank': rank}), ('correlation', {'rank': rank}), ('rarefaction', {'rank': rank}), ('alpha', {'rank': rank})]
+        for metric in metrics:
+            stages += [('permanova', {'rank': rank, 'metric': metric}), ('diversity', {'rank': rank, 'metric': metric}),
+                       ('pcoa', {'rank': rank, 'metric': metric})]
+        stages += [('integration', {'rank': rank}), ('composition', {'rank': rank})]
+
+    groups = _sample_groups(ds, ds.manifest.group_column)
+    names = list(groups)
+    for method in analysis.DEA_METHODS:
+        for i, a in enumerate(names):
+            for b in names[i + 1:]:
+                if method == 'moderated' and len(groups[a]) + len(groups[b]) < 3:
+                    continue
+                stages.append(('dea', {'group1': a, 'group2': b, 'method': method}))
+    return stages
+
+class JobRequest(BaseModel):
+    analysis: str
+    params: Dict[str, Any] = {}
+
+def _job_params_model(analysis: str, route):
+    """
+    A model of the job's params built from its GET route's query parameters, so a job
+    gets the same types, bounds and patterns (and 422s) as the request it stands for.
+    """
+    accepted = inspect.signature(JOB_ANALYSES[analysis]).parameters
+    fields = {
+        name: (param.annotation, param.default)
+        for name, param in inspect.signature(route).parameters.items() if name in accepted
+    }
+    return create_model(f"{analysis.title()}JobParams", __config__=ConfigDict(extra='forbid'), **fields)
+
+# Each job analysis's params, validated at submit time; the routes are the source of truth
+JOB_PARAMS = {
+    analysis: _job_params_model(analysis, route)
+    for analysis, route in {
+        'dea': get_dea_results,
+        'diversity': get_diversity,
+        'rarefaction': get_rarefaction,
+        'alpha': get_alpha_diversity,
+        'permanova': get_permanova,
+        'correlation': get_correlation,
+        'integration': get_integration,
+        'spls': get_spls_integration,
+    }.items()
+}
+
+def _get_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job '{job_id}'")
+    return job
+
+@router.post("/jobs", status_code=202)
+def submit_job(request: JobRequest):
+    func = JOB_ANALYSES.get(request.analysis)
+    if func is None:
+        raise HTTPException(status_code=400, detail=f"Unknown analysis '{request.analysis}'. Available: {', '.join(JOB_ANALYSES)}")
+    try:
+        params = JOB_PARAMS[request.analysis].model_validate(request.params).model_dump(exclude_unset=True)
+    except ValidationError as e:
+        # Reported like a bad query string, located under the body's params
+        raise RequestValidationError([{**err, 'loc': ('body', 'params') + tuple(err['loc'])} for err in e.errors()])
+    ds = _require_data(params.get('dataset'))
+    # Pin the job to the dataset (and version) it was submitted against
+    params = {**params, 'dataset': ds.name}
+    job = job_manager.submit(request.analysis, func, params, dataset=ds.name, version=ds.version)
+    return job.to_dict()
+
+@router.get("/jobs")
+def list_jobs():
+    return {**job_manager.stats(), "items": [job.to_dict() for job in job_manager.list()]}
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = Query(0, ge=0, le=60, description="Long-poll: seconds to wait for the job to finish")):
+    job = await job_manager.wait(_get_job(job_id), wait)
+    return job.to_dict()
+
+@router.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str, wait: float = Query(0, ge=0, le=60, description="Long-poll: seconds to wait for the job to finish")):
+    job = await job_manager.wait(_get_job(job_id), wait)
+    status = job.status
+    if status == jobs.FAILED:
+        raise HTTPException(status_code=job.error.status_code, detail=job.error.detail)
+    if status == jobs.CANCELLED:
+        raise HTTPException(status_code=409, detail=f"Job '{job_id}' was cancelled")
+    if status != jobs.DONE:
+        return JSONResponse(status_code=202, content=job.to_dict())
+    return Payload(job.result)
+
+@router.delete("/jobs/{job_id}")
+def cancel_job(job_id: str):
+    _get_job(job_id)
+    return job_manager.cancel(job_id).to_dict()
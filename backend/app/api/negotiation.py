@@ -0,0 +1,131 @@
+import hashlib
+from fastapi import HTTPException, Request, Response
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool
+from app.api import serialization
+from app.services.datasets import registry
+from app.services.result_cache import ResultCache
+from app.services.tracing import span
+
+# Bump when the encoding of any response changes, so old ETags stop matching
+RESPONSE_FORMAT_VERSION = 1
+
+VARY = "Accept, Accept-Encoding"
+
+# Encoded (and compressed) response bodies keyed by (dataset version, ETag), so a
+# repeat request without If-None-Match skips both the analysis and the encoding
+response_cache = ResultCache(max_entries=64, name="responses")
+registry.on_retire(response_cache.drop_version)
+
+
+class Payload(Response):
+    """
+    An endpoint's result, left unencoded: NegotiatedRoute turns it into JSON,
+    msgpack or Arrow per the request's Accept header and compresses it.
+    DataFrames inside go out as row records (JSON/msgpack) or as the Arrow table.
+    """
+
+    def __init__(self, content, status_code: int = 200, headers: dict = None):
+        super().__init__(status_code=status_code)
+        self.payload = content
+        self.extra_headers = dict(headers or {})
+
+
+def dataset_view(endpoint):
+    """
+    Mark a GET endpoint whose response depends only on the version of the dataset
+    named by its dataset= parameter and its query parameters. Its responses get strong
+    ETags and are answered with 304 Not Modified, or from the encoded-response cache,
+    without running it.
+    """
+    endpoint.dataset_view = True
+    return endpoint
+
+
+def _etag(version: str, request: Request, fmt: str, encoding: str):
+    params = sorted((k, v) for k, v in request.query_params.multi_items() if k != 'profile')
+    key = repr((RESPONSE_FORMAT_VERSION, version, request.url.path, params, fmt, encoding))
+    return '"' + hashlib.sha1(key.encode()).hexdigest() + '"'
+
+
+def _etag_matches(if_none_match: str, etag: str):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # Weak comparison, as If-None-Match calls for
+    tags = [t.strip() for t in if_none_match.split(',')]
+    return etag in (t[2:] if t.startswith('W/') else t for t in tags)
+
+
+def _encode(payload, fmt: str, encoding: str):
+    with span("serialize", format=fmt):
+        try:
+            body = serialization.ENCODERS[fmt](payload)
+        except ValueError as e:
+            raise HTTPException(status_code=406, detail=str(e))
+    if encoding != 'identity' and len(body) >= serialization.MIN_COMPRESS_SIZE:
+        with span("compress", encoding=encoding):
+            return serialization.compress(body, encoding), encoding
+    return body, 'identity'
+
+
+def _negotiate(request: Request):
+    fmt = serialization.negotiate_format(request.headers.get("accept", ""), request.query_params.get("format"))
+    if fmt is None:
+        raise HTTPException(status_code=406, detail=f"Available formats: {', '.join(serialization.MEDIA_TYPES[f] for f in serialization.available_formats())}")
+    return fmt
+
+
+def _build(status_code: int, body: bytes, media_type: str, headers: dict):
+    return Response(content=body, status_code=status_code, headers=headers, media_type=media_type)
+
+
+class NegotiatedRoute(APIRoute):
+    """
+    Route class for the omics router. Endpoints that return a Payload get content
+    negotiation (JSON via orjson, msgpack, Arrow IPC) and gzip/brotli compression;
+    dataset_view endpoints also get ETags, 304s and the encoded-response cache.
+    Other return values pass through unchanged.
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        versioned = getattr(self.endpoint, "dataset_view", False)
+
+        async def negotiated_handler(request: Request) -> Response:
+            # Profiled requests skip the caches and compression so main.py can wrap the body
+            profiling = request.query_params.get("profile") in ("1", "true")
+            encoding = 'identity' if profiling else serialization.negotiate_encoding(request.headers.get("accept-encoding", ""))
+
+            # Only an already-loaded dataset has a version to validate against
+            loader = registry.peek(request.query_params.get("dataset"))
+            version = loader.version if loader is not None else None
+            fmt = etag = None
+            if versioned and request.method == "GET" and version is not None and not profiling:
+                fmt = _negotiate(request)
+                etag = _etag(version, request, fmt, encoding)
+                validators = {"ETag": etag, "Cache-Control": "no-cache", "Vary": VARY}
+                if _etag_matches(request.headers.get("if-none-match"), etag):
+                    return Response(status_code=304, headers=validators)
+                cached = response_cache.get(('response', version, etag))
+                if cached is not None:
+                    return _build(*cached)
+
+            response = await handler(request)
+            # Health checks, metrics and job endpoints answer whatever the client accepts
+            if not isinstance(response, Payload):
+                return response
+            fmt = fmt or _negotiate(request)
+
+            body, used = await run_in_threadpool(_encode, response.payload, fmt, encoding)
+            headers = {**response.extra_headers, "Vary": VARY}
+            if used != 'identity':
+                headers["Content-Encoding"] = used
+            # A reload mid-request means the body may not match the version the tag names
+            if etag is not None and response.status_code == 200 and loader.version == version:
+                headers.update({"ETag": etag, "Cache-Control": "no-cache"})
+                response_cache.put(('response', version, etag), (response.status_code, body, serialization.MEDIA_TYPES[fmt], headers))
+            return _build(response.status_code, body, serialization.MEDIA_TYPES[fmt], headers)
+
+        return negotiated_handler
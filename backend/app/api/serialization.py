@@ -0,0 +1,198 @@
+import gzip
+import json
+import math
+import importlib.util
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+
+def _json_value(value):
+    # NaN/inf are not valid JSON
+    if isinstance(value, float) and not math.isfinite(value):
+        return "null"
+    return json.dumps(value)
+
+
+def iter_ndjson(df: pd.DataFrame, chunk_size: int = 5000):
+    """
+    Yield a DataFrame as newline-delimited JSON, one record per line.
+
+    Columns are pulled out as NumPy arrays one chunk at a time and each line is
+    written with a prebuilt template, so no per-row dicts are created.
+    """
+    columns = list(df.columns)
+    keys = [json.dumps(str(c)) for c in columns]
+    arrays = [df[c].to_numpy() for c in columns]
+    n_rows = len(df)
+
+    for start in range(0, n_rows, chunk_size):
+        stop = min(start + chunk_size, n_rows)
+        # tolist() converts to native Python scalars in one C-level pass per column
+        chunk_cols = [arr[start:stop].tolist() for arr in arrays]
+        lines = []
+        for row in zip(*chunk_cols):
+            fields = ",".join(f"{k}:{_json_value(v)}" for k, v in zip(keys, row))
+            lines.append("{" + fields + "}\n")
+        yield "".join(lines)
+
+
+# Response formats: name -> media type. JSON is always available; the binary
+# formats need their optional package installed.
+MEDIA_TYPES = {
+    'json': 'application/json',
+    'msgpack': 'application/msgpack',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+_FORMAT_MODULES = {'msgpack': 'msgpack', 'arrow': 'pyarrow'}
+_MEDIA_ALIASES = {'application/x-msgpack': 'msgpack'}
+
+# Content encodings in order of preference; 'br' needs the brotli package
+_ENCODING_MODULES = {'br': 'brotli', 'gzip': None}
+
+# Bodies smaller than this aren't worth compressing
+MIN_COMPRESS_SIZE = 1024
+
+
+@lru_cache(maxsize=None)
+def _installed(module: str):
+    return importlib.util.find_spec(module) is not None
+
+
+def available_formats():
+    return [f for f in MEDIA_TYPES if f not in _FORMAT_MODULES or _installed(_FORMAT_MODULES[f])]
+
+
+def available_encodings():
+    return [e for e, module in _ENCODING_MODULES.items() if module is None or _installed(module)]
+
+
+def _plain(obj, nan_to_none: bool = False):
+    # default= hook: tables go out as row records, NumPy values as Python ones
+    if isinstance(obj, pd.DataFrame):
+        if nan_to_none:
+            obj = obj.astype(object).where(obj.notna(), None)
+        return obj.to_dict(orient='records')
+    if isinstance(obj, (pd.Series, pd.Index, np.ndarray)):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
+
+
+def encode_json(payload):
+    try:
+        import orjson
+    except ImportError:
+        # NaN isn't valid JSON; tables map it to null, anything else fails as it did before
+        return json.dumps(payload, default=lambda o: _plain(o, nan_to_none=True), ensure_ascii=False,
+                          allow_nan=False, separators=(",", ":")).encode("utf-8")
+    # orjson writes NumPy arrays natively and NaN as null
+    return orjson.dumps(payload, default=_plain, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+
+def encode_msgpack(payload):
+    import msgpack
+    return msgpack.packb(payload, default=_plain, use_bin_type=True)
+
+
+def _single_table(payload):
+    """(table, other fields) if payload is a DataFrame or a dict holding exactly one."""
+    if isinstance(payload, pd.DataFrame):
+        return payload, {}
+    if isinstance(payload, dict):
+        tables = [k for k, v in payload.items() if isinstance(v, pd.DataFrame)]
+        if len(tables) == 1:
+            return payload[tables[0]], {k: v for k, v in payload.items() if k != tables[0]}
+    return None, None
+
+
+def encode_arrow(payload):
+    """
+    Arrow IPC stream of the response's table. The other fields of the response
+    travel as JSON in the schema metadata under b'omics'.
+    """
+    import pyarrow as pa
+    table, fields = _single_table(payload)
+    if table is None:
+        raise ValueError("This response is not a single table; request JSON or msgpack")
+    arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+    if fields:
+        metadata = dict(arrow_table.schema.metadata or {})
+        metadata[b'omics'] = encode_json(fields)
+        arrow_table = arrow_table.replace_schema_metadata(metadata)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, arrow_table.schema) as writer:
+        writer.write_table(arrow_table)
+    return sink.getvalue().to_pybytes()
+
+
+ENCODERS = {
+    'json': encode_json,
+    'msgpack': encode_msgpack,
+    'arrow': encode_arrow,
+}
+
+
+def compress(body: bytes, encoding: str):
+    if encoding == 'gzip':
+        # mtime=0 keeps the bytes, and so the strong ETag, stable across runs
+        return gzip.compress(body, compresslevel=6, mtime=0)
+    if encoding == 'br':
+        import brotli
+        return brotli.compress(body, quality=5)
+    return body
+
+
+def _parse_qvalues(header: str):
+    """Accept-style header -> [(value, q)], highest q first, header order kept for ties."""
+    items = []
+    for i, part in enumerate(header.split(',')):
+        fields = [f.strip() for f in part.split(';')]
+        if not fields[0]:
+            continue
+        q = 1.0
+        for f in fields[1:]:
+            if f.startswith('q='):
+                try:
+                    q = float(f[2:])
+                except ValueError:
+                    q = 0.0
+        items.append((fields[0].lower(), q, i))
+    items.sort(key=lambda x: (-x[1], x[2]))
+    return [(value, q) for value, q, _ in items]
+
+
+def negotiate_format(accept: str, requested: str = None):
+    """
+    Response format for an Accept header, or requested (a ?format= value) if it
+    names a known format. Returns None when nothing acceptable is available.
+    """
+    available = available_formats()
+    if requested in MEDIA_TYPES:
+        # An explicit ?format= wins over Accept, but never falls back silently
+        return requested if requested in available else None
+    if not accept:
+        return 'json'
+    by_media = {MEDIA_TYPES[f]: f for f in available}
+    by_media.update({alias: f for alias, f in _MEDIA_ALIASES.items() if f in available})
+    for media, q in _parse_qvalues(accept):
+        if q <= 0:
+            continue
+        if media in by_media:
+            return by_media[media]
+        if media in ('*/*', 'application/*'):
+            return 'json'
+    return None
+
+
+def negotiate_encoding(accept_encoding: str):
+    """Best content encoding the client accepts ('br', 'gzip' or 'identity')."""
+    offered = available_encodings()
+    accepted = {value: q for value, q in _parse_qvalues(accept_encoding or '')}
+    best, best_q = 'identity', 0.0
+    for encoding in offered:
+        q = accepted.get(encoding, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
@@ -1,64 +1,469 @@
 import pandas as pd
 import numpy as np
-from scipy import stats
-from sklearn.decomposition import PCA
-from sklearn.manifold import MDS
-from sklearn.preprocessing import StandardScaler
-import httpx
 import json
+import asyncio
+import logging
+from app.services.tracing import span, traced
+from app.services.http_client import external_client, response_cache, SERVICE_URLS
 
+logger = logging.getLogger(__name__)
 
-def perform_differential_expression(counts: pd.DataFrame, groups: dict):
+
+@traced("normalize.log_cpm")
+def compute_log_cpm(counts: pd.DataFrame):
+    """
+    Log2(CPM + 1) normalization of a Genes x Samples count matrix.
+    """
+    values = counts.to_numpy(dtype=np.float64)
+    lib_sizes = values.sum(axis=0)
+    log_cpm = np.log2(values / lib_sizes * 1e6 + 1)
+    return pd.DataFrame(log_cpm, index=counts.index, columns=counts.columns)
+
+def perform_differential_expression(counts: pd.DataFrame, groups: dict, log_cpm: pd.DataFrame = None):
     """
-    Simple DEA using T-test on Log-CPM data.
+    Welch's t-test per gene on Log-CPM data, with BH-adjusted p-values.
     groups: {'group1': [col1, col2, ...], 'group2': [col3, col4, ...]}
+    log_cpm: precomputed compute_log_cpm(counts); computed here if not given.
     """
-    # Log-CPM Normalization
-    cpm = counts.div(counts.sum(axis=0), axis=1) * 1e6
-    log_cpm = np.log2(cpm + 1)
-    
-    group1_cols = groups['group1']
-    group2_cols = groups['group2']
-    
-    results = []
-    
-    # Simple T-test per gene
-    # In production, vectorization or libraries like statsmodels would be better for speed,
-    # but for this dataset 50k genes might be slow if looped.
-    # Let's use scipy's ttest_ind which handles axis.
-    
-    g1_data = log_cpm[group1_cols]
-    g2_data = log_cpm[group2_cols]
-    
-    t_stat, p_val = stats.ttest_ind(g1_data, g2_data, axis=1, equal_var=False)
-    
-    # Calculate Log2 Fold Change
-    # LogFC = Mean(Group1) - Mean(Group2) (if we consider Group1 vs Group2)
-    # Usually Treatment vs Control, so Mean(Tx) - Mean(Ctrl)
-    # Here we can just return Mean1 - Mean2
-    
+    if log_cpm is None:
+        log_cpm = compute_log_cpm(counts)
+
+    # scipy.stats and sklearn are imported where used; they dominate import time
+    from scipy import stats
+
+    g1_data = log_cpm[groups['group1']]
+    g2_data = log_cpm[groups['group2']]
+
+    # One vectorized test over every gene
+    with span("dea.test", genes=len(log_cpm)):
+        t_stat, p_val = stats.ttest_ind(g1_data, g2_data, axis=1, equal_var=False)
+
+    # Log2 fold change of group1 over group2
     log_fc = g1_data.mean(axis=1) - g2_data.mean(axis=1)
     
     results_df = pd.DataFrame({
         'gene': counts.index,
         'logFC': log_fc,
         'p_value': p_val,
-        'adj_p_value': p_val # Placeholder for BH correction if needed later
     }).set_index('gene')
     
-    results_df['adj_p_value'] = results_df['p_value'] # TODO: Implement BH
+    results_df = results_df.dropna()
+    with span("dea.adjust"):
+        results_df['adj_p_value'] = adjust_pvalues_bh(results_df['p_value'].to_numpy())
     
+    return results_df
+
+def _trigamma_inverse(y: np.ndarray):
+    """
+    Solve trigamma(x) = y for x by Newton's method (as limma's trigammaInverse).
+    """
+    from scipy.special import polygamma
+    y = np.atleast_1d(np.asarray(y, dtype=float))
+    x = np.empty_like(y)
+    big, small = y > 1e7, y < 1e-6
+    mid = ~(big | small)
+    x[big] = 1 / np.sqrt(y[big])
+    x[small] = 1 / y[small]
+    xm = 0.5 + 1 / y[mid]
+    for _ in range(50):
+        tri = polygamma(1, xm)
+        dif = tri * (1 - tri / y[mid]) / polygamma(2, xm)
+        xm = xm + dif
+        if np.all(-dif / xm < 1e-8):
+            break
+    x[mid] = xm
+    return x
+
+def _fit_f_dist(s2: np.ndarray, df: float):
+    """
+    Moment estimates of the prior (d0, s0^2) for gene-wise variances, following
+    limma's fitFDist. Returns d0 = inf when there is no excess variability.
+    """
+    from scipy.special import digamma, polygamma
+    ok = np.isfinite(s2) & (s2 > 0)
+    if ok.sum() < 2:
+        return np.inf, float(np.nanmean(s2)) if s2.size else 0.0
+    z = np.log(s2[ok])
+    e = z - digamma(df / 2) + np.log(df / 2)
+    e_mean = e.mean()
+    e_var = e.var(ddof=1) - polygamma(1, df / 2)
+    if e_var > 0:
+        d0 = 2 * _trigamma_inverse(e_var)[0]
+        s0_sq = np.exp(e_mean + digamma(d0 / 2) - np.log(d0 / 2))
+    else:
+        d0 = np.inf
+        # The pooled variance, its MLE here (limma before 2017 used the larger exp(e_mean))
+        s0_sq = float(s2[ok].mean())
+    return d0, s0_sq
+
+def _moderated_t(log_fc: np.ndarray, s2: np.ndarray, resid_df: float, n1: int, n2: int):
+    """
+    Empirical-Bayes shrinkage of gene-wise variances towards a common prior, and the
+    resulting moderated t-statistics and p-values. Returns (t, p, d0, s0_sq).
+    """
+    from scipy import stats
+    d0, s0_sq = _fit_f_dist(s2, resid_df)
+    if np.isinf(d0):
+        s2_post = np.full_like(s2, s0_sq)
+        df_total = np.inf
+    else:
+        s2_post = (d0 * s0_sq + resid_df * s2) / (d0 + resid_df)
+        # limma caps the total df at the pooled residual df across genes
+        df_total = min(d0 + resid_df, resid_df * len(s2))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t_mod = log_fc / np.sqrt(s2_post * (1 / n1 + 1 / n2))
+    p_val = 2 * (stats.norm.sf(np.abs(t_mod)) if np.isinf(df_total) else stats.t.sf(np.abs(t_mod), df_total))
+    return t_mod, p_val, d0, s0_sq
+
+def perform_moderated_dea(counts: pd.DataFrame, groups: dict, log_cpm: pd.DataFrame = None, min_count: float = 10):
+    """
+    Two-group DEA with empirical-Bayes moderated t-statistics (limma-style) on Log-CPM data.
+    groups: {'group1': [col1, col2, ...], 'group2': [col3, col4, ...]}
+    min_count: genes are kept if their CPM reaches the equivalent of min_count reads
+               at the median library size in at least as many samples as the smaller group.
+
+    Everything runs as whole-matrix NumPy operations; BH is applied over the genes
+    that pass the filter.
+    """
+    g1_idx = counts.columns.get_indexer(groups['group1'])
+    g2_idx = counts.columns.get_indexer(groups['group2'])
+    n1, n2 = len(g1_idx), len(g2_idx)
+    resid_df = n1 + n2 - 2
+    if resid_df < 1:
+        raise ValueError("Moderated DEA needs at least 3 samples across both groups")
+    sample_idx = np.concatenate([g1_idx, g2_idx])
+
+    with span("dea.normalize"):
+        raw = counts.to_numpy()
+        lib_sizes = raw.sum(axis=0, dtype=np.float64)[sample_idx]
+        sub = raw[:, sample_idx]
+
+        # Low-count filter (edgeR filterByExpr-style CPM cutoff)
+        cpm_cutoff = min_count / np.median(lib_sizes) * 1e6
+        keep = ((sub / lib_sizes * 1e6) >= cpm_cutoff).sum(axis=1) >= min(n1, n2)
+
+        if log_cpm is not None:
+            values = log_cpm.to_numpy()[keep][:, sample_idx]
+        else:
+            values = np.log2(sub[keep] / lib_sizes * 1e6 + 1)
+    x1, x2 = values[:, :n1], values[:, n1:]
+
+    with span("dea.test", genes=int(keep.sum())):
+        mean1, mean2 = x1.mean(axis=1), x2.mean(axis=1)
+        ss = ((x1 - mean1[:, None]) ** 2).sum(axis=1) + ((x2 - mean2[:, None]) ** 2).sum(axis=1)
+        s2 = ss / resid_df
+        log_fc = mean1 - mean2
+
+        t_mod, p_val, d0, s0_sq = _moderated_t(log_fc, s2, resid_df, n1, n2)
+
+    results_df = pd.DataFrame({
+        'logFC': log_fc,
+        'AveExpr': values.mean(axis=1),
+        't': t_mod,
+        'p_value': p_val,
+        'adj_p_value': adjust_pvalues_bh(p_val),
+    }, index=pd.Index(counts.index[keep], name='gene'))
+    results_df.attrs.update({'method': 'moderated', 'prior_df': float(d0), 'prior_var': float(s0_sq), 'genes_tested': int(keep.sum())})
+
     return results_df.dropna()
 
+def _pair_cutoffs(lib_sizes: np.ndarray, idx: list, min_count: float, pairs=None):
+    """
+    The moderated DEA's CPM cutoff for each pair of groups (by position): min_count
+    reads at the median library size of the two groups' samples, as perform_moderated_dea
+    uses for that contrast. lib_sizes: per-sample totals; idx: column positions of each group.
+    """
+    if pairs is None:
+        pairs = [(a, b) for a in range(len(idx)) for b in range(a + 1, len(idx))]
+    return {(a, b): min_count / np.median(lib_sizes[np.concatenate([idx[a], idx[b]])]) * 1e6 for a, b in pairs}
+
+def _expressed_counts(raw: np.ndarray, lib_sizes: np.ndarray, idx: list, cutoffs: dict):
+    # Per pair of groups: how many of their samples reach the pair's CPM cutoff, per gene
+    cpm = {}
+    expressed = {}
+    for (a, b), cutoff in cutoffs.items():
+        for j in (a, b):
+            if j not in cpm:
+                cpm[j] = raw[:, idx[j]] / lib_sizes[idx[j]] * 1e6
+        expressed[(a, b)] = (cpm[a] >= cutoff).sum(axis=1) + (cpm[b] >= cutoff).sum(axis=1)
+    return expressed
+
+def _group_block_stats(raw: np.ndarray, values: np.ndarray, lib_sizes: np.ndarray, idx: list, cutoffs: dict):
+    """
+    GroupStatistics arrays for a block of genes: (center, sums, sumsq, expressed).
+    raw/values: genes x samples counts and log-CPM; lib_sizes: per-sample totals over
+    all genes; idx: column positions of each group; cutoffs: _pair_cutoffs().
+    """
+    all_idx = np.concatenate(idx)
+    center = values[:, all_idx].mean(axis=1)
+    n_genes, n_groups = raw.shape[0], len(idx)
+    sums = np.empty((n_genes, n_groups))
+    sumsq = np.empty((n_genes, n_groups))
+    for j, cols in enumerate(idx):
+        x = values[:, cols] - center[:, None]
+        sums[:, j] = x.sum(axis=1)
+        sumsq[:, j] = (x ** 2).sum(axis=1)
+    return center, sums, sumsq, _expressed_counts(raw, lib_sizes, idx, cutoffs)
+
+class GroupStatistics:
+    """
+    Per-group sufficient statistics of the Log-CPM matrix: sample count, sum and sum
+    of squares for every gene, plus for every pair of groups how many of their samples
+    pass that pair's low-count CPM cutoff (each contrast filters on its own samples'
+    library sizes, as perform_moderated_dea does). Computed in one pass; every pairwise
+    contrast is then derived from these arrays without touching the expression matrix again.
+
+    Values are centered on each gene's overall mean before accumulating, which keeps
+    the sum-of-squares variance formula numerically stable.
+    """
+
+    @traced("dea.group_stats")
+    def __init__(self, counts: pd.DataFrame, sample_groups: dict, log_cpm: pd.DataFrame = None, min_count: float = 10):
+        self.genes = counts.index
+        self.groups = list(sample_groups)
+        self.min_count = min_count
+
+        idx = [counts.columns.get_indexer(sample_groups[g]) for g in self.groups]
+        all_idx = np.concatenate(idx)
+        raw = counts.to_numpy()
+        lib_sizes = raw.sum(axis=0, dtype=np.float64)
+        values = log_cpm.to_numpy() if log_cpm is not None else np.log2(raw / lib_sizes * 1e6 + 1)
+
+        cutoffs = _pair_cutoffs(lib_sizes, idx, min_count)
+        self.n = np.array([len(i) for i in idx])
+        self.center, self.sums, self.sumsq, self.expressed = _group_block_stats(raw, values, lib_sizes, idx, cutoffs)
+        # Kept for add_samples()
+        self.sample_groups = {g: list(sample_groups[g]) for g in self.groups}
+        self.lib_sizes = dict(zip(counts.columns[all_idx], lib_sizes[all_idx]))
+        self.cpm_cutoffs = cutoffs
+
+    @classmethod
+    def from_blocks(cls, genes, sample_groups: dict, min_count: float, blocks):
+        """
+        Assemble from per-row-block results of _group_block_stats (e.g. a count file
+        read in chunks); the statistics are per gene, so blocks just stack.
+        """
+        self = cls.__new__(cls)
+        self.genes = pd.Index(genes)
+        self.groups = list(sample_groups)
+        self.min_count = min_count
+        self.n = np.array([len(sample_groups[g]) for g in self.groups])
+        n_groups = len(self.groups)
+        parts = list(zip(*blocks)) or [[np.empty(0)], [np.empty((0, n_groups))], [np.empty((0, n_groups))], [{}]]
+        self.center, self.sums, self.sumsq = (np.concatenate(p) for p in parts[:3])
+        pairs = [(a, b) for a in range(n_groups) for b in range(a + 1, n_groups)]
+        self.expressed = {pair: np.concatenate([e.get(pair, np.empty(0, dtype=np.int64)) for e in parts[3]]) for pair in pairs}
+        # Library sizes aren't known per block, so these can't be extended by add_samples()
+        self.sample_groups = self.lib_sizes = self.cpm_cutoffs = None
+        return self
+
+    @traced("dea.group_stats_update")
+    def add_samples(self, counts: pd.DataFrame, sample_groups: dict, log_cpm: pd.DataFrame = None):
+        """
+        GroupStatistics for sample_groups, which must hold every sample grouped here (in
+        the same groups) plus new ones, possibly in new groups. Only the new samples'
+        columns of counts/log_cpm are read for the sums: they are kept centered on the
+        original gene means, which any fixed center allows. The expressed counts of a pair
+        of groups are recomputed over its samples only if one of the two gained samples,
+        which moves the pair's cutoff.
+        """
+        if self.sample_groups is None:
+            raise ValueError("These statistics were assembled from blocks and can't be extended")
+        added = {}
+        for g, samples in sample_groups.items():
+            old = set(self.sample_groups.get(g, ()))
+            if not old.issubset(samples):
+                raise ValueError(f"Group '{g}' lost samples; recompute the statistics instead")
+            added[g] = [s for s in samples if s not in old]
+        missing = [g for g in self.groups if g not in sample_groups]
+        if missing:
+            raise ValueError(f"Groups missing: {', '.join(map(str, missing))}")
+
+        new = GroupStatistics.__new__(GroupStatistics)
+        new.genes, new.min_count, new.center = self.genes, self.min_count, self.center
+        new.groups = self.groups + [g for g in sample_groups if g not in self.groups]
+        pad = len(new.groups) - len(self.groups)
+        new.n = np.concatenate([self.n, np.zeros(pad, dtype=self.n.dtype)])
+        new.sums, new.sumsq = (np.pad(a, ((0, 0), (0, pad))) for a in (self.sums, self.sumsq))
+        new.sample_groups = {g: list(sample_groups[g]) for g in new.groups}
+        new.lib_sizes = dict(self.lib_sizes)
+
+        samples = [s for g in new.groups for s in added[g]]
+        cols = counts.columns.get_indexer(samples)
+        raw = counts.to_numpy()[:, cols]
+        lib_sizes = raw.sum(axis=0, dtype=np.float64)
+        values = log_cpm.to_numpy()[:, log_cpm.columns.get_indexer(samples)] if log_cpm is not None else np.log2(raw / lib_sizes * 1e6 + 1)
+        new.lib_sizes.update(zip(samples, lib_sizes))
+
+        start = 0
+        for j, g in enumerate(new.groups):
+            block = slice(start, start + len(added[g]))
+            start = block.stop
+            x = values[:, block] - new.center[:, None]
+            new.n[j] += x.shape[1]
+            new.sums[:, j] += x.sum(axis=1)
+            new.sumsq[:, j] += (x ** 2).sum(axis=1)
+
+        # Old groups keep their positions, so unchanged pairs keep their counts
+        changed = {j for j, g in enumerate(new.groups) if added[g]}
+        n_groups = len(new.groups)
+        stale = [(a, b) for a in range(n_groups) for b in range(a + 1, n_groups) if a in changed or b in changed]
+        new.expressed = {pair: e for pair, e in self.expressed.items() if pair not in stale}
+        new.cpm_cutoffs = {pair: c for pair, c in self.cpm_cutoffs.items() if pair not in stale}
+        if stale:
+            all_idx = counts.columns.get_indexer([s for g in new.groups for s in new.sample_groups[g]])
+            bounds = np.cumsum([0] + [len(new.sample_groups[g]) for g in new.groups])
+            idx = [np.arange(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:])]
+            libs = np.array([new.lib_sizes[s] for g in new.groups for s in new.sample_groups[g]])
+            cutoffs = _pair_cutoffs(libs, idx, new.min_count, stale)
+            new.expressed.update(_expressed_counts(counts.to_numpy()[:, all_idx], libs, idx, cutoffs))
+            new.cpm_cutoffs.update(cutoffs)
+        return new
+
+    def _col(self, group):
+        return self.groups.index(group)
+
+    def mean(self, group):
+        j = self._col(group)
+        return self.sums[:, j] / self.n[j] + self.center
+
+    def sum_sq_dev(self, group):
+        """Sum of squared deviations from the group mean, per gene."""
+        j = self._col(group)
+        ss = self.sumsq[:, j] - self.sums[:, j] ** 2 / self.n[j]
+        # A group that is constant (e.g. all zeros) away from the center leaves rounding
+        # noise here, not a variance; it must stay 0 so the test is undefined, as in scipy
+        return np.where(ss > self.sumsq[:, j] * 1e-12, ss, 0.0)
+
+    def _contrast_columns(self, group1, group2, method: str):
+        """
+        contrast()'s columns over every gene: (tested-gene mask, {column: array over the
+        tested genes}, attrs). Rows with a NaN are still in; contrast() drops them.
+        """
+        n1, n2 = self.n[self._col(group1)], self.n[self._col(group2)]
+        mean1, mean2 = self.mean(group1), self.mean(group2)
+        ss1, ss2 = self.sum_sq_dev(group1), self.sum_sq_dev(group2)
+        log_fc = mean1 - mean2
+
+        if method == 'welch':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                se1, se2 = ss1 / (n1 - 1) / n1, ss2 / (n2 - 1) / n2
+                t_stat = log_fc / np.sqrt(se1 + se2)
+                dof = (se1 + se2) ** 2 / (se1 ** 2 / (n1 - 1) + se2 ** 2 / (n2 - 1))
+            from scipy import stats
+            p_val = 2 * stats.t.sf(np.abs(t_stat), dof)
+            # BH leaves NaN p-values out of the tests, as if the rows were already dropped
+            keep = np.ones(len(self.genes), dtype=bool)
+            return keep, {'logFC': log_fc, 'p_value': p_val, 'adj_p_value': adjust_pvalues_bh(p_val)}, {}
+
+        if method == 'moderated':
+            resid_df = n1 + n2 - 2
+            if resid_df < 1:
+                raise ValueError("Moderated DEA needs at least 3 samples across both groups")
+            keep = self.expressed[tuple(sorted((self._col(group1), self._col(group2))))] >= min(n1, n2)
+            s2 = (ss1[keep] + ss2[keep]) / resid_df
+            t_mod, p_val, d0, s0_sq = _moderated_t(log_fc[keep], s2, resid_df, n1, n2)
+            columns = {
+                'logFC': log_fc[keep],
+                'AveExpr': (mean1[keep] * n1 + mean2[keep] * n2) / (n1 + n2),
+                't': t_mod,
+                'p_value': p_val,
+                'adj_p_value': adjust_pvalues_bh(p_val),
+            }
+            return keep, columns, {'method': 'moderated', 'prior_df': float(d0), 'prior_var': float(s0_sq), 'genes_tested': int(keep.sum())}
+
+        raise ValueError(f"Unknown DEA method '{method}'")
+
+    @traced("dea.test")
+    def contrast(self, group1, group2, method: str = 'welch'):
+        """DEA for group1 vs group2 from the stored statistics; same output as DEA_METHODS[method]."""
+        keep, columns, attrs = self._contrast_columns(group1, group2, method)
+        results_df = pd.DataFrame(columns, index=pd.Index(self.genes[keep], name='gene'))
+        results_df.attrs.update(attrs)
+        return results_df.dropna()
+
+    def iter_contrast(self, group1, group2, method: str = 'welch', block_sizes=None):
+        """
+        contrast() as consecutive row blocks, e.g. one per chunk the statistics were read
+        in (block_sizes genes each; one block if None). Concatenated, the blocks are
+        contrast(); the BH adjustment is still over every gene.
+        """
+        keep, columns, attrs = self._contrast_columns(group1, group2, method)
+        bounds = np.cumsum([0] + list(block_sizes if block_sizes is not None else [len(self.genes)]))
+        # Positions of each block's genes among the tested ones
+        tested = np.concatenate([[0], np.cumsum(keep)])
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            lo, hi = tested[start], tested[stop]
+            block = pd.DataFrame({k: v[lo:hi] for k, v in columns.items()},
+                                 index=pd.Index(self.genes[start:stop][keep[start:stop]], name='gene'))
+            block.attrs.update(attrs)
+            yield block.dropna()
+
+def perform_multi_contrast_dea(counts: pd.DataFrame, sample_groups: dict, contrasts=None, method: str = 'welch', log_cpm: pd.DataFrame = None, min_count: float = 10, group_stats: GroupStatistics = None):
+    """
+    DEA for several contrasts in one pass over the expression matrix.
+    sample_groups: {group_name: [col1, col2, ...], ...}
+    contrasts: list of (group1, group2) pairs; all pairwise contrasts if None.
+    group_stats: reuse previously computed GroupStatistics for these groups.
+    Returns {(group1, group2): results DataFrame}.
+    """
+    if group_stats is None:
+        group_stats = GroupStatistics(counts, sample_groups, log_cpm=log_cpm, min_count=min_count)
+    if contrasts is None:
+        names = list(sample_groups)
+        contrasts = [(a, b) for i, a in enumerate(names) for b in names[i + 1:]]
+    return {(a, b): group_stats.contrast(a, b, method=method) for a, b in contrasts}
+
+def filter_dea_results(results: pd.DataFrame, max_p=None, max_q=None, min_abs_logfc=None, sort_by=None, descending=False):
+    """
+    Threshold and sort a DEA result table (index=gene) with NumPy masks.
+    sort_by: any result column, 'gene', or 'abs_logFC'.
+    """
+    mask = np.ones(len(results), dtype=bool)
+    if max_p is not None:
+        mask &= results['p_value'].to_numpy() <= max_p
+    if max_q is not None:
+        mask &= results['adj_p_value'].to_numpy() <= max_q
+    if min_abs_logfc is not None:
+        mask &= np.abs(results['logFC'].to_numpy()) >= min_abs_logfc
+    filtered = results[mask] if not mask.all() else results
+
+    if sort_by is None:
+        return filtered
+    if sort_by == 'gene':
+        key = filtered.index.to_numpy().astype(str)
+    elif sort_by == 'abs_logFC':
+        key = np.abs(filtered['logFC'].to_numpy())
+    elif sort_by in filtered.columns:
+        key = filtered[sort_by].to_numpy()
+    else:
+        raise ValueError(f"Cannot sort by '{sort_by}'")
+    order = np.argsort(key, kind='stable')
+    if descending:
+        order = order[::-1]
+    return filtered.iloc[order]
+
+# Selectable DEA engines, by the name used in the API's method= parameter
+DEA_METHODS = {
+    'welch': perform_differential_expression,
+    'moderated': perform_moderated_dea,
+}
+
+@traced("diversity.alpha")
 def calculate_diversity_indices(abundance_df: pd.DataFrame):
     """
     Calculate Shannon and Simpson diversity indices.
     Expects filtered abundance matrix (rows=taxa, cols=samples).
+    These are on the raw proportions, so they still depend on read depth; see
+    app.services.rarefaction for indices at a common depth.
     """
+    from scipy.special import xlogy
     # Ensure relative abundance
     rel_abundance = abundance_df.div(abundance_df.sum(axis=0), axis=1)
     
-    shannon = - (rel_abundance * np.log(rel_abundance + 1e-9)).sum(axis=0)
+    # 0 * log(0) is taken as 0
+    shannon = 0.0 - xlogy(rel_abundance, rel_abundance).sum(axis=0)
     simpson = 1 - (rel_abundance ** 2).sum(axis=0)
     
     return pd.DataFrame({'shannon': shannon, 'simpson': simpson})
@@ -68,6 +473,8 @@ def perform_pca(data: pd.DataFrame, n_components=2):
     Perform PCA on data (features x samples).
     Needs transpose for sklearn.
     """
+    from sklearn.decomposition import PCA
+    from sklearn.preprocessing import StandardScaler
     # Transpose to (samples x features)
     X = data.T
     scaler = StandardScaler()
@@ -78,83 +485,303 @@ def perform_pca(data: pd.DataFrame, n_components=2):
     
     return pd.DataFrame(coords, index=X.index, columns=[f'PC{i+1}' for i in range(n_components)]), pca.explained_variance_ratio_
 
-def perform_pcoa(data_matrix):
-    pass
-    
-def calculate_beta_diversity(abundance_df: pd.DataFrame, n_components=2):
-    """
-    Calculate Beta Diversity using Bray-Curtis distance and PCoA (MDS).
-    abundance_df: Taxa x Samples
-    """
-    # 1. Normalize to relative abundance
-    # Check if we need to pivot first
-    if 'Sample' in abundance_df.columns:
-        # Pivot: Index=Sample, Columns=Taxa
-        abundance_df = abundance_df.pivot_table(index='Sample', columns='Genus', values='Abundance', aggfunc='sum').fillna(0)
-        # Transpose to Taxa x Samples for consistency with downstream logic if needed, 
-        # BUT this function expects Taxa x Samples? 
-        # Let's look at usage. 
-        # In endpoints/omics.py: 
-        # pivot_df = data_loader.metagenomics.pivot_table(...) 
-        # beta_df = analysis.calculate_beta_diversity(pivot_df)
-        # So it is ALREADY pivoted in endpoint as Samples x Taxa (Sample is index).
-        
-        # Wait, pivot_df in endpoint is: pivot_table(index='Sample', ...) -> Rows=Sample.
-        # analysis.calculate_diversity_indices says: "Expects filtered abundance matrix (rows=taxa, cols=samples)"
-        # But calculate_beta_diversity docstring says: "abundance_df: Taxa x Samples".
-        # Let's verify what endpoint passes.
-        pass
-
-    # If input is Samples x Taxa (Index is Sample), transpose to Taxa x Samples for consistency with 'div' logic below
-    # which does div(sum(axis=0), axis=1) -> dividing columns totals.
-    # If input is Samples x Taxa, sum(axis=0) gives sums per Taxa? No.
-    # We want relative abundance per SAMPLE.
-    
-    # If rows=Samples, cols=Taxa: 
-    # rel = df.div(df.sum(axis=1), axis=0)
-    
-    # If rows=Taxa, cols=Samples:
-    # rel = df.div(df.sum(axis=0), axis=1)
-    
-    # Let's assume input is Taxa x Samples (standard OTU table).
-    # IF the endpoint passes Samples x Taxa, we must Transpose first.
-    # Endpoint: pivot_df = data_loader.metagenomics.pivot_table(index='Sample', columns='Genus', values='Abundance', aggfunc='sum').fillna(0)
-    # This produces Samples x Taxa.
-    # So we should transpose it at start.
-    
-    abundance_df = abundance_df.T # Now Taxa x Samples
-    
-    rel_abundance = abundance_df.div(abundance_df.sum(axis=0), axis=1)
-    
-    # 2. Transpose to Samples x Taxa for distance calculation
-    X = rel_abundance.T
+@traced("diversity.pcoa")
+def perform_pcoa(distance_matrix, n_components=2):
+    """
+    Classical (Torgerson) PCoA of a Samples x Samples distance matrix.
+    Double-centers -0.5 * D^2 and takes the top eigenpairs; returns
+    (coords array, explained-variance ratio per axis). Ratios are relative to the
+    trace of the centered matrix, i.e. the sum of all eigenvalues.
+    """
+    from scipy.linalg import eigh
+    D = np.asarray(distance_matrix, dtype=np.float64)
+    n = D.shape[0]
+    A = -0.5 * D ** 2
+    # Double-centering without forming the centering matrix
+    B = A - A.mean(axis=0, keepdims=True) - A.mean(axis=1, keepdims=True) + A.mean()
+    k = min(n_components, n)
+    eigvals, eigvecs = eigh(B, subset_by_index=[n - k, n - 1])
+    order = np.argsort(eigvals)[::-1]
+    eigvals, eigvecs = eigvals[order], eigvecs[:, order]
+    # Axes with non-positive eigenvalues carry no Euclidean variance
+    coords = eigvecs * np.sqrt(np.clip(eigvals, 0, None))
+    total = np.trace(B)
+    explained = eigvals / total if total > 0 else np.zeros_like(eigvals)
+    return coords, explained
+
+def _braycurtis(X: np.ndarray, chunk_elements: int = 1 << 24):
+    # sum|x_i - x_j| / sum(x_i + x_j), a block of rows at a time to bound the 3-D temporary
+    n, p = X.shape
+    sums = X.sum(axis=1)
+    D = np.empty((n, n))
+    rows = max(1, chunk_elements // max(n * p, 1))
+    for start in range(0, n, rows):
+        stop = min(start + rows, n)
+        diff = np.abs(X[start:stop, None, :] - X[None, :, :]).sum(axis=2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            D[start:stop] = diff / (sums[start:stop, None] + sums[None, :])
+    return np.nan_to_num(D)
+
+def _jaccard(X: np.ndarray):
+    # Presence/absence Jaccard from one matrix product
+    P = (X > 0).astype(np.float64)
+    inter = P @ P.T
+    sizes = P.sum(axis=1)
+    union = sizes[:, None] + sizes[None, :] - inter
+    with np.errstate(invalid='ignore', divide='ignore'):
+        D = 1 - inter / union
+    return np.nan_to_num(D)
+
+def _aitchison(X: np.ndarray, pseudocount: float = 1.0):
+    # Euclidean distance between centred log-ratio transforms, via the Gram matrix
+    L = np.log(X + pseudocount)
+    clr = L - L.mean(axis=1, keepdims=True)
+    sq = (clr ** 2).sum(axis=1)
+    D2 = sq[:, None] + sq[None, :] - 2 * clr @ clr.T
+    return np.sqrt(np.clip(D2, 0, None))
+
+# Beta-diversity metrics: name -> (function on a Samples x Taxa array, input it expects)
+BETA_METRICS = {
+    'braycurtis': (_braycurtis, 'relative'),
+    'jaccard': (_jaccard, 'counts'),
+    'aitchison': (_aitchison, 'counts'),
+}
+
+@traced("diversity.distance")
+def calculate_distance_matrix(abundance_df: pd.DataFrame, metric: str = 'braycurtis'):
+    """
+    Samples x Samples beta-diversity distances.
+    abundance_df: Taxa x Samples abundance (counts); Bray-Curtis is computed on
+    relative abundances, Jaccard on presence/absence and Aitchison on clr(counts + 1).
+    """
+    if metric not in BETA_METRICS:
+        raise ValueError(f"Unknown metric '{metric}'. Available: {', '.join(BETA_METRICS)}")
+    func, kind = BETA_METRICS[metric]
+    abundance_df = _as_taxa_matrix(abundance_df)
+    X = abundance_df.to_numpy(dtype=np.float64).T # Samples x Taxa
+    if kind == 'relative':
+        totals = X.sum(axis=1, keepdims=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            X = np.nan_to_num(X / totals)
+    D = func(X)
+    np.fill_diagonal(D, 0.0)
+    return pd.DataFrame(D, index=abundance_df.columns, columns=abundance_df.columns)
     
-    # 3. Calculate Bray-Curtis dissimilarity
-    # Since we have many taxa, let's use sklearn's pairwise_distances or scipy
-    from sklearn.metrics import pairwise_distances
-    bc_dist = pairwise_distances(X, metric='braycurtis')
+def _as_taxa_matrix(metagenomics: pd.DataFrame, rank: str = 'Genus'):
+    """
+    Accept either a long-format metagenomics table (Sample, Abundance, <rank>...)
+    or an already pivoted Taxa x Samples matrix, e.g. TaxonomyMatrix.abundance(rank).
+    """
+    if 'Sample' in metagenomics.columns and rank in metagenomics.columns:
+        with span("pivot", rank=rank):
+            return metagenomics.pivot_table(index=rank, columns='Sample', values='Abundance', aggfunc='sum', observed=True).fillna(0)
+    return metagenomics
+
+def calculate_beta_diversity(abundance_df: pd.DataFrame, n_components=2, metric: str = 'braycurtis', distances: pd.DataFrame = None):
+    """
+    Calculate Beta Diversity: a distance matrix (Bray-Curtis by default) and classical PCoA.
+    abundance_df: Taxa x Samples (e.g. TaxonomyMatrix.abundance(rank))
+    distances: precomputed calculate_distance_matrix(...) to reuse; computed here if not given.
+    The explained-variance ratio per axis is in result.attrs['explained_variance'].
+    """
+    if distances is None:
+        distances = calculate_distance_matrix(abundance_df, metric=metric)
     
-    # 4. PCoA using MDS on the distance matrix
-    mds = MDS(n_components=n_components, dissimilarity='precomputed', random_state=42)
-    coords = mds.fit_transform(bc_dist)
+    coords, explained = perform_pcoa(distances.to_numpy(), n_components=n_components)
     
-    return pd.DataFrame(coords, index=X.index, columns=[f'PC{i+1}' for i in range(n_components)])
+    result = pd.DataFrame(coords, index=distances.index, columns=[f'PC{i+1}' for i in range(coords.shape[1])])
+    result.attrs['explained_variance'] = explained.tolist()
+    return result
+
+
+
+def _permutation_chunks(permutations: int, seed, chunk_size: int):
+    """
+    Split the permutations into chunks with their own child seeds, so results are
+    identical whether chunks run in this process or in a pool.
+    """
+    n_chunks = max(1, -(-permutations // chunk_size))
+    seeds = np.random.SeedSequence(seed).spawn(n_chunks)
+    sizes = [min(chunk_size, permutations - i * chunk_size) for i in range(n_chunks)]
+    return list(zip(seeds, sizes))
+
+def _permanova_f_batch(d2: np.ndarray, codes: np.ndarray, group_sizes: np.ndarray, ss_total: float, seed, size: int):
+    """
+    Pseudo-F for a batch of label permutations as one tensor computation:
+    SS_within = sum_g 0.5 / n_g * 1_g' D^2 1_g, with 1_g one-hot columns per permutation.
+    """
+    rng = np.random.default_rng(seed)
+    n, g = len(codes), len(group_sizes)
+    perm_codes = rng.permuted(np.broadcast_to(codes, (size, n)), axis=1)
+    onehot = np.zeros((size, n, g))
+    np.put_along_axis(onehot, perm_codes[:, :, None], 1.0, axis=2)
+    within = np.einsum('bng,bng->bg', d2 @ onehot, onehot) * 0.5 / group_sizes
+    ss_within = within.sum(axis=1)
+    return ((ss_total - ss_within) / (g - 1)) / (ss_within / (n - g))
+
+def _run_permutations(func, args, n_samples: int, permutations: int, seed, n_jobs=None, chunk_size: int = 500):
+    chunks = _permutation_chunks(permutations, seed, chunk_size)
+    # Only worth the process start-up cost for large jobs
+    work = permutations * n_samples * n_samples
+    if n_jobs == 1 or len(chunks) == 1 or work < 2e9:
+        return np.concatenate([func(*args, seed, size) for seed, size in chunks])
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = [pool.submit(func, *args, seed, size) for seed, size in chunks]
+        return np.concatenate([f.result() for f in futures])
+
+def _group_codes(distances: pd.DataFrame, grouping: pd.Series):
+    grouping = grouping.reindex(distances.index)
+    keep = grouping.notna().to_numpy()
+    labels = pd.Categorical(grouping[keep])
+    codes = np.asarray(labels.codes)
+    group_sizes = np.bincount(codes, minlength=len(labels.categories)).astype(np.float64)
+    D = distances.to_numpy()[np.ix_(keep, keep)]
+    return D, codes, group_sizes, labels.categories
+
+def perform_permanova(distances: pd.DataFrame, grouping: pd.Series, permutations: int = 999, seed=42, n_jobs=None):
+    """
+    PERMANOVA (Anderson 2001) on a Samples x Samples distance matrix.
+    grouping: Series of group labels indexed by sample; samples without a label are dropped.
+    Permutations are scored in batches as matrix operations, with a process pool for
+    large jobs; the same seed always gives the same p-value.
+    """
+    D, codes, group_sizes, groups = _group_codes(distances, grouping)
+    n, g = len(codes), len(groups)
+    if g < 2 or n <= g:
+        raise ValueError("PERMANOVA needs at least two groups and more samples than groups")
+    d2 = D ** 2
+    ss_total = d2.sum() / (2 * n)
+
+    onehot = np.eye(g)[codes]
+    ss_within = (np.einsum('ng,ng->g', d2 @ onehot, onehot) * 0.5 / group_sizes).sum()
+    f_obs = ((ss_total - ss_within) / (g - 1)) / (ss_within / (n - g))
+
+    with span("permanova.permutations", permutations=permutations):
+        f_perm = _run_permutations(_permanova_f_batch, (d2, codes, group_sizes, ss_total), n, permutations, seed, n_jobs=n_jobs)
+    p_value = (np.sum(f_perm >= f_obs - 1e-12) + 1) / (permutations + 1)
+
+    return {
+        'method': 'PERMANOVA',
+        'test_statistic_name': 'pseudo-F',
+        'test_statistic': float(f_obs),
+        'p_value': float(p_value),
+        'r_squared': float(1 - ss_within / ss_total),
+        'permutations': permutations,
+        'n_samples': n,
+        'n_groups': g,
+        'groups': {str(k): int(v) for k, v in zip(groups, group_sizes)},
+    }
+
+def _anova_f_batch(fitted: np.ndarray, residuals: np.ndarray, codes: np.ndarray, group_sizes: np.ndarray, seed, size: int):
+    """One-way ANOVA F for a batch of residual permutations (y* = fitted + permuted residuals)."""
+    rng = np.random.default_rng(seed)
+    n, g = len(codes), len(group_sizes)
+    perm_idx = rng.permuted(np.broadcast_to(np.arange(n), (size, n)), axis=1)
+    y = fitted[None, :] + residuals[perm_idx]
+    return _anova_f(y, codes, group_sizes)
+
+def _anova_f(y: np.ndarray, codes: np.ndarray, group_sizes: np.ndarray):
+    # y: (batch, n); group means via one-hot matrix product
+    n, g = len(codes), len(group_sizes)
+    onehot = np.eye(g)[codes]
+    means = (y @ onehot) / group_sizes
+    grand = y.mean(axis=1, keepdims=True)
+    ss_between = ((means - grand) ** 2 * group_sizes).sum(axis=1)
+    ss_within = ((y - means[:, codes]) ** 2).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (ss_between / (g - 1)) / (ss_within / (n - g))
 
+def _spatial_median(X: np.ndarray, tol=1e-10, max_iter=500):
+    """Point minimizing the summed Euclidean distance to the rows of X (Weiszfeld iteration from the coordinate-wise median)."""
+    m = np.median(X, axis=0)
+    if X.shape[1] == 0:
+        return m
+    for _ in range(max_iter):
+        # A row sitting on the estimate would get infinite weight; floor its distance
+        d = np.maximum(np.sqrt(((X - m) ** 2).sum(axis=1)), tol)
+        w = 1.0 / d
+        new = (w[:, None] * X).sum(axis=0) / w.sum()
+        if np.sqrt(((new - m) ** 2).sum()) <= tol * (1.0 + np.sqrt((m ** 2).sum())):
+            return new
+        m = new
+    return m
+
+def perform_permdisp(distances: pd.DataFrame, grouping: pd.Series, permutations: int = 999, seed=42, n_jobs=None, type='median'):
+    """
+    PERMDISP (vegan's betadisper): distance of each sample to its group's spatial
+    median (type='median', vegan's default) or centroid (type='centroid') in full
+    PCoA space, as sqrt(|d_pos - d_neg|) over the positive- and negative-eigenvalue
+    axes, then an ANOVA F tested by permuting residuals. A significant result means
+    groups differ in spread, which PERMANOVA alone cannot tell apart from a location
+    difference.
+    """
+    from scipy.linalg import eigh
+    if type not in ('median', 'centroid'):
+        raise ValueError(f"Unknown PERMDISP type '{type}': use 'median' or 'centroid'")
+    D, codes, group_sizes, groups = _group_codes(distances, grouping)
+    n, g = len(codes), len(groups)
+    if g < 2 or n <= g:
+        raise ValueError("PERMDISP needs at least two groups and more samples than groups")
+
+    with span("permdisp.ordination"):
+        A = -0.5 * D ** 2
+        B = A - A.mean(axis=0, keepdims=True) - A.mean(axis=1, keepdims=True) + A.mean()
+        eigvals, eigvecs = eigh(B)
+    nonzero = np.abs(eigvals) > 1e-10 * np.abs(eigvals).max()
+    eigvals, eigvecs = eigvals[nonzero], eigvecs[:, nonzero]
+    coords = eigvecs * np.sqrt(np.abs(eigvals))
+    pos = eigvals > 0
+
+    onehot = np.eye(g)[codes]
+    if type == 'centroid':
+        centers = (onehot.T @ coords) / group_sizes[:, None]
+    else:
+        # As vegan: the median over the positive and the negative axes separately
+        centers = np.zeros((g, coords.shape[1]))
+        for k in range(g):
+            members = coords[codes == k]
+            centers[k, pos] = _spatial_median(members[:, pos])
+            centers[k, ~pos] = _spatial_median(members[:, ~pos])
+    dev2 = (coords - centers[codes]) ** 2
+    z = np.sqrt(np.abs(dev2[:, pos].sum(axis=1) - dev2[:, ~pos].sum(axis=1)))
 
+    group_means = (onehot.T @ z) / group_sizes
+    residuals = z - group_means[codes]
+    f_obs = float(_anova_f(z[None, :], codes, group_sizes)[0])
+
+    # As vegan's permutest: the full model's residuals, permuted, under the null's fit
+    # (the grand mean). Adding back the group means would keep the effect being tested.
+    null_fitted = np.full(n, z.mean())
+    with span("permdisp.permutations", permutations=permutations):
+        f_perm = _run_permutations(_anova_f_batch, (null_fitted, residuals, codes, group_sizes), n, permutations, seed, n_jobs=n_jobs)
+    p_value = (np.sum(f_perm >= f_obs - 1e-12) + 1) / (permutations + 1)
+
+    return {
+        'method': 'PERMDISP',
+        'test_statistic_name': 'F',
+        'test_statistic': f_obs,
+        'p_value': float(p_value),
+        'permutations': permutations,
+        'n_samples': n,
+        'n_groups': g,
+        'type': type,
+        'mean_dispersion': {str(k): float(v) for k, v in zip(groups, group_means)},
+    }
 
 def perform_correlation_analysis(transcriptomics: pd.DataFrame, metagenomics: pd.DataFrame, top_n_genes=50, top_n_taxa=20):
     """
     Perform Spearman correlation between top variable genes and top abundant taxa.
+    metagenomics: Taxa x Samples abundance matrix (or the raw long-format table, pivoted at Genus).
     """
     # 1. Select top genes by variance
-    gene_vars = transcriptomics.var(axis=1).sort_values(ascending=False)
+    with span("correlation.select"):
+        gene_vars = transcriptomics.var(axis=1).sort_values(ascending=False)
     top_genes = gene_vars.head(top_n_genes).index
     df_genes = transcriptomics.loc[top_genes].T # Samples x Genes
     
     # 2. Select top taxa by abundance
-    # Metagenomics: Sample | Abundance | Genus ...
-    # Pivot to Sample x Genus
-    mg_pivot = metagenomics.pivot_table(index='Genus', columns='Sample', values='Abundance', aggfunc='sum').fillna(0)
+    mg_pivot = _as_taxa_matrix(metagenomics) # Taxa x Samples
     # Filter for samples present in both
     common_samples = df_genes.index.intersection(mg_pivot.columns)
     
@@ -172,59 +799,199 @@ def perform_correlation_analysis(transcriptomics: pd.DataFrame, metagenomics: pd
     df_taxa = df_taxa[top_taxa]
     
     # 3. Calculate Correlation
-    # We want corr matrix: Genes x Taxa
-    # Pandas corrwith or manual loop
-    
-    corr_matrix = pd.DataFrame(index=top_genes, columns=top_taxa, dtype=float)
-    
-    for gene in top_genes:
-        for taxon in top_taxa:
-            corr, _ = stats.spearmanr(df_genes[gene], df_taxa[taxon])
-            corr_matrix.loc[gene, taxon] = corr
-            
-            corr_matrix.loc[gene, taxon] = corr
+    # We want corr matrix: Genes x Taxa, one matrix product over the rank-standardized rows
+    with span("correlation.test"):
+        z_genes = _rank_standardize(df_genes.T.to_numpy(dtype=float))
+        z_taxa = _rank_standardize(df_taxa.T.to_numpy(dtype=float))
+        
+        corr_matrix = pd.DataFrame(z_genes @ z_taxa.T, index=top_genes, columns=top_taxa)
             
     return corr_matrix
 
+def _rank_standardize(X: np.ndarray):
+    """
+    Rank each row (average ties, as spearmanr does), center it and scale it to unit
+    norm, so that Z1 @ Z2.T is the Spearman correlation between rows of X1 and X2.
+    Constant rows come out as NaN.
+    """
+    from scipy import stats
+    ranks = stats.rankdata(X, axis=1)
+    ranks -= ranks.mean(axis=1, keepdims=True)
+    norms = np.sqrt((ranks ** 2).sum(axis=1, keepdims=True))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return ranks / norms
+
+def _correlation_pvalues(rho: np.ndarray, n: int):
+    """Two-sided p-values for correlation coefficients via the t approximation (as in spearmanr)."""
+    from scipy import stats
+    dof = n - 2
+    # |rho| = 1 (common with ties over few samples) would give t = inf and p = 0 exactly
+    rho = np.clip(rho, -1.0 + 1e-7, 1.0 - 1e-7)
+    t = rho * np.sqrt(dof / ((1.0 - rho) * (1.0 + rho)))
+    return 2 * stats.t.sf(np.abs(t), dof)
+
+def adjust_pvalues_bh(p_values: np.ndarray):
+    """
+    Benjamini-Hochberg adjusted p-values (q-values), vectorized.
+    NaNs are left as NaN and not counted as tests.
+    """
+    p = np.asarray(p_values, dtype=float)
+    q = np.full(p.shape, np.nan)
+    valid = ~np.isnan(p)
+    pv = p[valid]
+    m = pv.size
+    if m == 0:
+        return q
+    order = np.argsort(pv)
+    scaled = pv[order] * m / np.arange(1, m + 1)
+    # Enforce monotonicity from the largest p-value down
+    scaled = np.minimum.accumulate(scaled[::-1])[::-1]
+    adj = np.empty(m)
+    adj[order] = np.minimum(scaled, 1.0)
+    q[valid] = adj
+    return q
+
+def spearman_correlation_screen(transcriptomics: pd.DataFrame, taxa_abundance: pd.DataFrame, max_q=None, top_k=None,
+                                min_samples=None, chunk_size=2000):
+    """
+    All-pairs Spearman screen between every gene and every taxon.
+    transcriptomics: Genes x Samples, depth-normalized (e.g. log-CPM; zeros must stay
+    zero); taxa_abundance: Taxa x Samples relative abundances.
+
+    Both matrices are ranked once; the correlation block is computed as a matrix
+    product in chunks of `chunk_size` genes. P-values use the t approximation and
+    q-values are BH-adjusted over all tested pairs. Genes/taxa that are constant
+    across the shared samples, or non-zero in fewer than `min_samples` of them
+    (default: half), are not tested: with mostly-zero rows every pair is a tie
+    artefact with |rho| near 1.
+
+    Returns a long DataFrame (gene, taxon, rho, p_value, q_value) holding the pairs
+    with q <= max_q and/or the top_k strongest pairs, sorted by p-value.
+    """
+    common_samples = transcriptomics.columns.intersection(taxa_abundance.columns)
+    n = len(common_samples)
+    columns = ['gene', 'taxon', 'rho', 'p_value', 'q_value']
+    if n < 4:
+        return pd.DataFrame(columns=columns)
+
+    genes = transcriptomics[common_samples]
+    taxa = taxa_abundance[common_samples]
+    gene_values = genes.to_numpy(dtype=np.float64)
+    taxa_values = taxa.to_numpy(dtype=np.float64)
+
+    # Drop rows that are constant across samples (undefined correlation) or too sparse
+    if min_samples is None:
+        min_samples = (n + 1) // 2
+    gene_keep = (np.ptp(gene_values, axis=1) > 0) & (np.count_nonzero(gene_values, axis=1) >= min_samples)
+    taxa_keep = (np.ptp(taxa_values, axis=1) > 0) & (np.count_nonzero(taxa_values, axis=1) >= min_samples)
+    gene_labels = genes.index[gene_keep]
+    taxa_labels = taxa.index[taxa_keep]
+    gene_values = gene_values[gene_keep]
+    z_taxa = _rank_standardize(taxa_values[taxa_keep])
+
+    n_genes, n_taxa = len(gene_labels), len(taxa_labels)
+    m = n_genes * n_taxa
+    if m == 0:
+        return pd.DataFrame(columns=columns)
+
+    # Correlation block, float32, one gene chunk at a time
+    with span("correlation.rho", pairs=m):
+        rho = np.empty((n_genes, n_taxa), dtype=np.float32)
+        for start in range(0, n_genes, chunk_size):
+            stop = min(start + chunk_size, n_genes)
+            rho[start:stop] = np.clip(_rank_standardize(gene_values[start:stop]) @ z_taxa.T, -1.0, 1.0)
+
+    # p is a decreasing function of |rho|, and rank correlations over n samples take
+    # few distinct values, so p-values and BH are computed per distinct |rho| and
+    # weighted by how many pairs share it. This is exact BH, including ties.
+    with span("correlation.test"):
+        abs_levels, level_counts = np.unique(np.abs(rho), return_counts=True)
+        abs_levels, level_counts = abs_levels[::-1], level_counts[::-1]   # strongest first
+        level_p = _correlation_pvalues(abs_levels.astype(np.float64), n)
+        n_at_or_above = np.cumsum(level_counts)
+        level_q = np.minimum.accumulate((level_p * m / n_at_or_above)[::-1])[::-1]
+        level_q = np.minimum(level_q, 1.0)
+
+    # Selection as a cutoff on |rho|
+    cut_level = len(abs_levels) - 1
+    if max_q is not None:
+        passed = np.nonzero(level_q <= max_q)[0]
+        cut_level = passed[-1] if passed.size else -1
+    if top_k is not None and top_k > 0:
+        cut_level = min(cut_level, int(np.searchsorted(n_at_or_above, min(top_k, m))))
+    attrs = {'n_tests': m, 'n_genes': n_genes, 'n_taxa': n_taxa, 'n_samples': n, 'min_samples': int(min_samples)}
+    if cut_level < 0:
+        # Nothing passed, but the response still says how much was tested
+        result = pd.DataFrame(columns=columns)
+        result.attrs.update(attrs)
+        return result
+    rho_cut = abs_levels[cut_level]
+
+    gene_idx, taxon_idx = [], []
+    for start in range(0, n_genes, chunk_size):
+        gi, ti = np.nonzero(np.abs(rho[start:start + chunk_size]) >= rho_cut)
+        gene_idx.append(gi + start)
+        taxon_idx.append(ti)
+    gene_idx = np.concatenate(gene_idx)
+    taxon_idx = np.concatenate(taxon_idx)
+    rho_sel = rho[gene_idx, taxon_idx]
+
+    # Levels are in descending order; map each selected |rho| back to its level
+    level_pos = len(abs_levels) - 1 - np.searchsorted(abs_levels[::-1], np.abs(rho_sel))
+
+    result = pd.DataFrame({
+        'gene': gene_labels[gene_idx],
+        'taxon': taxa_labels[taxon_idx],
+        'rho': rho_sel.astype(np.float64),
+        'p_value': level_p[level_pos],
+        'q_value': level_q[level_pos],
+    })
+    result = result.assign(_abs=np.abs(result['rho'])).sort_values(['_abs', 'gene', 'taxon'], ascending=[False, True, True]).drop(columns='_abs')
+    if top_k is not None and top_k > 0:
+        result = result.head(top_k)
+    result = result.reset_index(drop=True)
+    result.attrs.update(attrs)
+    return result
+
 def perform_pls_integration(transcriptomics: pd.DataFrame, metagenomics: pd.DataFrame, n_components=2):
     """
     Perform PLS Canonical correlation analysis to find latent variables integration.
     Closest python equivalent to mixOmics PLS.
+    metagenomics: Taxa x Samples abundance matrix (or the raw long-format table, pivoted at Genus).
     """
     from sklearn.cross_decomposition import PLSCanonical
+    from sklearn.preprocessing import StandardScaler
     
-    # Handle pivoting if Y_taxa looks like it has 'Sample' column.
-    if 'Sample' in metagenomics.columns and 'Genus' in metagenomics.columns:
-         Y_pivot = metagenomics.pivot_table(index='Sample', columns='Genus', values='Abundance', aggfunc='sum').fillna(0)
-    else:
-         Y_pivot = metagenomics
+    Y_pivot = _as_taxa_matrix(metagenomics).T # Samples x Taxa
          
     # Now find intersection
     common_samples = transcriptomics.columns.intersection(Y_pivot.index)
     
     if len(common_samples) < 5:
-        # Debugging print
-        print(f"Transcriptomics cols: {transcriptomics.columns[:5]}")
-        print(f"Metagenomics index: {Y_pivot.index[:5]}")
+        logger.warning("PLS: only %d shared samples (transcriptomics %s..., metagenomics %s...)",
+                       len(common_samples), list(transcriptomics.columns[:5]), list(Y_pivot.index[:5]))
         return None
         
-    X_genes = transcriptomics[common_samples].T # Samples x Genes
-    Y_taxa = Y_pivot.loc[common_samples] # Samples x Taxa
+    with span("pls.align"):
+        X_genes = transcriptomics[common_samples].T # Samples x Genes
+        Y_taxa = Y_pivot.loc[common_samples] # Samples x Taxa
 
     
     # Normalize (Standardize)
-    scaler_X = StandardScaler()
-    scaler_Y = StandardScaler()
-    X_scaled = scaler_X.fit_transform(X_genes)
-    Y_scaled = scaler_Y.fit_transform(Y_taxa)
-    
-    # filter zero variance columns
-    X_scaled = X_scaled[:, ~np.all(X_scaled == 0, axis=0)]
-    Y_scaled = Y_scaled[:, ~np.all(Y_scaled == 0, axis=0)]
+    with span("pls.scale"):
+        scaler_X = StandardScaler()
+        scaler_Y = StandardScaler()
+        X_scaled = scaler_X.fit_transform(X_genes)
+        Y_scaled = scaler_Y.fit_transform(Y_taxa)
+        
+        # filter zero variance columns
+        X_scaled = X_scaled[:, ~np.all(X_scaled == 0, axis=0)]
+        Y_scaled = Y_scaled[:, ~np.all(Y_scaled == 0, axis=0)]
 
     # PLS
-    pls = PLSCanonical(n_components=n_components)
-    X_c, Y_c = pls.fit_transform(X_scaled, Y_scaled)
+    with span("pls.fit", genes=X_scaled.shape[1], taxa=Y_scaled.shape[1]):
+        pls = PLSCanonical(n_components=n_components)
+        X_c, Y_c = pls.fit_transform(X_scaled, Y_scaled)
     
     # Return latent variables (Scores) for samples
     scores = pd.DataFrame(index=common_samples)
@@ -236,12 +1003,37 @@ def perform_pls_integration(transcriptomics: pd.DataFrame, metagenomics: pd.Data
     return scores
 
 
-async def perform_enrichment_analysis(gene_list: list):
+ENRICHR_LIBRARIES = ['GO_Biological_Process_2023', 'KEGG_2021_Human']
+
+def _parse_enrichr(raw_data):
+    # Enrichr returns [Rank, Term, P-value, Z-score, Combined Score, Genes, Adj P-val, ...]
+    # We want Term, P-value, Genes
+    parsed = []
+    for item in raw_data[:10]: # Top 10
+        parsed.append({
+            'term': item[1],
+            'p_value': item[2],
+            'adj_p_value': item[6],
+            'genes': item[5]
+        })
+    return parsed
+
+async def perform_enrichment_analysis(gene_list: list, libraries: list = None):
     """
     Perform GO and KEGG enrichment using Enrichr API.
+    Libraries are queried concurrently; per-library results are cached on disk.
     """
-    ADD_LIST_URL = 'https://maayanlab.cloud/Enrichr/addList'
-    ENRICH_URL = 'https://maayanlab.cloud/Enrichr/enrich'
+    ENRICH_BASE = SERVICE_URLS['enrichr']
+    libraries = libraries or ENRICHR_LIBRARIES
+    
+    results = {}
+    for lib in libraries:
+        cached = response_cache.get('enrichr', gene_list, lib)
+        if cached is not None:
+            results[lib] = cached
+    missing = [lib for lib in libraries if lib not in results]
+    if not missing:
+        return results
     
     try:
         # 1. Add list
@@ -249,47 +1041,76 @@ async def perform_enrichment_analysis(gene_list: list):
             'list': (None, '\n'.join(gene_list)),
             'description': (None, 'Omics Analysis Platform')
         }
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(ADD_LIST_URL, files=payload)
-            resp.raise_for_status()
-            data = resp.json()
-            user_list_id = data['userListId']
-            
-            # 2. Get Enrichment results
-            libraries = ['GO_Biological_Process_2023', 'KEGG_2021_Human']
-            results = {}
-            
-            for lib in libraries:
-                query_url = f"{ENRICH_URL}?userListId={user_list_id}&backgroundType={lib}"
-                resp = await client.get(query_url)
-                if resp.status_code == 200:
-                    # Enrichr returns [Rank, Term, P-value, Z-score, Combined Score, Genes, Adj P-val, ...]
-                    # We want Term, P-value, Genes
-                    raw_data = resp.json()[lib]
-                    parsed = []
-                    for item in raw_data[:10]: # Top 10
-                        parsed.append({
-                            'term': item[1],
-                            'p_value': item[2],
-                            'adj_p_value': item[6],
-                            'genes': item[5]
-                        })
-                    results[lib] = parsed
-            
-            return results
+        resp = await external_client.post(f"{ENRICH_BASE}/addList", files=payload)
+        resp.raise_for_status()
+        user_list_id = resp.json()['userListId']
+        
+        # 2. Get Enrichment results, all libraries at once
+        async def query(lib):
+            resp = await external_client.get(f"{ENRICH_BASE}/enrich", params={'userListId': user_list_id, 'backgroundType': lib})
+            if resp.status_code != 200:
+                return lib, None
+            return lib, _parse_enrichr(resp.json()[lib])
+        
+        for lib, parsed in await asyncio.gather(*(query(lib) for lib in missing)):
+            if parsed is not None:
+                results[lib] = parsed
+                response_cache.set('enrichr', gene_list, parsed, lib)
+        
+        return results
     except Exception as e:
-        print(f"Enrichment Error: {e}")
-        return {}
+        logger.warning("Enrichment error: %s", e)
+        return results
+
+def expressed_genes(counts: pd.DataFrame, min_cpm: float = 1.0, min_samples: int = 2):
+    """
+    Genes with CPM >= min_cpm in at least min_samples samples; a background set for enrichment.
+    """
+    values = counts.to_numpy()
+    cpm = values / values.sum(axis=0, dtype=np.float64) * 1e6
+    return counts.index[(cpm >= min_cpm).sum(axis=1) >= min_samples]
+
+def perform_local_enrichment(gene_list: list, universe, libraries: list = None, background=None, version=None):
+    """
+    Offline hypergeometric enrichment against local GMT libraries (see gene_sets.GENESET_DIR).
+    Returns the same {library: [{term, p_value, adj_p_value, genes}]} shape as
+    perform_enrichment_analysis.
+    """
+    from app.services import gene_sets
+    libraries = libraries or gene_sets.available_libraries()
+    results = {}
+    for lib in libraries:
+        library = gene_sets.get_library(lib, universe, version=version)
+        results[lib] = library.enrich(gene_list, background=background)
+    return results
+
+def perform_local_enrichment_batch(gene_lists: dict, universe, libraries: list = None, background=None, version=None, top_n: int = 10):
+    """
+    Score many named gene lists at once: {list_name: {library: [...]}}.
+    """
+    from app.services import gene_sets
+    libraries = libraries or gene_sets.available_libraries()
+    names = list(gene_lists)
+    results = {name: {} for name in names}
+    for lib in libraries:
+        library = gene_sets.get_library(lib, universe, version=version)
+        scored = library.enrich_many([gene_lists[n] for n in names], background=background, top_n=top_n)
+        for name, parsed in zip(names, scored):
+            results[name][lib] = parsed
+    return results
 
 async def get_ppi_network(gene_list: list):
     """
     Fetch PPI interactions from STRING DB API.
     """
-    STRING_API_URL = "https://string-db.org/api/json/network"
+    STRING_API_URL = f"{SERVICE_URLS['string']}/json/network"
     
     try:
         # Limit to top 50 genes to avoid explosive network
         genes_to_query = gene_list[:50]
+        cached = response_cache.get('string', genes_to_query)
+        if cached is not None:
+            return cached
         
         params = {
             "identifiers": "%0d".join(genes_to_query),
@@ -297,13 +1118,15 @@ async def get_ppi_network(gene_list: list):
             "caller_identity": "omics_platform"
         }
         
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(STRING_API_URL, data=params)
-            if resp.status_code == 200:
-                return resp.json()
-            return []
+        # A lookup sent as a form POST: safe to retry
+        resp = await external_client.post(STRING_API_URL, data=params, idempotent=True)
+        if resp.status_code == 200:
+            network = resp.json()
+            response_cache.set('string', genes_to_query, network)
+            return network
+        return []
     except Exception as e:
-        print(f"PPI Error: {e}")
+        logger.warning("PPI error: %s", e)
         return []
 
 async def get_drug_interactions(gene_list: list):
@@ -316,30 +1139,32 @@ async def get_drug_interactions(gene_list: list):
     Let's use the DGIdb v4 Interaction Search endpoint if possible, or a simple GET.
     https://dgidb.org/api/v2/interactions.json?genes=...
     """
-    DGIDB_URL = "https://dgidb.org/api/v2/interactions.json"
+    DGIDB_URL = f"{SERVICE_URLS['dgidb']}/interactions.json"
     
     try:
         # Query top 20 genes
-        genes_query = ",".join(gene_list[:20])
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(f"{DGIDB_URL}?genes={genes_query}")
-            if resp.status_code == 200:
-                data = resp.json()
-                interactions = []
-                for match in data.get('matchedTerms', []):
-                    gene_name = match['searchTerm']
-                    for cat in match.get('interactions', []):
-                        interactions.append({
-                            'gene': gene_name,
-                            'drug': cat['drugName'],
-                            'score': cat['score'],
-                            'interaction_type': cat['interactionTypes']
-                        })
-                return interactions
-            return []
+        genes_to_query = gene_list[:20]
+        cached = response_cache.get('dgidb', genes_to_query)
+        if cached is not None:
+            return cached
+        
+        genes_query = ",".join(genes_to_query)
+        resp = await external_client.get(f"{DGIDB_URL}?genes={genes_query}")
+        if resp.status_code == 200:
+            data = resp.json()
+            interactions = []
+            for match in data.get('matchedTerms', []):
+                gene_name = match['searchTerm']
+                for cat in match.get('interactions', []):
+                    interactions.append({
+                        'gene': gene_name,
+                        'drug': cat['drugName'],
+                        'score': cat['score'],
+                        'interaction_type': cat['interactionTypes']
+                    })
+            response_cache.set('dgidb', genes_to_query, interactions)
+            return interactions
+        return []
     except Exception as e:
-        print(f"Drug Interaction Error: {e}")
+        logger.warning("Drug interaction error: %s", e)
         return []
-
-
-
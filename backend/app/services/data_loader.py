@@ -1,40 +1,467 @@
 import pandas as pd
+import numpy as np
 import os
+import re
+import glob
+import json
 import gzip
+import time
+import logging
+import threading
+from app.services import dataset_cache
+from app.services import shared_dataset
+from app.services.tracing import span
+from app.services.taxonomy import TaxonomyMatrix
+from app.services.analysis import compute_log_cpm
+from app.services import ingestion
 
 DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../"))
 
+SOURCE_FILES = {
+    'metadata': "metadata.xlsx",
+    'transcriptomics': "GSE186651_datacount.txt.gz",
+    'metagenomics': "GSE186651_Abundance_rawdata.csv.gz",
+}
+
+# Samples appended through the ingestion API, per dataset and source fingerprint. Not a
+# cache: these exist nowhere else, so nothing here is pruned automatically.
+INGEST_DIR = os.environ.get("OMICS_INGEST_DIR", os.path.join(DATA_DIR, "ingested"))
+
+logger = logging.getLogger(__name__)
+
+# Load states
+IDLE, LOADING, READY, FAILED = "idle", "loading", "ready", "failed"
+
+# Dataset names double as cache directory names
+_NAME_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]*$")
+
+
+def table_separator(path: str):
+    # .csv / .csv.gz are comma-separated; everything else (.txt, .tsv) tab-separated
+    return ',' if '.csv' in os.path.basename(path).lower() else '\t'
+
+
+class Manifest:
+    """
+    Where one dataset's files are and how to read them: the count matrix (genes x
+    samples), the long-format abundance table, the sample metadata, and the
+    metadata columns holding the sample IDs and the default grouping.
+    """
+
+    def __init__(self, name: str, transcriptomics: str, metagenomics: str, metadata: str,
+                 sample_column: str = 'Title', group_column: str = 'Disease severity', description: str = None):
+        if not _NAME_PATTERN.match(name or ''):
+            raise ValueError(f"Invalid dataset name '{name}': use letters, digits, '.', '_' and '-'")
+        self.name = name
+        self.paths = {'metadata': metadata, 'transcriptomics': transcriptomics, 'metagenomics': metagenomics}
+        self.sample_column = sample_column
+        self.group_column = group_column
+        self.description = description
+
+    @classmethod
+    def from_file(cls, path: str):
+        """Read a JSON manifest; relative file paths are taken from the manifest's directory."""
+        with open(path) as f:
+            spec = json.load(f)
+        spec.setdefault('name', os.path.basename(path).rsplit('.', 1)[0])
+        missing = [k for k in ('transcriptomics', 'metagenomics', 'metadata') if not spec.get(k)]
+        if missing:
+            raise ValueError(f"Manifest {path} is missing {', '.join(missing)}")
+        base = os.path.dirname(os.path.abspath(path))
+        for k in ('transcriptomics', 'metagenomics', 'metadata'):
+            spec[k] = os.path.join(base, spec[k])
+        known = ('name', 'transcriptomics', 'metagenomics', 'metadata', 'sample_column', 'group_column', 'description')
+        return cls(**{k: v for k, v in spec.items() if k in known})
+
+    def settings(self):
+        # Everything besides the files that changes what gets loaded or how results are grouped
+        return {'sample_column': self.sample_column, 'group_column': self.group_column}
+
+    def to_dict(self):
+        return {'name': self.name, 'description': self.description, **self.paths, **self.settings()}
+
+
+DEFAULT_MANIFEST = Manifest(
+    'GSE186651', description="COVID-19 nasopharyngeal metatranscriptomics (PRJNA774978)",
+    **{name: os.path.join(DATA_DIR, fname) for name, fname in SOURCE_FILES.items()}
+)
+
+
+def _footprint(loaded):
+    # Bytes held by a loaded dataset; memory-mapped arrays count at their full size
+    metadata, transcriptomics, metagenomics, taxonomy, log_cpm = loaded
+    total = metadata.memory_usage(deep=True).sum() + metagenomics.memory_usage(deep=True).sum()
+    total += transcriptomics.to_numpy().nbytes + log_cpm.to_numpy().nbytes
+    arrays, _ = taxonomy.to_arrays()
+    total += sum(np.asarray(a).nbytes for a in arrays.values())
+    return int(total)
+
+
 class DataLoader:
-    _instance = None
-
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super(DataLoader, cls).__new__(cls)
-            cls._instance.metadata = None
-            cls._instance.transcriptomics = None
-            cls._instance.metagenomics = None
-        return cls._instance
-
-    def load_data(self):
-        print("Loading data...")
+    """
+    One dataset: its manifest, the loaded frames and the load state. Instances are
+    made and evicted by the dataset registry (app.services.datasets); data_loader
+    below serves the built-in GSE186651 dataset.
+    """
+
+    def __init__(self, manifest: Manifest = DEFAULT_MANIFEST):
+        self.manifest = manifest
+        self.name = manifest.name
+        self.metadata = None
+        self.transcriptomics = None
+        self.metagenomics = None
+        self.taxonomy = None
+        self.log_cpm = None
+        self.version = None
+        self.status = IDLE
+        self.error = None
+        self.timings = {}
+        self.source = None
+        self.loaded_at = None
+        self.memory_bytes = 0
+        # Sample IDs appended since the source files were read, and those files' fingerprint
+        self.ingested = []
+        self._source_key = None
+        # How many of the ingestion log's batches are applied, and the log's mtime when last listed
+        self._log_state = (0, None)
+        # (shared_root, key) of the segment the matrices are mapped from, if any
+        self._shared = None
+        self._retire_callbacks = []
+        self._ingest_callbacks = []
+        self._load_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def ready(self):
+        # A reload in progress keeps serving the previous version
+        return self.version is not None
+
+    def _parse_sources(self, paths: dict, timings: dict):
+        with span("load.metadata") as s:
+            if paths['metadata'].lower().endswith(('.xlsx', '.xls')):
+                metadata = pd.read_excel(paths['metadata'])
+            else:
+                metadata = pd.read_csv(paths['metadata'], sep=table_separator(paths['metadata']))
+        timings['metadata'] = s.seconds
+        with span("load.transcriptomics") as s:
+            transcriptomics = pd.read_csv(paths['transcriptomics'], sep=table_separator(paths['transcriptomics']), index_col=0)
+        timings['transcriptomics'] = s.seconds
+        with span("load.metagenomics") as s:
+            metagenomics = pd.read_csv(paths['metagenomics'], sep=table_separator(paths['metagenomics']))
+        timings['metagenomics'] = s.seconds
+        return metadata, transcriptomics, metagenomics
+
+    def cache_root(self):
+        # One directory per dataset: writing a new version prunes its siblings
+        return os.path.join(dataset_cache.default_cache_dir(DATA_DIR), self.name)
+
+    def ingest_dir(self, source_key: str):
+        return os.path.join(INGEST_DIR, self.name, source_key)
+
+    def fingerprint(self):
+        """
+        The version the dataset would load as now: its source files' fingerprint, chained
+        with every batch ingested on top of them. Raises OSError if a file is missing.
+        """
+        version = dataset_cache.fingerprint_sources(dict(self.manifest.paths), self.manifest.settings())
+        for _, digest in ingestion.batch_files(self.ingest_dir(version)):
+            version = ingestion.next_version(version, digest)
+        return version
+
+    def current_version(self):
+        """
+        The loaded version, or for a dataset not loaded yet the one its files would
+        load as; None if that can't be told. Enough to look up precomputed results.
+        """
+        if self.version is not None:
+            self.sync()
+            return self.version
         try:
-            # Load Metadata
-            meta_path = os.path.join(DATA_DIR, "metadata.xlsx")
-            self.metadata = pd.read_excel(meta_path)
-            
-            # Load Transcriptomics
-            trans_path = os.path.join(DATA_DIR, "GSE186651_datacount.txt.gz")
-            self.transcriptomics = pd.read_csv(trans_path, sep='\t', compression='gzip', index_col=0)
-            
-            # Load Metagenomics
-            meta_gen_path = os.path.join(DATA_DIR, "GSE186651_Abundance_rawdata.csv.gz")
-            self.metagenomics = pd.read_csv(meta_gen_path, compression='gzip')
-            
-            print("Data loaded successfully.")
+            return self.fingerprint()
+        except OSError:
+            return None
+
+    def load_data(self, use_cache: bool = True):
+        """
+        Load (or reload) the dataset's files. The new data is assembled on the side and
+        swapped in only once complete, so a failed reload leaves the previous version
+        in place. Returns True on success; on failure status is FAILED and error says why.
+        """
+        with self._load_lock, span("load", dataset=self.name) as total:
+            logger.info("Loading dataset %s...", self.name)
+            self.status = LOADING
+            self.error = None
+            timings = {}
+            shared = None
+            try:
+                paths = dict(self.manifest.paths)
+                key = dataset_cache.fingerprint_sources(paths, self.manifest.settings())
+                cache_root = self.cache_root()
+
+                if use_cache:
+                    # Workers booting together queue here: the first parses and publishes,
+                    # the rest find the cache and shared matrices ready and just map them.
+                    with dataset_cache.build_lock(cache_root):
+                        loaded, source, shared = self._load_cached(paths, key, cache_root, timings)
+                else:
+                    metadata, transcriptomics, metagenomics = self._parse_sources(paths, timings)
+                    loaded = (metadata, transcriptomics, metagenomics) + self._derive(metagenomics, transcriptomics, timings)
+                    source = "sources"
+                metadata = loaded[0]
+
+                # Sample IDs encode patient and replicate (e.g. SY2_R3); expose the patient as a groupable column
+                sample_column = self.manifest.sample_column
+                if sample_column in metadata.columns and 'Patient' not in metadata.columns:
+                    metadata['Patient'] = metadata[sample_column].astype(str).str.split('_').str[0]
+                loaded, version, ingested, log_state = self._replay(loaded, key, timings)
+                memory_bytes = _footprint(loaded)
+            except Exception as e:
+                if shared is not None and shared != self._shared:
+                    self._release_lease(*shared)
+                logger.exception("Error loading dataset %s", self.name)
+                self.error = f"{type(e).__name__}: {e}"
+                self.status = FAILED
+                return False
+
+            previous = self.version
+            self.metadata, self.transcriptomics, self.metagenomics, self.taxonomy, self.log_cpm = loaded
+            timings['total'] = time.perf_counter() - total.start
+            self.timings = timings
+            self.source = source
+            self.version = version
+            self._source_key = key
+            released, self._shared = self._shared, shared
+            self.ingested = ingested
+            self._log_state = log_state
+            self.memory_bytes = memory_bytes
+            self.loaded_at = time.time()
+            self.status = READY
+            logger.info("Dataset %s loaded from %s (%s) in %.2fs.", self.name, source, version, timings['total'])
+            if previous is not None and previous != version:
+                self._retire(previous)
+            if released is not None and released != shared:
+                # The old segment goes with drop_stale once every worker has moved on
+                self._release_lease(*released)
             return True
-        except Exception as e:
-            print(f"Error loading data: {e}")
+
+    def _replay(self, loaded, key: str, timings: dict):
+        # Re-apply the batches ingested on top of these source files, oldest first
+        version, ingested = key, []
+        mtime = self._log_mtime(key)
+        batches = ingestion.batch_files(self.ingest_dir(key))
+        if batches:
+            with span("load.ingested", batches=len(batches)) as s:
+                for path, digest in batches:
+                    batch = ingestion.load_batch(path)
+                    loaded = ingestion.apply_batch(loaded, batch, self.manifest.sample_column)
+                    ingested += batch.sample_ids(self.manifest.sample_column)
+                    version = ingestion.next_version(version, digest)
+            timings['ingested'] = s.seconds
+        pickled = ingestion.pickled_batches(self.ingest_dir(key))
+        if pickled:
+            logger.warning("Dataset %s: batches in the old pickle format are not loaded; ingest them again: %s",
+                           self.name, ", ".join(pickled))
+        others = [d for d in glob.glob(os.path.join(INGEST_DIR, self.name, "*")) if os.path.basename(d) != key]
+        if others:
+            logger.warning("Dataset %s: samples ingested on top of earlier versions of its files are not loaded: %s",
+                           self.name, ", ".join(others))
+        return loaded, version, ingested, (len(batches), mtime)
+
+    def _log_mtime(self, key: str):
+        # Stat before listing: a batch renamed in after that bumps it again
+        try:
+            return os.stat(self.ingest_dir(key)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def ingest(self, batch: ingestion.SampleBatch):
+        """
+        Append a batch of new samples to the loaded dataset and return the version it
+        replaced. Only the new samples are normalized and pivoted. The batch is saved
+        to the ingestion log before the swap, so reloads and worker processes replay it
+        and arrive at the same version. Raises ValueError for an invalid batch and
+        OSError if it can't be saved; either way the dataset is left as it was.
+        """
+        with self._load_lock, span("ingest", dataset=self.name):
+            if self.version is None:
+                raise ValueError(f"Dataset '{self.name}' is not loaded")
+            sample_column = self.manifest.sample_column
+            # Other workers append to the same log: number the batch and chain its
+            # version only once every batch already there is applied here
+            with dataset_cache.build_lock(self.cache_root()):
+                self._catch_up()
+                loaded = (self.metadata, self.transcriptomics, self.metagenomics, self.taxonomy, self.log_cpm)
+                batch.validate(loaded, sample_column)
+                loaded = ingestion.apply_batch(loaded, batch, sample_column)
+                digest = ingestion.save_batch(self.ingest_dir(self._source_key), batch)
+                self._log_state = (self._log_state[0] + 1, self._log_mtime(self._source_key))
+            return self._swap(loaded, batch, digest)
+
+    def sync(self):
+        """
+        Apply the batches other workers have ingested since this one loaded or last
+        looked, so they all serve the same version. A stat() when there are none.
+        Returns True if the version changed.
+        """
+        if self.version is None or self._log_mtime(self._source_key) == self._log_state[1]:
             return False
+        with self._load_lock:
+            if self.version is None:
+                return False
+            version = self.version
+            try:
+                self._catch_up()
+            except Exception:
+                # Don't retry on every request; the next batch logged tries again
+                logger.exception("Could not apply ingested batches for dataset %s", self.name)
+                self._log_state = (self._log_state[0], self._log_mtime(self._source_key))
+            return self.version != version
+
+    def _catch_up(self):
+        # With _load_lock held: apply the logged batches not applied yet, in order
+        applied, _ = self._log_state
+        mtime = self._log_mtime(self._source_key)
+        batches = ingestion.batch_files(self.ingest_dir(self._source_key))
+        for path, digest in batches[applied:]:
+            batch = ingestion.load_batch(path)
+            loaded = (self.metadata, self.transcriptomics, self.metagenomics, self.taxonomy, self.log_cpm)
+            loaded = ingestion.apply_batch(loaded, batch, self.manifest.sample_column)
+            self._log_state = (self._log_state[0] + 1, None)
+            self._swap(loaded, batch, digest)
+        self._log_state = (self._log_state[0], mtime)
+
+    def _swap(self, loaded, batch: ingestion.SampleBatch, digest: str):
+        # Serve the frames with the batch appended; returns the version they replace
+        previous = self.version
+        self.metadata, self.transcriptomics, self.metagenomics, self.taxonomy, self.log_cpm = loaded
+        self.version = ingestion.next_version(previous, digest)
+        self.ingested = self.ingested + batch.sample_ids(self.manifest.sample_column)
+        self.memory_bytes = _footprint(loaded)
+        logger.info("Dataset %s: ingested %d samples (%s -> %s).", self.name, len(batch.metadata), previous, self.version)
+        for callback in self._ingest_callbacks:
+            try:
+                callback(self, previous, batch)
+            except Exception:
+                # Only costs the carried-over results; they are recomputed on demand
+                logger.exception("Ingest callback failed for dataset %s", self.name)
+        self._retire(previous)
+        return previous
+
+    def _retire(self, version: str):
+        for callback in self._retire_callbacks:
+            callback(version)
+
+    def _derive(self, metagenomics, transcriptomics, timings: dict):
+        # Pivot every rank once so endpoints never touch the long-format table per request
+        with span("load.pivot") as s:
+            taxonomy = TaxonomyMatrix.from_long(metagenomics)
+        timings['taxonomy'] = s.seconds
+        # Normalized once per dataset version and shared by every DEA request
+        with span("load.normalize") as s:
+            log_cpm = compute_log_cpm(transcriptomics)
+        timings['log_cpm'] = s.seconds
+        return taxonomy, log_cpm
+
+    def _load_cached(self, paths: dict, key: str, cache_root: str, timings: dict):
+        with span("load.cache"):
+            cached = dataset_cache.read_cache(cache_root, key, timings)
+        source = "cache"
+        if cached is None:
+            source = "sources"
+            cached = self._parse_sources(paths, timings)
+            try:
+                dataset_cache.write_cache(cache_root, key, *cached)
+                # Re-read so this process uses the same compact representation as cached boots.
+                cached = dataset_cache.read_cache(cache_root, key)
+            except OSError as e:
+                logger.warning("Could not write dataset cache: %s", e)
+        metadata, transcriptomics, metagenomics = cached
+
+        shared_root = shared_dataset.default_shared_dir(cache_root, self.name)
+        shared = shared_dataset.attach(shared_root, key)
+        if shared is None:
+            taxonomy, log_cpm = self._derive(metagenomics, transcriptomics, timings)
+            arrays, labels = taxonomy.to_arrays()
+            arrays.update({'counts': transcriptomics.to_numpy(), 'log_cpm': log_cpm.to_numpy()})
+            labels.update({'genes': list(transcriptomics.index), 'samples': list(transcriptomics.columns)})
+            try:
+                shared_dataset.publish(shared_root, key, arrays, labels)
+                shared_dataset.drop_stale(shared_root, keep=key)
+                shared = shared_dataset.attach(shared_root, key)
+            except OSError as e:
+                logger.warning("Could not publish shared matrices: %s", e)
+            if shared is None:
+                return (metadata, transcriptomics, metagenomics, taxonomy, log_cpm), source, None
+            logger.info("Published shared matrices to %s.", shared_root)
+        else:
+            source = "shared"
+        shared_dataset.lease(shared_root, key)
+
+        # Every process maps the same read-only pages instead of holding a private copy
+        with span("load.shared_attach") as s:
+            arrays, labels, _ = shared
+            genes = pd.Index(labels['genes'])
+            samples = pd.Index(labels['samples'])
+            transcriptomics = pd.DataFrame(arrays['counts'], index=genes, columns=samples, copy=False)
+            log_cpm = pd.DataFrame(arrays['log_cpm'], index=genes, columns=samples, copy=False)
+            taxonomy = TaxonomyMatrix.from_arrays(arrays, labels)
+        timings['shared_attach'] = s.seconds
+        return (metadata, transcriptomics, metagenomics, taxonomy, log_cpm), source, (shared_root, key)
+
+    def release_shared(self):
+        """
+        Give up this process's lease on the shared segment the matrices are mapped
+        from, for when the dataset is evicted, and unlink the segment if no other
+        worker still has it loaded: otherwise /dev/shm keeps holding it. Frames already
+        handed out stay valid (an unlinked file stays mapped), and a later load republishes.
+        """
+        shared, self._shared = self._shared, None
+        if shared is None:
+            return
+        shared_root, key = shared
+        try:
+            # Not while another worker is attaching to or publishing the same segment
+            with dataset_cache.build_lock(self.cache_root()):
+                if shared_dataset.release(shared_root, key):
+                    shared_dataset.unpublish(shared_root, key)
+                    logger.info("Removed shared matrices for dataset %s (%s).", self.name, key)
+        except OSError as e:
+            logger.warning("Could not remove shared matrices for dataset %s: %s", self.name, e)
+
+    def _release_lease(self, shared_root: str, key: str):
+        try:
+            shared_dataset.release(shared_root, key)
+        except OSError as e:
+            logger.warning("Could not release shared matrices for dataset %s: %s", self.name, e)
+
+    def source_path(self, name: str):
+        """Path of a raw source file, e.g. for re-reading the count matrix in chunks."""
+        return self.manifest.paths[name]
+
+    def start_background_load(self, target=None):
+        """
+        Run load_data() (or target, a wrapper around it) on a daemon thread so the app
+        can serve probes while it loads.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return self._thread
+        self.status = LOADING
+        self._thread = threading.Thread(target=target or self.load_data, name=f"data-loader-{self.name}", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def state(self):
+        """Load status for readiness probes."""
+        return {
+            "dataset": self.name,
+            "status": self.status,
+            "version": self.version,
+            "source": self.source,
+            "ingested_samples": len(self.ingested),
+            "loaded_at": self.loaded_at,
+            "timings": {name: round(seconds, 4) for name, seconds in self.timings.items()},
+            "error": self.error,
+        }
 
     def get_metadata(self):
         return self.metadata
@@ -45,4 +472,25 @@ class DataLoader:
     def get_metagenomics(self):
         return self.metagenomics
 
+    def get_taxonomy(self):
+        return self.taxonomy
+
+    def get_log_cpm(self):
+        return self.log_cpm
+
+    def on_retire(self, callback):
+        """
+        Register callback(version), run when a version stops being served: replaced
+        by a reload or unloaded. Used to drop results cached for it.
+        """
+        self._retire_callbacks.append(callback)
+
+    def on_ingest(self, callback):
+        """
+        Register callback(loader, previous_version, batch), run after samples are
+        ingested and before the previous version is retired, so results the new
+        samples don't affect can be carried over to the new version.
+        """
+        self._ingest_callbacks.append(callback)
+
 data_loader = DataLoader()
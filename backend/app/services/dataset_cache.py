@@ -0,0 +1,147 @@
+import pandas as pd
+import numpy as np
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import time
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Bump when the on-disk layout changes so stale caches are rebuilt instead of misread.
+CACHE_FORMAT_VERSION = 2
+
+def default_cache_dir(data_dir: str):
+    return os.environ.get("OMICS_CACHE_DIR", os.path.join(data_dir, ".omics_cache"))
+
+
+@contextmanager
+def build_lock(cache_root: str):
+    """
+    Exclusive lock across processes (e.g. uvicorn workers booting together), so one
+    of them parses the sources and publishes while the rest wait and then reuse it.
+    """
+    os.makedirs(cache_root, exist_ok=True)
+    with open(os.path.join(cache_root, ".lock"), "w") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def fingerprint_sources(paths: dict, settings: dict = None):
+    """
+    Fingerprint the source files by name, size and mtime, plus any settings that
+    change how they are read (e.g. a manifest's sample and group columns).
+    Cheap enough to run on every boot; any edit to an input changes the key.
+    """
+    h = hashlib.sha1(f"v{CACHE_FORMAT_VERSION}".encode())
+    for name in sorted(paths):
+        st = os.stat(paths[name])
+        h.update(f"{name}:{os.path.basename(paths[name])}:{st.st_size}:{st.st_mtime_ns}".encode())
+    if settings:
+        h.update(json.dumps(settings, sort_keys=True).encode())
+    return h.hexdigest()[:16]
+
+
+def _save_labels(path, labels):
+    # Fixed-width unicode arrays memory-map cleanly, unlike object arrays.
+    np.save(path, np.asarray([str(x) for x in labels], dtype=str))
+
+
+def _write_transcriptomics(out_dir, counts: pd.DataFrame):
+    values = counts.to_numpy()
+    # Raw counts fit comfortably in int32 and halve the footprint of int64.
+    if np.issubdtype(values.dtype, np.integer) and values.size and values.max() <= np.iinfo(np.int32).max and values.min() >= 0:
+        values = values.astype(np.int32)
+    np.save(os.path.join(out_dir, "counts.npy"), np.ascontiguousarray(values))
+    _save_labels(os.path.join(out_dir, "genes.npy"), counts.index)
+    _save_labels(os.path.join(out_dir, "samples.npy"), counts.columns)
+
+
+def _write_metagenomics(out_dir, df: pd.DataFrame):
+    categories = {}
+    for col in df.columns:
+        if df[col].dtype.kind in 'biufcmM':
+            # Abundance and any other numeric column stay numbers; only text becomes categorical
+            np.save(os.path.join(out_dir, f"mg_{col}.npy"), df[col].to_numpy())
+            continue
+        cat = pd.Categorical(df[col])
+        np.save(os.path.join(out_dir, f"mg_{col}.npy"), cat.codes)
+        categories[col] = [str(c) for c in cat.categories]
+    with open(os.path.join(out_dir, "mg_columns.json"), "w") as f:
+        json.dump({'columns': df.columns.tolist(), 'categories': categories}, f)
+
+
+def write_cache(cache_root: str, key: str, metadata: pd.DataFrame, transcriptomics: pd.DataFrame, metagenomics: pd.DataFrame):
+    """
+    Write the parsed datasets to cache_root/<key>. The directory is built under a
+    temporary name and renamed into place, so readers never see a partial cache.
+    """
+    os.makedirs(cache_root, exist_ok=True)
+    final_dir = os.path.join(cache_root, key)
+    tmp_dir = tempfile.mkdtemp(prefix=f".{key}-", dir=cache_root)
+    try:
+        metadata.to_pickle(os.path.join(tmp_dir, "metadata.pkl"))
+        _write_transcriptomics(tmp_dir, transcriptomics)
+        _write_metagenomics(tmp_dir, metagenomics)
+        try:
+            os.rename(tmp_dir, final_dir)
+        except OSError:
+            # Another worker finished first; its copy is equivalent.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    # Drop caches for older fingerprints
+    for entry in os.listdir(cache_root):
+        if entry != key and not entry.startswith('.'):
+            shutil.rmtree(os.path.join(cache_root, entry), ignore_errors=True)
+    return final_dir
+
+
+def read_cache(cache_root: str, key: str, timings: dict = None):
+    """
+    Load a cache written by write_cache. Returns None if it does not exist.
+    Numeric arrays are memory-mapped, so the count matrix is paged in lazily.
+    timings: optional dict filled with seconds spent per dataset.
+    """
+    cache_dir = os.path.join(cache_root, key)
+    if not os.path.isdir(cache_dir):
+        return None
+    timings = {} if timings is None else timings
+
+    start = time.perf_counter()
+    metadata = pd.read_pickle(os.path.join(cache_dir, "metadata.pkl"))
+    timings['metadata'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    counts = np.load(os.path.join(cache_dir, "counts.npy"), mmap_mode='r')
+    genes = np.load(os.path.join(cache_dir, "genes.npy"))
+    samples = np.load(os.path.join(cache_dir, "samples.npy"))
+    transcriptomics = pd.DataFrame(counts, index=pd.Index(genes.astype(object)), columns=pd.Index(samples.astype(object)), copy=False)
+    timings['transcriptomics'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+
+    with open(os.path.join(cache_dir, "mg_columns.json")) as f:
+        layout = json.load(f)
+    mg_cols = {}
+    for col in layout['columns']:
+        arr = np.load(os.path.join(cache_dir, f"mg_{col}.npy"), mmap_mode='r')
+        if col in layout['categories']:
+            mg_cols[col] = pd.Categorical.from_codes(np.asarray(arr), categories=layout['categories'][col])
+        else:
+            mg_cols[col] = arr
+    metagenomics = pd.DataFrame(mg_cols, columns=layout['columns'])
+    timings['metagenomics'] = time.perf_counter() - start
+
+    return metadata, transcriptomics, metagenomics
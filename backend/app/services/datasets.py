@@ -0,0 +1,260 @@
+import os
+import glob
+import time
+import logging
+import threading
+from collections import OrderedDict
+from app.services.data_loader import DATA_DIR, DEFAULT_MANIFEST, LOADING, FAILED, DataLoader, Manifest, data_loader
+
+# One JSON manifest per dataset, e.g. datasets/GSE999999.json
+DATASETS_DIR = os.environ.get("OMICS_DATASETS_DIR", os.path.join(DATA_DIR, "datasets"))
+
+logger = logging.getLogger(__name__)
+
+
+def _new_stats():
+    return {
+        "loads": 0, "load_failures": 0, "evictions": 0, "accesses": 0, "ingests": 0, "samples_ingested": 0,
+        "last_load_seconds": None, "total_load_seconds": 0.0, "last_access": None,
+    }
+
+
+class DatasetRegistry:
+    """
+    Every dataset the API can serve, by name. Manifests are read from a directory
+    (rescanned when an unknown name is asked for); the built-in GSE186651 manifest
+    is always there unless a file of the same name replaces it.
+
+    Datasets load on first access, in the background. Once the loaded datasets'
+    footprint exceeds the memory budget, the least recently used ones are evicted,
+    never the default or one still loading. Evicting drops the registry's reference
+    and this worker's lease on the dataset's shared matrices, which are unlinked
+    once no worker has them loaded: requests already holding the loader finish on
+    it, and the memory is freed once they are done.
+    """
+
+    def __init__(self, manifest_dir: str = DATASETS_DIR, default: str = None, memory_budget_mb: float = 4096):
+        self.manifest_dir = manifest_dir
+        self.default = default or DEFAULT_MANIFEST.name
+        self.memory_budget = int(memory_budget_mb * 1024 ** 2)
+        self._manifests = {}
+        self._loaders = {}
+        # Names of created loaders, least recently used first
+        self._lru = OrderedDict()
+        self._stats = {}
+        self._retire_callbacks = []
+        self._ingest_callbacks = []
+        self._lock = threading.RLock()
+        self.refresh()
+
+    def refresh(self):
+        """Re-read the manifest directory. Invalid manifests are logged and skipped."""
+        manifests = {DEFAULT_MANIFEST.name: DEFAULT_MANIFEST}
+        for path in sorted(glob.glob(os.path.join(self.manifest_dir, "*.json"))):
+            try:
+                manifest = Manifest.from_file(path)
+            except (OSError, ValueError, TypeError) as e:
+                logger.warning("Skipping dataset manifest %s: %s", path, e)
+                continue
+            manifests[manifest.name] = manifest
+        with self._lock:
+            self._manifests = manifests
+        return manifests
+
+    def names(self):
+        with self._lock:
+            return list(self._manifests)
+
+    def manifest(self, name: str = None):
+        name = name or self.default
+        with self._lock:
+            manifest = self._manifests.get(name)
+        if manifest is None:
+            # Maybe a manifest was added since the last scan
+            manifest = self.refresh().get(name)
+        return manifest
+
+    def on_retire(self, callback):
+        """Register callback(version), run when any dataset's version is replaced by a reload or evicted."""
+        self._retire_callbacks.append(callback)
+
+    def _retired(self, version: str):
+        for callback in self._retire_callbacks:
+            callback(version)
+
+    def on_ingest(self, callback):
+        """Register callback(loader, previous_version, batch), run when samples are ingested into any dataset."""
+        self._ingest_callbacks.append(callback)
+
+    def _ingested(self, loader: DataLoader, previous: str, batch):
+        for callback in self._ingest_callbacks:
+            callback(loader, previous, batch)
+
+    def loader(self, name: str = None):
+        """The loader for a dataset, created (not loaded) on first use; None for unknown names."""
+        manifest = self.manifest(name)
+        if manifest is None:
+            return None
+        with self._lock:
+            loader = self._loaders.get(manifest.name)
+            if loader is None:
+                # The default dataset is never evicted, so the module-level loader can serve it
+                if manifest is DEFAULT_MANIFEST and manifest.name == self.default:
+                    loader = data_loader
+                else:
+                    loader = DataLoader(manifest)
+                    loader.on_retire(self._retired)
+                    loader.on_ingest(self._ingested)
+                self._loaders[manifest.name] = loader
+                self._lru[manifest.name] = True
+                self._stats.setdefault(manifest.name, _new_stats())
+            return loader
+
+    def peek(self, name: str = None):
+        """The dataset's loader if one exists, without counting an access or starting a load."""
+        with self._lock:
+            return self._loaders.get(name or self.default)
+
+    def acquire(self, name: str = None):
+        """
+        The loader for a dataset (the default if name is None), or None if there is no
+        such dataset. Starts loading it in the background if it isn't loaded yet;
+        callers check .ready. A failed load is not retried until load() is called.
+        A loaded dataset first applies any samples other workers have ingested.
+        """
+        loader = self.loader(name)
+        if loader is None:
+            return None
+        with self._lock:
+            stats = self._stats[loader.name]
+            stats["accesses"] += 1
+            stats["last_access"] = time.time()
+            self._lru.move_to_end(loader.name)
+        if loader.ready:
+            # Pick up samples ingested through other workers
+            loader.sync()
+        elif loader.status not in (LOADING, FAILED):
+            self.start_load(loader.name)
+        return loader
+
+    def start_load(self, name: str = None):
+        """(Re)load a dataset on a background thread; returns the loader, or None if unknown."""
+        loader = self.loader(name)
+        if loader is not None:
+            loader.start_background_load(target=lambda: self._load(loader))
+        return loader
+
+    def load(self, name: str = None):
+        """Load (or reload) a dataset in this thread; returns the loader, or None if unknown."""
+        loader = self.loader(name)
+        if loader is not None:
+            self._load(loader)
+        return loader
+
+    def _load(self, loader: DataLoader):
+        ok = loader.load_data()
+        with self._lock:
+            stats = self._stats[loader.name]
+            if ok:
+                stats["loads"] += 1
+                stats["last_load_seconds"] = loader.timings.get('total')
+                stats["total_load_seconds"] += loader.timings.get('total', 0.0)
+            else:
+                stats["load_failures"] += 1
+        if ok:
+            self._release(self._enforce_budget(keep=loader.name))
+        return ok
+
+    def ingest(self, name: str, batch):
+        """
+        Append a batch of samples to a loaded dataset (see DataLoader.ingest); returns
+        the version it replaced. The dataset grows, so the memory budget is re-checked.
+        """
+        loader = self.loader(name)
+        previous = loader.ingest(batch)
+        with self._lock:
+            stats = self._stats[loader.name]
+            stats["ingests"] += 1
+            stats["samples_ingested"] += len(batch.metadata)
+        self._release(self._enforce_budget(keep=loader.name))
+        return previous
+
+    def resident_bytes(self):
+        with self._lock:
+            return sum(l.memory_bytes for l in self._loaders.values() if l.ready)
+
+    def _enforce_budget(self, keep: str):
+        # Returns the evicted loaders, for the caller to release outside the lock
+        evicted = []
+        with self._lock:
+            resident = self.resident_bytes()
+            for name in list(self._lru):
+                if resident <= self.memory_budget:
+                    break
+                loader = self._loaders[name]
+                if name in (keep, self.default) or loader.status == LOADING or not loader.ready:
+                    continue
+                resident -= loader.memory_bytes
+                evicted.append(self._evict(name))
+            if resident > self.memory_budget:
+                logger.warning("Loaded datasets use %.0f MB, over the %.0f MB budget, with nothing left to evict.",
+                               resident / 1024 ** 2, self.memory_budget / 1024 ** 2)
+        return evicted
+
+    def _evict(self, name: str):
+        loader = self._loaders.pop(name)
+        self._lru.pop(name, None)
+        self._stats[name]["evictions"] += 1
+        logger.info("Evicting dataset %s (%.0f MB).", name, loader.memory_bytes / 1024 ** 2)
+        if loader.version is not None:
+            self._retired(loader.version)
+        return loader
+
+    @staticmethod
+    def _release(evicted):
+        # Takes the dataset's cross-process build lock, so never under self._lock:
+        # a worker loading the dataset would hold up acquire(), peek() and /readyz
+        for loader in evicted:
+            loader.release_shared()
+
+    def evict(self, name: str):
+        """Evict a loaded dataset now. Returns False if it isn't loaded or can't be evicted."""
+        with self._lock:
+            loader = self._loaders.get(name)
+            if loader is None or name == self.default or loader.status == LOADING:
+                return False
+            self._evict(name)
+        self._release([loader])
+        return True
+
+    def stats(self):
+        with self._lock:
+            manifests = dict(self._manifests)
+            loaders = dict(self._loaders)
+            stats = {name: dict(s) for name, s in self._stats.items()}
+        datasets = []
+        for name, manifest in manifests.items():
+            loader = loaders.get(name)
+            datasets.append({
+                "name": name,
+                "description": manifest.description,
+                "default": name == self.default,
+                "status": loader.status if loader is not None else "idle",
+                "version": loader.version if loader is not None else None,
+                "memory_bytes": loader.memory_bytes if loader is not None and loader.ready else 0,
+                **stats.get(name, _new_stats()),
+            })
+        return {
+            "default": self.default,
+            "memory_budget_bytes": self.memory_budget,
+            "resident_bytes": self.resident_bytes(),
+            "datasets": datasets,
+        }
+
+
+registry = DatasetRegistry(
+    default=os.environ.get("OMICS_DEFAULT_DATASET"),
+    memory_budget_mb=float(os.environ.get("OMICS_DATASET_MEMORY_MB", 4096)),
+)
+data_loader.on_retire(registry._retired)
+data_loader.on_ingest(registry._ingested)
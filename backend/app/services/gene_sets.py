@@ -0,0 +1,244 @@
+import os
+import glob
+import numpy as np
+import pandas as pd
+from app.services.result_cache import ResultCache
+
+DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../"))
+GENESET_DIR = os.environ.get("GENESET_DIR", os.path.join(DATA_DIR, "genesets"))
+
+
+def load_gmt(path: str):
+    """
+    Parse a GMT file: one gene set per line, "term<TAB>description<TAB>gene1<TAB>gene2...".
+    Enrichr-style "GENE,1.0" weights are stripped. Returns {term: [genes]}.
+    """
+    gene_sets = {}
+    with open(path) as f:
+        for line in f:
+            parts = line.rstrip("\n\r").split("\t")
+            if len(parts) < 3:
+                continue
+            genes = [g.split(",")[0].strip() for g in parts[2:]]
+            gene_sets[parts[0]] = [g for g in genes if g]
+    return gene_sets
+
+
+def _log_comb(n, k):
+    from scipy.special import gammaln
+    return gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+
+
+def hypergeom_sf(k, N, K, n, rtol: float = 1e-15):
+    """
+    Vectorized hypergeometric upper tail P(X >= k) for X ~ Hypergeom(N, K, n).
+
+    scipy.stats.hypergeom.sf costs hundreds of microseconds per element, far too slow
+    for every (query, term) pair. Here the pmf at the start point comes from log-gamma
+    and the tail is summed with the pmf ratio recurrence, over whichever side of the
+    mean is shorter; elements drop out of the loop once their sum has converged.
+    """
+    k, K, n = np.broadcast_arrays(np.asarray(k, dtype=np.float64), np.asarray(K, dtype=np.float64), np.asarray(n, dtype=np.float64))
+    k, K, n = k.ravel(), K.ravel(), n.ravel()
+    if k.size > 1024:
+        # Overlap counts and set sizes repeat heavily across pairs; evaluate each triple once
+        ki, Ki, ni = k.astype(np.int64), K.astype(np.int64), n.astype(np.int64)
+        packed = (ki * (Ki.max() + 1) + Ki) * (ni.max() + 1) + ni
+        uniq, first, inverse = np.unique(packed, return_index=True, return_inverse=True)
+        if len(uniq) < k.size:
+            return hypergeom_sf(k[first], N, K[first], n[first], rtol=rtol)[inverse]
+    x_min = np.maximum(0, n - (N - K))
+    x_max = np.minimum(K, n)
+    out = np.ones(k.shape)
+    out[k > x_max] = 0.0
+
+    def logpmf(x, K_, n_):
+        return _log_comb(K_, x) + _log_comb(N - K_, n_ - x) - _log_comb(N, n_)
+
+    # Upper side: sum pmf(x) for x = k .. x_max
+    upper = np.nonzero((k > n * K / N) & (k <= x_max))[0]
+    if upper.size:
+        x = k[upper].copy()
+        Ku, nu, xmax = K[upper], n[upper], x_max[upper]
+        term = np.exp(logpmf(x, Ku, nu))
+        total = term.copy()
+        active = np.arange(upper.size)
+        while active.size:
+            xa = x[active]
+            Ka, na = Ku[active], nu[active]
+            term[active] *= (Ka - xa) * (na - xa) / ((xa + 1) * (N - Ka - na + xa + 1))
+            x[active] += 1
+            total[active] += term[active]
+            done = (x[active] >= xmax[active]) | (term[active] <= total[active] * rtol)
+            active = active[~done]
+        out[upper] = np.minimum(total, 1.0)
+
+    # Lower side: 1 - sum pmf(x) for x = k-1 down to x_min
+    lower = np.nonzero((k <= n * K / N) & (k > x_min))[0]
+    if lower.size:
+        x = k[lower] - 1
+        Kl, nl, xmin = K[lower], n[lower], x_min[lower]
+        term = np.exp(logpmf(x, Kl, nl))
+        total = term.copy()
+        active = np.nonzero(x > xmin)[0]
+        while active.size:
+            xa = x[active]
+            Ka, na = Kl[active], nl[active]
+            term[active] *= xa * (N - Ka - na + xa) / ((Ka - xa + 1) * (na - xa + 1))
+            x[active] -= 1
+            total[active] += term[active]
+            done = (x[active] <= xmin[active]) | (term[active] <= total[active] * rtol)
+            active = active[~done]
+        out[lower] = np.clip(1.0 - total, 0.0, 1.0)
+
+    return out
+
+
+def available_libraries(geneset_dir: str = None):
+    """Library names (GMT file stems) found in the gene-set directory."""
+    geneset_dir = geneset_dir or GENESET_DIR
+    return sorted(os.path.splitext(os.path.basename(p))[0] for p in glob.glob(os.path.join(geneset_dir, "*.gmt")))
+
+
+class GeneSetLibrary:
+    """
+    A GMT library as a sparse gene x term incidence matrix over a fixed gene universe
+    (the transcriptomics gene index). Genes outside the universe are dropped from the
+    sets, so the hypergeometric test is against the genes that could have been measured.
+    """
+
+    def __init__(self, name: str, gene_sets: dict, universe):
+        from scipy import sparse
+        self.name = name
+        self.universe = pd.Index(universe)
+        self.terms = pd.Index(list(gene_sets))
+
+        rows, cols = [], []
+        for j, genes in enumerate(gene_sets.values()):
+            idx = self.universe.get_indexer(pd.unique(pd.Index(genes)))
+            idx = idx[idx >= 0]
+            rows.append(idx)
+            cols.append(np.full(idx.size, j))
+        rows = np.concatenate(rows) if rows else np.array([], dtype=int)
+        cols = np.concatenate(cols) if cols else np.array([], dtype=int)
+        self.incidence = sparse.csc_matrix(
+            (np.ones(rows.size, dtype=np.float32), (rows, cols)),
+            shape=(len(self.universe), len(self.terms))
+        )
+
+    @classmethod
+    def from_gmt(cls, path: str, universe):
+        name = os.path.splitext(os.path.basename(path))[0]
+        return cls(name, load_gmt(path), universe)
+
+    def _query_matrix(self, query_lists: list, background_mask: np.ndarray):
+        from scipy import sparse
+        rows, cols = [], []
+        for i, genes in enumerate(query_lists):
+            idx = self.universe.get_indexer(pd.unique(pd.Index(genes)))
+            idx = idx[idx >= 0]
+            if background_mask is not None:
+                idx = idx[background_mask[idx]]
+            rows.append(np.full(idx.size, i))
+            cols.append(idx)
+        rows = np.concatenate(rows) if rows else np.array([], dtype=int)
+        cols = np.concatenate(cols) if cols else np.array([], dtype=int)
+        return sparse.csr_matrix(
+            (np.ones(rows.size, dtype=np.float32), (rows, cols)),
+            shape=(len(query_lists), len(self.universe))
+        )
+
+    def enrich_many(self, query_lists: list, background=None, top_n: int = 10, with_genes: bool = True):
+        """
+        Score many query gene lists against every term at once.
+
+        Overlaps for all (query, term) pairs come from one sparse product; p-values are
+        the hypergeometric upper tail P(X >= overlap) and are BH-adjusted per query over
+        all terms with at least one gene in the background.
+        background: optional list of genes to use as the universe (e.g. expressed genes).
+
+        Returns one list per query of {'term', 'p_value', 'adj_p_value', 'genes'} dicts,
+        best terms first.
+        """
+        from scipy import sparse
+        from app.services.analysis import adjust_pvalues_bh
+
+        background_mask = None
+        incidence = self.incidence
+        if background is not None:
+            background_mask = np.zeros(len(self.universe), dtype=bool)
+            idx = self.universe.get_indexer(pd.Index(background))
+            background_mask[idx[idx >= 0]] = True
+            incidence = (sparse.diags(background_mask.astype(np.float32)) @ incidence).tocsc()
+            incidence.eliminate_zeros()
+        n_universe = int(background_mask.sum()) if background_mask is not None else len(self.universe)
+
+        queries = self._query_matrix(query_lists, background_mask)
+        overlaps = np.asarray((queries @ incidence).todense())            # queries x terms
+        term_sizes = np.asarray(incidence.sum(axis=0)).ravel()             # K per term
+        query_sizes = np.asarray(queries.sum(axis=1)).ravel()              # n per query
+
+        testable = term_sizes > 0
+        p_values = np.ones_like(overlaps, dtype=np.float64)
+        hit = overlaps > 0
+        if hit.any():
+            q_idx, t_idx = np.nonzero(hit)
+            p_values[q_idx, t_idx] = hypergeom_sf(
+                overlaps[q_idx, t_idx], n_universe, term_sizes[t_idx], query_sizes[q_idx]
+            )
+
+        results = []
+        for i in range(len(query_lists)):
+            p = p_values[i, testable]
+            adj = adjust_pvalues_bh(p)
+            terms_idx = np.nonzero(testable)[0]
+            order = np.lexsort((-overlaps[i, terms_idx], p))[:top_n]
+            parsed = []
+            query_genes = np.sort(queries.indices[queries.indptr[i]:queries.indptr[i + 1]])
+            for k in order:
+                if overlaps[i, terms_idx[k]] == 0:
+                    break
+                entry = {
+                    'term': self.terms[terms_idx[k]],
+                    'p_value': float(p[k]),
+                    'adj_p_value': float(adj[k]),
+                }
+                if with_genes:
+                    j = terms_idx[k]
+                    term_genes = incidence.indices[incidence.indptr[j]:incidence.indptr[j + 1]]
+                    entry['genes'] = self.universe[np.intersect1d(query_genes, term_genes, assume_unique=True)].tolist()
+                parsed.append(entry)
+            results.append(parsed)
+        return results
+
+    def enrich(self, gene_list: list, background=None, top_n: int = 10):
+        return self.enrich_many([gene_list], background=background, top_n=top_n)[0]
+
+
+# Parsed libraries keyed by ('library', dataset version, name, path, mtime, size); rebuilt when the
+# gene universe changes or the GMT file is edited or replaced
+_library_cache = ResultCache(max_entries=int(os.environ.get("GENESET_CACHE_ENTRIES", 16)), name="gene_set_libraries")
+
+
+def get_library(name: str, universe, version=None, geneset_dir: str = None):
+    geneset_dir = geneset_dir or GENESET_DIR
+    # Only names of GMT files actually in the directory; never a path built from the request
+    available = available_libraries(geneset_dir)
+    if name not in available:
+        raise FileNotFoundError(f"Gene-set library '{name}' not found. Available: {', '.join(available) or 'none'}")
+    path = os.path.abspath(os.path.join(geneset_dir, f"{name}.gmt"))
+    st = os.stat(path)
+    key = ('library', version, name, path, st.st_mtime_ns, st.st_size)
+    return _library_cache.get_or_compute(key, lambda: GeneSetLibrary.from_gmt(path, universe))
+
+
+def clear_library_cache(version=None):
+    """Drop the libraries built for one dataset version, or all of them."""
+    if version is None:
+        _library_cache.clear()
+    else:
+        _library_cache.drop_version(version)
+
+
+def library_cache_stats():
+    return _library_cache.stats()
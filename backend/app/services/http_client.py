@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import random
+import asyncio
+import hashlib
+import logging
+import tempfile
+from app.services.tracing import span
+
+# Base URLs are overridable so the services can be pointed at a local stub server.
+SERVICE_URLS = {
+    'enrichr': os.environ.get("ENRICHR_URL", "https://maayanlab.cloud/Enrichr"),
+    'string': os.environ.get("STRING_URL", "https://string-db.org/api"),
+    'dgidb': os.environ.get("DGIDB_URL", "https://dgidb.org/api/v2"),
+}
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# Safe to send twice; anything else (e.g. Enrichr's POST /addList, which creates a
+# list upstream) is only retried when the request never reached the server
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+logger = logging.getLogger(__name__)
+
+
+class ExternalClient:
+    """
+    One shared httpx.AsyncClient for the app's lifetime: pooled connections,
+    timeouts, retries with exponential backoff and a cap on concurrent requests.
+    Non-idempotent requests are retried only on connection errors, unless the call
+    passes idempotent=True (e.g. a POST that is really a query).
+    """
+
+    def __init__(self, max_connections: int = 20, max_concurrency: int = 8, timeout: float = 20.0, retries: int = 3, backoff: float = 0.5):
+        self.max_connections = max_connections
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._client = None
+        self._semaphore = None
+
+    def _ensure_client(self):
+        # httpx is only imported once an external service is actually called
+        import httpx
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout, connect=5.0),
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def request(self, method: str, url: str, idempotent: bool = None, **kwargs):
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        with span("external.request", url=url.split('?')[0]) as s:
+            resp = await self._request(method, url, idempotent, **kwargs)
+            s.attrs['status'] = resp.status_code
+            return resp
+
+    async def _request(self, method: str, url: str, idempotent: bool, **kwargs):
+        import httpx
+        client = self._ensure_client()
+        # Failures where the server can't have seen the request
+        unsent = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    resp = await client.request(method, url, **kwargs)
+                if resp.status_code not in RETRY_STATUS or attempt >= self.retries or not idempotent:
+                    return resp
+            except (httpx.TransportError, httpx.TimeoutException) as e:
+                if attempt >= self.retries or not (idempotent or isinstance(e, unsent)):
+                    raise
+            # Exponential backoff with jitter
+            await asyncio.sleep(self.backoff * (2 ** attempt) * (0.5 + random.random()))
+            attempt += 1
+
+    async def get(self, url: str, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, idempotent: bool = False, **kwargs):
+        return await self.request("POST", url, idempotent=idempotent, **kwargs)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class ResponseCache:
+    """
+    On-disk JSON cache for external-service responses, keyed by
+    (service, sorted gene list, library) and expiring after ttl seconds.
+    """
+
+    def __init__(self, cache_dir: str, ttl: float = 7 * 24 * 3600):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+
+    def _path(self, service: str, genes, library: str = ""):
+        key = json.dumps([service, sorted(genes), library])
+        return os.path.join(self.cache_dir, service, hashlib.sha256(key.encode()).hexdigest() + ".json")
+
+    def get(self, service: str, genes, library: str = ""):
+        path = self._path(service, genes, library)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry.get('stored_at', 0) > self.ttl:
+            return None
+        return entry['value']
+
+    def set(self, service: str, genes, value, library: str = ""):
+        path = self._path(service, genes, library)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write-then-rename so concurrent readers never see a partial file
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump({'stored_at': time.time(), 'value': value}, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning("Could not write response cache: %s", e)
+
+
+# Its own root: dataset cache rebuilds prune everything else under .omics_cache
+_DEFAULT_CACHE_DIR = os.path.join(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../")), ".omics_http_cache")
+
+external_client = ExternalClient(
+    max_concurrency=int(os.environ.get("EXTERNAL_MAX_CONCURRENCY", 8)),
+    timeout=float(os.environ.get("EXTERNAL_TIMEOUT", 20)),
+    retries=int(os.environ.get("EXTERNAL_RETRIES", 3)),
+)
+response_cache = ResponseCache(
+    os.environ.get("EXTERNAL_CACHE_DIR", _DEFAULT_CACHE_DIR),
+    ttl=float(os.environ.get("EXTERNAL_CACHE_TTL", 7 * 24 * 3600)),
+)
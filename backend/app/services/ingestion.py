@@ -0,0 +1,179 @@
+import os
+import glob
+import json
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from app.services.analysis import compute_log_cpm
+from app.services.tracing import span
+
+
+class SampleBatch:
+    """
+    New samples to append to a loaded dataset: their metadata rows (one per sample,
+    keyed by the manifest's sample column), their count columns (genes x samples) and
+    their long-format abundance rows. A sample can come with counts, abundance or both.
+    """
+
+    def __init__(self, metadata: pd.DataFrame, counts: pd.DataFrame = None, abundance: pd.DataFrame = None):
+        self.metadata = metadata
+        self.counts = counts if counts is not None else pd.DataFrame()
+        self.abundance = abundance if abundance is not None else pd.DataFrame(columns=['Sample', 'Abundance'])
+
+    @classmethod
+    def from_payload(cls, metadata: list, counts: dict = None, abundance: list = None):
+        """From the JSON shapes the API takes: row dicts, {sample: {gene: count}} and row dicts."""
+        counts = pd.DataFrame(counts or {}).fillna(0)
+        abundance = pd.DataFrame(abundance or [], columns=None if abundance else ['Sample', 'Abundance'])
+        return cls(pd.DataFrame(metadata), counts, abundance)
+
+    def sample_ids(self, sample_column: str):
+        return [str(s) for s in self.metadata[sample_column]]
+
+    @property
+    def count_samples(self):
+        return [str(s) for s in self.counts.columns]
+
+    @property
+    def abundance_samples(self):
+        return sorted({str(s) for s in self.abundance['Sample']})
+
+    def validate(self, loaded, sample_column: str):
+        """Raise ValueError unless the batch can be appended to the loaded frames."""
+        metadata, transcriptomics, metagenomics, taxonomy, _ = loaded
+        if self.metadata.empty:
+            raise ValueError("A batch needs at least one metadata row")
+        if sample_column not in self.metadata.columns or self.metadata[sample_column].isna().any():
+            raise ValueError(f"Every metadata row needs the sample column '{sample_column}'")
+        samples = self.sample_ids(sample_column)
+        if len(set(samples)) != len(samples):
+            raise ValueError("Sample IDs in the batch must be unique")
+        existing = set(metadata[sample_column].astype(str)) | set(map(str, transcriptomics.columns)) | set(taxonomy.samples)
+        clash = [s for s in samples if s in existing]
+        if clash:
+            raise ValueError(f"Samples already in the dataset: {', '.join(clash[:5])}")
+        if self.counts.empty and self.abundance.empty:
+            raise ValueError("A batch needs count columns, abundance rows or both")
+        if not self.abundance.empty:
+            missing = [c for c in ('Sample', 'Abundance') if c not in self.abundance.columns]
+            if missing:
+                raise ValueError(f"Every abundance row needs {' and '.join(missing)}")
+
+        unknown = [s for s in self.count_samples + self.abundance_samples if s not in set(samples)]
+        if unknown:
+            raise ValueError(f"Samples without a metadata row: {', '.join(unknown[:5])}")
+        if not self.counts.empty:
+            # New genes would need rows of zeros in every existing sample; not supported
+            new_genes = self.counts.index.difference(transcriptomics.index)
+            if len(new_genes):
+                raise ValueError(f"{len(new_genes)} unknown genes, e.g. {', '.join(map(str, new_genes[:5]))}")
+            values = self.counts.to_numpy(dtype=np.float64)
+            if not np.isfinite(values).all() or (values < 0).any():
+                raise ValueError("Counts must be finite and non-negative")
+            if np.issubdtype(transcriptomics.to_numpy().dtype, np.integer) and not np.array_equal(values, np.round(values)):
+                raise ValueError("This dataset holds integer read counts")
+        if not self.abundance.empty:
+            extra = self.abundance.columns.difference(metagenomics.columns)
+            if len(extra):
+                raise ValueError(f"Unknown abundance columns: {', '.join(map(str, extra))}")
+            values = pd.to_numeric(self.abundance['Abundance'], errors='coerce').to_numpy(dtype=np.float64)
+            if not np.isfinite(values).all() or (values < 0).any():
+                raise ValueError("Abundance must be finite and non-negative")
+
+
+def _append_columns(frame: pd.DataFrame, added: pd.DataFrame):
+    # Genes x samples: one copy into a new block; the existing frame may be read-only maps
+    values = np.concatenate([frame.to_numpy(), added.to_numpy(dtype=frame.to_numpy().dtype)], axis=1)
+    return pd.DataFrame(values, index=frame.index, columns=frame.columns.append(pd.Index(added.columns.astype(str))), copy=False)
+
+
+def _append_long(df: pd.DataFrame, rows: pd.DataFrame):
+    # Concatenate long-format tables, keeping categorical columns categorical
+    columns = {}
+    for col in df.columns:
+        new = rows[col].reset_index(drop=True) if col in rows.columns else pd.Series([None] * len(rows), dtype=object)
+        old = df[col].reset_index(drop=True)
+        if isinstance(old.dtype, pd.CategoricalDtype):
+            # union_categoricals wants both category sets in one dtype (str under pandas 3)
+            new = pd.Categorical(new.astype(object).astype(old.cat.categories.dtype))
+            columns[col] = union_categoricals([pd.Categorical(old), new], ignore_order=True)
+        else:
+            columns[col] = pd.concat([old, new], ignore_index=True)
+    return pd.DataFrame(columns, columns=df.columns)
+
+
+def apply_batch(loaded, batch: SampleBatch, sample_column: str):
+    """
+    The loaded frames (metadata, counts, long abundance, taxonomy, log-CPM) with the
+    batch appended. Only the new samples are normalized and pivoted: log-CPM gets
+    their columns from their own library sizes, the taxonomy matrices their rows via
+    TaxonomyMatrix.append. The inputs are left untouched.
+    """
+    metadata, transcriptomics, metagenomics, taxonomy, log_cpm = loaded
+    new_meta = batch.metadata.copy()
+    new_meta[sample_column] = new_meta[sample_column].astype(str)
+    if 'Patient' in metadata.columns and 'Patient' not in new_meta.columns:
+        new_meta['Patient'] = new_meta[sample_column].str.split('_').str[0]
+    metadata = pd.concat([metadata, new_meta], ignore_index=True)
+
+    if not batch.counts.empty:
+        with span("ingest.normalize", samples=batch.counts.shape[1]):
+            counts = batch.counts.reindex(transcriptomics.index, fill_value=0)
+            new_log_cpm = compute_log_cpm(counts)
+            transcriptomics = _append_columns(transcriptomics, counts)
+            log_cpm = _append_columns(log_cpm, new_log_cpm)
+
+    if not batch.abundance.empty:
+        rows = batch.abundance.copy()
+        rows['Sample'] = rows['Sample'].astype(str)
+        rows['Abundance'] = pd.to_numeric(rows['Abundance'])
+        with span("ingest.pivot", rows=len(rows)):
+            taxonomy = taxonomy.append(rows)
+            metagenomics = _append_long(metagenomics, rows)
+    return metadata, transcriptomics, metagenomics, taxonomy, log_cpm
+
+
+def next_version(version: str, digest: str):
+    """The version after appending the batch with this digest."""
+    return hashlib.sha1(f"{version}:{digest}".encode()).hexdigest()[:16]
+
+
+def batch_files(ingest_dir: str):
+    """Saved batches in the order they were ingested, as (path, digest)."""
+    paths = sorted(glob.glob(os.path.join(ingest_dir, "*.json")))
+    return [(p, os.path.basename(p)[:-5].split('-', 1)[1]) for p in paths]
+
+
+def pickled_batches(ingest_dir: str):
+    # Batches logged before the JSON format; never unpickled, as that can run code
+    return sorted(glob.glob(os.path.join(ingest_dir, "*.pkl")))
+
+
+def save_batch(ingest_dir: str, batch: SampleBatch):
+    """
+    Append the batch to the dataset's ingestion log; returns its digest. The three
+    tables are stored as JSON in pandas' 'split' layout, which reads back with the
+    dtypes the API's JSON payload gave them.
+    """
+    os.makedirs(ingest_dir, exist_ok=True)
+    tables = {'metadata': batch.metadata, 'counts': batch.counts, 'abundance': batch.abundance}
+    body = json.dumps({name: frame.to_dict(orient='split') for name, frame in tables.items()}).encode()
+    digest = hashlib.sha1(body).hexdigest()[:16]
+    fd, tmp = tempfile.mkstemp(prefix=".batch-", dir=ingest_dir)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(body)
+        os.rename(tmp, os.path.join(ingest_dir, f"{len(batch_files(ingest_dir)) + 1:05d}-{digest}.json"))
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return digest
+
+
+def load_batch(path: str):
+    with open(path) as f:
+        parts = json.load(f)
+    return SampleBatch(*(pd.DataFrame(**parts[name]) for name in ('metadata', 'counts', 'abundance')))
@@ -0,0 +1,202 @@
+import os
+import time
+import uuid
+import asyncio
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from app.services import tracing
+
+# Job states
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+
+
+class JobError(Exception):
+    """A job failure carrying an HTTP status, so workers can report bad input as 4xx."""
+
+    def __init__(self, status_code: int, detail):
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _init_worker():
+    # Each worker maps the default dataset's on-disk cache once at startup; jobs then
+    # only ship their parameters, never the matrices. Other datasets load on first use.
+    from app.services.datasets import registry
+    registry.load()
+
+
+def _run_job(func, params: dict, dataset, version):
+    from app.services.datasets import registry
+    started = time.time()
+    try:
+        # Stage timings travel back with the result; the worker's own metrics are never scraped
+        with tracing.trace() as trace:
+            # First job on this dataset, or the API process reloaded it since; catch up before computing
+            loader = registry.peek(dataset)
+            if loader is None or (version is not None and loader.version != version):
+                registry.load(dataset)
+            result = func(**params)
+    except JobError:
+        raise
+    except Exception as e:
+        # HTTPException and friends don't pickle cleanly; flatten to status + detail
+        status = getattr(e, 'status_code', None)
+        if status is not None:
+            raise JobError(status, getattr(e, 'detail', str(e)))
+        raise JobError(500, f"{type(e).__name__}: {e}")
+    return started, time.time(), result, trace.to_dict()
+
+
+class Job:
+    def __init__(self, kind: str, params: dict, future):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.future = future
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.profile = None
+        self.cancel_requested = False
+
+    @property
+    def status(self):
+        if self.cancel_requested or self.future.cancelled():
+            return CANCELLED
+        if self.finished_at is not None:
+            return FAILED if self.error is not None else DONE
+        return RUNNING if self.future.running() else QUEUED
+
+    def _collect(self):
+        # Runs once, from the future's done-callback; finished_at is set last so
+        # status never reports "done" before the result is in place
+        finished = time.time()
+        if not self.future.cancelled():
+            try:
+                self.started_at, finished, result, self.profile = self.future.result()
+                tracing.observe_profile(self.profile)
+                if not self.cancel_requested:
+                    self.result = result
+            except JobError as e:
+                self.error = e
+            except Exception as e:
+                self.error = JobError(500, f"{type(e).__name__}: {e}")
+        self.finished_at = finished
+
+    def to_dict(self):
+        end = self.finished_at or time.time()
+        return {
+            "id": self.id,
+            "analysis": self.kind,
+            "params": self.params,
+            "status": self.status,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "queue_seconds": (self.started_at - self.submitted_at) if self.started_at else None,
+            "run_seconds": (self.finished_at - self.started_at) if self.started_at and self.finished_at else None,
+            "elapsed_seconds": end - self.submitted_at,
+            "error": None if self.error is None else {"status_code": self.error.status_code, "detail": self.error.detail},
+            "profile": self.profile,
+        }
+
+
+class JobManager:
+    """
+    Runs CPU-bound analyses in a bounded process pool so they neither hold the
+    API process's GIL nor tie up its request threads.
+
+    The pool is started on first use. Finished jobs are kept (up to max_jobs,
+    oldest evicted first) so their status and results can be fetched later.
+    """
+
+    def __init__(self, max_workers: int = None, max_jobs: int = 256):
+        self.max_workers = max_workers or max(1, min(4, (os.cpu_count() or 2) - 1))
+        self.max_jobs = max_jobs
+        self._executor = None
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _ensure_executor(self):
+        if self._executor is None:
+            # spawn rather than fork: the API process runs threads (uvicorn, the request pool)
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+        return self._executor
+
+    def submit(self, kind: str, func, params: dict, dataset: str = None, version=None):
+        """
+        Queue func(**params) in a worker; func must be a module-level (picklable) function.
+        The worker loads dataset (at version) first if it doesn't have it.
+        """
+        with self._lock:
+            future = self._ensure_executor().submit(_run_job, func, params, dataset, version)
+            job = Job(kind, params, future)
+            self._jobs[job.id] = job
+            self._evict()
+        future.add_done_callback(lambda _: job._collect())
+        return job
+
+    def _evict(self):
+        finished = [jid for jid, j in self._jobs.items() if j.finished_at is not None]
+        while len(self._jobs) > self.max_jobs and finished:
+            self._jobs.pop(finished.pop(0), None)
+
+    def get(self, job_id: str):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id: str):
+        """
+        Cancel a job. Queued jobs never start; a job already running in a worker
+        can't be interrupted, so it finishes but its result is discarded.
+        """
+        job = self.get(job_id)
+        if job is None:
+            return None
+        if not job.future.done():
+            if not job.future.cancel():
+                job.cancel_requested = True
+        return job
+
+    async def wait(self, job: Job, timeout: float):
+        """Long-poll: return once the job has finished or timeout seconds have passed."""
+        if timeout <= 0 or job.future.done():
+            return job
+        # asyncio.wait never raises for the job's own outcome, and on timeout leaves it running
+        waiter = asyncio.wrap_future(job.future)
+        # The outcome is read from job.future; retrieve the wrapper's too, now or whenever it
+        # finishes, or asyncio logs "Future exception was never retrieved" for failed jobs
+        waiter.add_done_callback(lambda f: f.cancelled() or f.exception())
+        await asyncio.wait({waiter}, timeout=timeout)
+        return job
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return {"workers": self.max_workers, "started": self._executor is not None, "jobs": counts}
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+job_manager = JobManager(
+    max_workers=int(os.environ["OMICS_JOB_WORKERS"]) if os.environ.get("OMICS_JOB_WORKERS") else None,
+    max_jobs=int(os.environ.get("OMICS_MAX_JOBS", 256)),
+)
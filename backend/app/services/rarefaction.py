@@ -0,0 +1,158 @@
+import numpy as np
+import pandas as pd
+from app.services.tracing import span
+
+# Alpha-diversity indices computed on every rarefied draw
+INDICES = ('observed', 'shannon', 'simpson', 'chao1')
+
+# Iterations drawn together as one batch (and one pool task). Fixed, so the same seed
+# gives the same draws whether batches run here or in a pool.
+ITERATIONS_PER_BATCH = 10
+
+
+def depth_grid(totals, steps: int = 20):
+    """Log-spaced depths from 1 read to the deepest sample; read depths span orders of magnitude."""
+    top = max(int(np.max(totals)), 1)
+    return np.unique(np.geomspace(1, top, steps).round().astype(np.int64))
+
+
+def _as_counts(abundance: pd.DataFrame):
+    # Samples x taxa int64, taxa without reads dropped and the rest by decreasing total
+    X = abundance.to_numpy(dtype=np.float64).T
+    if (X < 0).any() or not np.array_equal(X, np.round(X)):
+        raise ValueError("Rarefaction needs non-negative integer read counts")
+    X = X.astype(np.int64)
+    totals = X.sum(axis=0)
+    order = np.argsort(-totals, kind='stable')
+    return X[:, order[totals[order] > 0]]
+
+
+def _draw_batch(counts: np.ndarray, depths: np.ndarray, seed, size: int):
+    """
+    Alpha diversity of `size` rarefied draws of every sample at every depth.
+
+    Each draw is multivariate hypergeometric, and the whole (size, samples, depths)
+    batch is drawn at once by the conditional method: taxon by taxon, the reads a
+    taxon gets are Hypergeometric(its reads, reads of the taxa after it, draws left),
+    broadcast over the batch. Only the per-draw sums behind the indices are kept,
+    never the rarefied matrices. Draws deeper than the sample come back NaN.
+    """
+    from scipy.special import xlogy
+    rng = np.random.default_rng(seed)
+    n_samples, n_taxa = counts.shape
+    totals = counts.sum(axis=1)
+    valid = depths[None, :] <= totals[:, None]
+    shape = (size, n_samples, len(depths))
+    remaining = np.broadcast_to(np.where(valid, depths[None, :], 0), shape).copy()
+    left = totals.copy()
+
+    observed = np.zeros(shape)
+    singletons = np.zeros(shape)
+    doubletons = np.zeros(shape)
+    sum_xlogx = np.zeros(shape)
+    sum_x2 = np.zeros(shape)
+    for i in range(n_taxa):
+        # Taxa are sorted by abundance, so shallow draws are usually placed early
+        if i % 64 == 0 and not remaining.any():
+            break
+        c = counts[:, i]
+        left -= c
+        x = rng.hypergeometric(np.broadcast_to(c[None, :, None], shape), np.broadcast_to(left[None, :, None], shape), remaining)
+        remaining -= x
+        observed += x > 0
+        singletons += x == 1
+        doubletons += x == 2
+        sum_xlogx += xlogy(x, x)
+        sum_x2 += x * x
+
+    d = depths[None, None, :].astype(np.float64)
+    result = {
+        'observed': observed,
+        # -sum p ln p with p = x / d, so empty taxa contribute exactly 0
+        'shannon': np.log(d) - sum_xlogx / d,
+        'simpson': 1 - sum_x2 / d ** 2,
+        # Bias-corrected Chao1, defined even without doubletons
+        'chao1': observed + singletons * (singletons - 1) / (2 * (doubletons + 1)),
+    }
+    for values in result.values():
+        values[:, ~valid] = np.nan
+    return result
+
+
+def _run_batches(counts: np.ndarray, depths: np.ndarray, iterations: int, seed, n_jobs=None):
+    n_batches = -(-iterations // ITERATIONS_PER_BATCH)
+    seeds = np.random.SeedSequence(seed).spawn(n_batches)
+    sizes = [min(ITERATIONS_PER_BATCH, iterations - i * ITERATIONS_PER_BATCH) for i in range(n_batches)]
+    # Only worth the process start-up cost for large grids
+    work = iterations * counts.shape[0] * counts.shape[1] * len(depths)
+    if n_jobs == 1 or n_batches == 1 or work < 5e8:
+        batches = [_draw_batch(counts, depths, s, n) for s, n in zip(seeds, sizes)]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [pool.submit(_draw_batch, counts, depths, s, n) for s, n in zip(seeds, sizes)]
+            batches = [f.result() for f in futures]
+    return {index: np.concatenate([b[index] for b in batches]) for index in INDICES}
+
+
+def rarefaction_curves(abundance: pd.DataFrame, depths=None, steps: int = 20, iterations: int = 10, seed=42, n_jobs=None):
+    """
+    Rarefaction curves of a Taxa x Samples read-count matrix: each alpha index
+    (observed richness, Shannon, Gini-Simpson, Chao1) averaged over `iterations`
+    random subsamples without replacement, per sample and depth. depths defaults to
+    a log-spaced grid of `steps` depths up to the deepest sample.
+
+    Returns a long frame (Sample, depth, reads, <index>, <index>_sd) without the
+    depths a sample doesn't reach; attrs['depths'] holds the grid and attrs['reads']
+    every sample's read count. The same seed always gives the same curves.
+    """
+    if iterations < 1:
+        raise ValueError("iterations must be at least 1")
+    counts = _as_counts(abundance)
+    totals = counts.sum(axis=1)
+    if depths is None:
+        depths = depth_grid(totals, steps)
+    depths = np.unique(np.asarray(depths, dtype=np.int64))
+    if depths.size == 0 or depths[0] < 1:
+        raise ValueError("Depths must be positive read counts")
+
+    with span("rarefaction.draw", samples=counts.shape[0], taxa=counts.shape[1], depths=len(depths), iterations=iterations):
+        draws = _run_batches(counts, depths, iterations, seed, n_jobs=n_jobs)
+
+    sample_idx, depth_idx = np.nonzero(depths[None, :] <= totals[:, None])
+    columns = {
+        'Sample': abundance.columns.to_numpy()[sample_idx],
+        'depth': depths[depth_idx],
+        'reads': totals[sample_idx],
+    }
+    for index in INDICES:
+        values = draws[index][:, sample_idx, depth_idx]
+        columns[index] = values.mean(axis=0)
+        columns[f'{index}_sd'] = values.std(axis=0, ddof=1) if iterations > 1 else np.zeros(len(sample_idx))
+    result = pd.DataFrame(columns)
+    result.attrs['depths'] = depths.tolist()
+    result.attrs['reads'] = {str(s): int(n) for s, n in zip(abundance.columns, totals)}
+    return result
+
+
+def default_depth(abundance: pd.DataFrame):
+    """The shallowest non-empty sample's read count, the usual common rarefaction depth."""
+    totals = abundance.sum(axis=0)
+    totals = totals[totals > 0]
+    if totals.empty:
+        raise ValueError("No sample has any reads at this rank")
+    return int(totals.min())
+
+
+def rarefied_alpha_diversity(curves: pd.DataFrame, depth: int):
+    """
+    One depth of rarefaction_curves() as a Samples x indices frame. Samples with
+    fewer reads than depth are left out; attrs['excluded'] lists them.
+    """
+    at_depth = curves[curves['depth'] == depth].set_index('Sample').drop(columns='depth')
+    at_depth.index.name = None
+    at_depth.attrs = {
+        'depth': int(depth),
+        'excluded': [s for s, n in curves.attrs['reads'].items() if n < depth],
+    }
+    return at_depth
@@ -0,0 +1,126 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class ResultCache:
+    """
+    Size-bounded LRU cache for analysis results.
+
+    get_or_compute() runs the computation at most once per key: concurrent callers
+    asking for a key that is already being computed wait on the same Future
+    instead of repeating the work. Failed computations are not cached.
+    """
+
+    def __init__(self, max_entries: int = 32, name: str = "results"):
+        self.name = name
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                self.misses += 1
+                future = Future()
+                self._in_flight[key] = future
+            else:
+                # Someone else is computing it; counts as a hit on the shared result
+                self.hits += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = compute()
+        except BaseException as e:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            # A clear() while computing drops the in-flight entry; don't cache stale results then
+            if self._in_flight.pop(key, None) is future:
+                self._store(key, value)
+        future.set_result(value)
+        return value
+
+    def _store(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        """Look up a key without computing it (for callers that can't block, e.g. async handlers)."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._store(key, value)
+
+    def invalidate(self, predicate=None):
+        """Drop every entry, or only those whose key matches predicate(key)."""
+        with self._lock:
+            if predicate is None:
+                self._entries.clear()
+                self._in_flight.clear()
+                return
+            for key in [k for k in self._entries if predicate(k)]:
+                del self._entries[key]
+            for key in [k for k in self._in_flight if predicate(k)]:
+                del self._in_flight[key]
+
+    def clear(self):
+        self.invalidate()
+
+    def drop_version(self, version):
+        """Drop results computed from one dataset version; keys are (kind, version, ...) tuples."""
+        self.invalidate(lambda key: key[1] == version)
+
+    def entries(self, version):
+        """(key, value) for every result cached for one dataset version."""
+        with self._lock:
+            return [(k, v) for k, v in self._entries.items() if k[1] == version]
+
+    def carry_over(self, version, new_version, keep=None):
+        """
+        Also cache the results of version under new_version, for those whose key passes
+        keep(key) (all if None): results a version change doesn't affect. Returns how many.
+        """
+        with self._lock:
+            carried = [((k[0], new_version) + k[2:], v) for k, v in self._entries.items()
+                       if k[1] == version and (keep is None or keep(k))]
+            for key, value in carried:
+                self._store(key, value)
+        return len(carried)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "in_flight": len(self._in_flight),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+from app.services.data_loader import DATA_DIR
+from app.services.result_cache import ResultCache
+
+# Precomputed results, one directory per dataset version: <root>/<dataset>/<version>/
+STORE_DIR = os.environ.get("OMICS_RESULT_STORE", os.path.join(DATA_DIR, ".omics_results"))
+
+# Bump when the on-disk layout or the key derivation changes; older stores are then ignored
+STORE_FORMAT_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+
+def _canonical(value):
+    # Query parameters arrive as 10.0 where the defaults say 10; both must give the same key
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in value.items()}
+    if isinstance(value, np.generic):
+        return _canonical(value.item())
+    return value
+
+
+def result_key(analysis: str, params: dict):
+    """Directory name of a result: a hash of the analysis and its full parameter set."""
+    payload = json.dumps([STORE_FORMAT_VERSION, analysis, _canonical(params)], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()[:16]
+
+
+def _write_table(path: str, df: pd.DataFrame):
+    # Parquet only (pyarrow is a requirement): the store never holds anything that runs code when read.
+    # Tables Parquet can't hold (non-string column names, mixed-type columns) fail their stage instead.
+    df.to_parquet(path + '.parquet')
+    return os.path.basename(path) + '.parquet'
+
+
+def write_result(out_dir: str, result):
+    """
+    Write an analysis result (nested dicts/lists holding DataFrames, Series, arrays and
+    plain values) to out_dir: tables as Parquet files, arrays as .npy, and the rest as
+    result.json with references to them.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    counter = iter(range(1 << 30))
+
+    def encode(value):
+        if isinstance(value, pd.DataFrame):
+            return {"__table__": _write_table(os.path.join(out_dir, f"t{next(counter)}"), value)}
+        if isinstance(value, pd.Series):
+            name = value.name
+            return {"__series__": _write_table(os.path.join(out_dir, f"t{next(counter)}"), value.to_frame('values')),
+                    "name": name.item() if isinstance(name, np.generic) else name}
+        if isinstance(value, np.ndarray):
+            name = f"a{next(counter)}.npy"
+            np.save(os.path.join(out_dir, name), value, allow_pickle=False)
+            return {"__array__": name}
+        if isinstance(value, dict):
+            return {str(k): encode(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [encode(v) for v in value]
+        if isinstance(value, np.generic):
+            return value.item()
+        return value
+
+    with open(os.path.join(out_dir, "result.json"), "w") as f:
+        json.dump(encode(result), f)
+
+
+def read_result(entry_dir: str):
+    """Read a result written by write_result."""
+    def table(name):
+        # Anything else (e.g. a pickle dropped into the store) is refused, not loaded
+        if not name.endswith('.parquet') or os.path.basename(name) != name:
+            raise ValueError(f"Not a Parquet table: {name}")
+        return pd.read_parquet(os.path.join(entry_dir, name))
+
+    def decode(value):
+        if isinstance(value, dict):
+            if "__table__" in value:
+                return table(value["__table__"])
+            if "__series__" in value:
+                return table(value["__series__"])['values'].rename(value["name"])
+            if "__array__" in value:
+                return np.load(os.path.join(entry_dir, value["__array__"]), allow_pickle=False)
+            return {k: decode(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [decode(v) for v in value]
+        return value
+
+    with open(os.path.join(entry_dir, "result.json")) as f:
+        return decode(json.load(f))
+
+
+class ResultStore:
+    """
+    Analysis results precomputed by the batch pipeline (backend/pipeline.py), by dataset
+    version. A version's directory is written under a temporary name and renamed into
+    place once every stage has finished, so readers see all of a run or none of it.
+
+    get() only answers for the exact version and parameters a result was computed
+    with; anything else is a miss and the caller computes it live.
+    """
+
+    def __init__(self, root: str = STORE_DIR, max_cached: int = 32):
+        self.root = root
+        # Off in the pipeline's own workers, which must compute rather than read back
+        self.serving = True
+        self._indexes = {}
+        self._lock = threading.Lock()
+        # Recently read results, so repeat requests skip the disk
+        self._results = ResultCache(max_entries=max_cached, name="stored_results")
+
+    def version_dir(self, dataset: str, version: str):
+        return os.path.join(self.root, dataset, version)
+
+    def index(self, dataset: str, version: str):
+        """A published version's index, or None. Re-read when the pipeline republishes it."""
+        path = os.path.join(self.version_dir(dataset, version), "index.json")
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        with self._lock:
+            cached = self._indexes.get((dataset, version))
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        try:
+            with open(path) as f:
+                index = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("Unreadable result store index %s: %s", path, e)
+            return None
+        if index.get("format") != STORE_FORMAT_VERSION:
+            index = None
+        with self._lock:
+            self._indexes[(dataset, version)] = (mtime, index)
+        return index
+
+    def get(self, dataset: str, version: str, analysis: str, params: dict):
+        """The stored result for analysis(**params) on this dataset version, or None."""
+        if not self.serving or version is None:
+            return None
+        index = self.index(dataset, version)
+        key = result_key(analysis, params)
+        if index is None or key not in index["results"]:
+            return None
+        entry_dir = os.path.join(self.version_dir(dataset, version), key)
+        try:
+            # (kind, version, ...) keys, like the other caches
+            return self._results.get_or_compute((analysis, version, dataset, key), lambda: read_result(entry_dir))
+        except (OSError, ValueError) as e:
+            # Pruned or republished underneath us; computing live is always correct
+            logger.warning("Could not read stored result %s: %s", entry_dir, e)
+            return None
+
+    def versions(self, dataset: str):
+        """Published versions of a dataset, newest first."""
+        base = os.path.join(self.root, dataset)
+        try:
+            entries = [e for e in os.listdir(base) if not e.startswith('.')]
+        except OSError:
+            return []
+        entries = [e for e in entries if os.path.isfile(os.path.join(base, e, "index.json"))]
+        return sorted(entries, key=lambda e: os.path.getmtime(os.path.join(base, e, "index.json")), reverse=True)
+
+    def stats(self):
+        return self._results.stats()
+
+    def begin(self, dataset: str, version: str, reuse: bool = True):
+        """
+        Start writing a version: returns (staging directory, index). With reuse, results
+        already published for this version are carried over, so a rerun only computes
+        what is missing.
+        """
+        base = os.path.join(self.root, dataset)
+        os.makedirs(base, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=f".{version}-", dir=base)
+        published = self.index(dataset, version) if reuse else None
+        if published is not None:
+            shutil.copytree(self.version_dir(dataset, version), staging, dirs_exist_ok=True)
+            index = dict(published, results=dict(published["results"]))
+        else:
+            index = {"format": STORE_FORMAT_VERSION, "dataset": dataset, "version": version, "results": {}}
+        index["failed"] = {}
+        return staging, index
+
+    def publish(self, staging: str, index: dict, keep: int = 3):
+        """Move a staging directory into place as its version, then prune all but the newest `keep` versions."""
+        dataset, version = index["dataset"], index["version"]
+        index["published_at"] = time.time()
+        with open(os.path.join(staging, "index.json"), "w") as f:
+            json.dump(index, f, indent=1)
+        final_dir = self.version_dir(dataset, version)
+        if os.path.isdir(final_dir):
+            retired = tempfile.mkdtemp(prefix=f".{version}-old-", dir=os.path.dirname(final_dir))
+            os.rename(final_dir, os.path.join(retired, version))
+            os.rename(staging, final_dir)
+            shutil.rmtree(retired, ignore_errors=True)
+        else:
+            os.rename(staging, final_dir)
+
+        for old in self.versions(dataset)[keep:]:
+            if old != version:
+                shutil.rmtree(self.version_dir(dataset, old), ignore_errors=True)
+        return final_dir
+
+    def discard(self, staging: str):
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+result_store = ResultStore()
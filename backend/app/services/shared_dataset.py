@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+# Bump when the layout changes so workers never attach to a segment they'd misread.
+SHARED_FORMAT_VERSION = 1
+HEADER = "header.json"
+# Per-version directories of lease files, one per process mapping that version
+LEASES = ".leases"
+
+
+def default_shared_dir(cache_root: str, name: str):
+    """
+    Where one dataset's published matrices live. /dev/shm is RAM-backed, so every
+    process that maps a file there shares the same physical pages; elsewhere fall
+    back to the disk cache, which the page cache shares just the same. Each dataset
+    gets its own directory, so pruning one's stale versions never touches another's.
+    """
+    if os.environ.get("OMICS_SHARED_DIR"):
+        return os.path.join(os.environ["OMICS_SHARED_DIR"], name)
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        tag = hashlib.sha1(os.path.abspath(cache_root).encode()).hexdigest()[:12]
+        return os.path.join("/dev/shm", f"omics-{tag}", name)
+    # Dot-prefixed so dataset_cache's stale-key cleanup leaves it alone
+    return os.path.join(cache_root, ".shared")
+
+
+def publish(shared_root: str, version: str, arrays: dict, labels: dict = None):
+    """
+    Write named ndarrays to shared_root/<version> as raw .npy files plus a header
+    holding the dataset version, each array's dtype/shape and the label lists
+    (gene names, sample IDs, taxa) needed to rebuild DataFrames around them.
+    The directory is built under a temporary name and renamed into place.
+    """
+    os.makedirs(shared_root, exist_ok=True)
+    final_dir = os.path.join(shared_root, version)
+    if os.path.exists(os.path.join(final_dir, HEADER)):
+        return final_dir
+
+    tmp_dir = tempfile.mkdtemp(prefix=f".{version}-", dir=shared_root)
+    try:
+        header = {
+            'format': SHARED_FORMAT_VERSION,
+            'version': version,
+            'created_at': time.time(),
+            'pid': os.getpid(),
+            'arrays': {},
+            'labels': {name: [str(x) for x in values] for name, values in (labels or {}).items()},
+        }
+        for name, values in arrays.items():
+            values = np.asarray(values)
+            if not (values.flags.c_contiguous or values.flags.f_contiguous):
+                values = np.ascontiguousarray(values)
+            # .npy keeps Fortran order, so frames map back with pandas' native column-major layout
+            fname = f"{len(header['arrays'])}.npy"
+            np.save(os.path.join(tmp_dir, fname), values)
+            header['arrays'][name] = {'file': fname, 'dtype': values.dtype.str, 'shape': list(values.shape)}
+        # Header last: its presence marks the segment complete
+        with open(os.path.join(tmp_dir, HEADER), "w") as f:
+            json.dump(header, f)
+        try:
+            os.rename(tmp_dir, final_dir)
+        except OSError:
+            # Another process published the same version first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return final_dir
+
+
+def attach(shared_root: str, version: str):
+    """
+    Map a published version read-only. Returns (arrays, labels, header), or None if
+    that version hasn't been published. No array data is copied into the process.
+    """
+    seg_dir = os.path.join(shared_root, version)
+    try:
+        with open(os.path.join(seg_dir, HEADER)) as f:
+            header = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if header.get('format') != SHARED_FORMAT_VERSION or header.get('version') != version:
+        return None
+
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        arr = np.load(os.path.join(seg_dir, spec['file']), mmap_mode='r')
+        if arr.dtype.str != spec['dtype'] or list(arr.shape) != spec['shape']:
+            return None
+        arrays[name] = arr
+    return arrays, header['labels'], header
+
+
+def drop_stale(shared_root: str, keep: str):
+    """
+    Remove published versions other than keep. Processes still mapping an old
+    version keep their pages until they reload; unlinking doesn't invalidate maps.
+    """
+    if not os.path.isdir(shared_root):
+        return
+    for entry in os.listdir(shared_root):
+        if entry != keep and not entry.startswith('.'):
+            shutil.rmtree(os.path.join(shared_root, entry), ignore_errors=True)
+            shutil.rmtree(os.path.join(shared_root, LEASES, entry), ignore_errors=True)
+
+
+def unpublish(shared_root: str, version: str):
+    """
+    Remove one published version, e.g. for a dataset that was unloaded. /dev/shm
+    frees the pages once the last process mapping them lets go.
+    """
+    shutil.rmtree(os.path.join(shared_root, version), ignore_errors=True)
+    shutil.rmtree(os.path.join(shared_root, LEASES, version), ignore_errors=True)
+
+
+def _alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def lease(shared_root: str, version: str):
+    """Record that this process maps a version, so another one unloading it leaves it published."""
+    lease_dir = os.path.join(shared_root, LEASES, version)
+    os.makedirs(lease_dir, exist_ok=True)
+    open(os.path.join(lease_dir, str(os.getpid())), "w").close()
+
+
+def release(shared_root: str, version: str):
+    """
+    Drop this process's lease on a version, and those of processes that have exited.
+    Returns True if no live process holds one any more, i.e. it's safe to unpublish.
+    Callers hold the dataset's build lock so no one attaches in between.
+    """
+    lease_dir = os.path.join(shared_root, LEASES, version)
+    try:
+        os.remove(os.path.join(lease_dir, str(os.getpid())))
+    except FileNotFoundError:
+        pass
+    try:
+        entries = os.listdir(lease_dir)
+    except FileNotFoundError:
+        return True
+    held = False
+    for entry in entries:
+        if entry.isdigit() and _alive(int(entry)):
+            held = True
+        else:
+            try:
+                os.remove(os.path.join(lease_dir, entry))
+            except OSError:
+                pass
+    return not held
@@ -0,0 +1,284 @@
+import numpy as np
+import pandas as pd
+from app.services.tracing import span
+
+# Candidate numbers of features kept per component when none are given
+DEFAULT_KEEP_GENES = (10, 25, 50, 100, 250)
+DEFAULT_KEEP_TAXA = (5, 10, 25, 50)
+
+# Most genes the API lets the variance pre-screen keep; every CV fit is O(samples x genes)
+MAX_SCREENED_GENES = 20000
+
+
+def _soft_keep(w: np.ndarray, keep: int):
+    """
+    L1 soft-thresholding (as in mixOmics' sPLS): shrink every entry by the
+    (keep+1)-th largest magnitude, which leaves exactly the keep largest non-zero.
+    """
+    if keep is None or keep >= w.size:
+        return w
+    lam = np.partition(np.abs(w), w.size - keep - 1)[w.size - keep - 1]
+    # sign(w) * max(|w| - lam, 0)
+    return w - np.clip(w, -lam, lam)
+
+
+def _unit(w: np.ndarray):
+    norm = np.sqrt(w @ w)
+    return w / norm if norm > 0 else w
+
+
+def _leading_pair(X: np.ndarray, Y: np.ndarray, rng, n_oversamples: int = 8, n_iter: int = 4):
+    """
+    Leading left/right singular vectors of M = X.T @ Y by randomized SVD (Halko et
+    al.). M is only ever applied through X and Y, so the genes x taxa
+    cross-product is never formed; memory stays O((genes + taxa) * k).
+    """
+    k = min(1 + n_oversamples, X.shape[1], Y.shape[1])
+    Z = X.T @ (Y @ rng.standard_normal((Y.shape[1], k)))
+    for _ in range(n_iter):
+        Z, _ = np.linalg.qr(Z)
+        Z = X.T @ (Y @ (Y.T @ (X @ Z)))
+    Q, _ = np.linalg.qr(Z)
+    B = (X @ Q).T @ Y  # k x taxa
+    Ub, _, Vt = np.linalg.svd(B, full_matrices=False)
+    return Q @ Ub[:, 0], Vt[0]
+
+
+def _standardize(train: np.ndarray, test: np.ndarray = None):
+    """Center and scale columns on the training rows; constant columns are left at zero."""
+    mean = train.mean(axis=0)
+    std = train.std(axis=0, ddof=1) if train.shape[0] > 1 else np.ones(train.shape[1])
+    std[~(std > 0)] = 1.0
+    scaled = (train - mean) / std
+    return scaled if test is None else (scaled, (test - mean) / std)
+
+
+def _component(X: np.ndarray, Y: np.ndarray, keep_x: int, keep_y: int, v: np.ndarray, max_iter: int = 100, tol: float = 1e-6):
+    """
+    Weights of one sparse component: alternate soft-thresholded updates of the
+    gene and taxon weights from the starting taxon weights v until they settle.
+    """
+    u = np.zeros(X.shape[1])
+    for _ in range(max_iter):
+        u_new = _unit(_soft_keep(X.T @ (Y @ v), keep_x))
+        v_new = _unit(_soft_keep(Y.T @ (X @ u_new), keep_y))
+        du, dv = u_new - u, v_new - v
+        delta = np.sqrt(du @ du) + np.sqrt(dv @ dv)
+        u, v = u_new, v_new
+        if delta < tol:
+            break
+    # Sign convention: largest gene weight positive
+    if u[np.argmax(np.abs(u))] < 0:
+        u, v = -u, -v
+    return u, v
+
+
+def _fit(X: np.ndarray, Y: np.ndarray, keep_x, keep_y, seed=0):
+    """
+    Canonical-mode sparse PLS on standardized X (n x genes) and Y (n x taxa).
+    keep_x/keep_y: features kept per component. Each component starts from the
+    leading singular pair of the deflated X'Y; both blocks are deflated on their
+    own scores afterwards.
+
+    Returns (U, V, C, D, X_resid, Y_resid): weights, deflation loadings and the
+    deflated matrices, so further components can be fitted from where this stopped.
+    """
+    rng = np.random.default_rng(seed)
+    X, Y = X.copy(), Y.copy()
+    U, V, C, D = [], [], [], []
+    for kx, ky in zip(keep_x, keep_y):
+        u, v = _component(X, Y, kx, ky, _leading_pair(X, Y, rng)[1])
+        t, s = X @ u, Y @ v
+        tt, ss = t @ t, s @ s
+        c = X.T @ t / tt if tt > 0 else np.zeros(X.shape[1])
+        d = Y.T @ s / ss if ss > 0 else np.zeros(Y.shape[1])
+        X -= np.outer(t, c)
+        Y -= np.outer(s, d)
+        U.append(u), V.append(v), C.append(c), D.append(d)
+    empty = lambda m: np.empty((m.shape[1], 0))
+    stack = lambda cols, m: np.column_stack(cols) if cols else empty(m)
+    return stack(U, X), stack(V, Y), stack(C, X), stack(D, Y), X, Y
+
+
+def _scores(X: np.ndarray, W: np.ndarray, P: np.ndarray):
+    """Scores of new rows for a fitted block: project on each weight vector, deflating as in the fit."""
+    X = X.copy()
+    T = np.empty((X.shape[0], W.shape[1]))
+    for h in range(W.shape[1]):
+        T[:, h] = X @ W[:, h]
+        X -= np.outer(T[:, h], P[:, h])
+    return T, X
+
+
+def _correlation(a: np.ndarray, b: np.ndarray):
+    a, b = a - a.mean(), b - b.mean()
+    denom = np.sqrt((a @ a) * (b @ b))
+    return float(a @ b / denom) if denom > 0 else 0.0
+
+
+def _cv_fold(X: np.ndarray, Y: np.ndarray, train: np.ndarray, test: np.ndarray, keep_x, keep_y, grid, seed):
+    """
+    One CV fold for the next component: with the earlier components fixed at their
+    chosen sparsity, fit the next one for every (keep_x, keep_y) in grid on the
+    training rows and score it by the correlation of the held-out gene and taxon scores.
+    """
+    X_train, X_test = _standardize(X[train], X[test])
+    Y_train, Y_test = _standardize(Y[train], Y[test])
+    U, V, C, D, X_resid, Y_resid = _fit(X_train, Y_train, keep_x, keep_y, seed)
+    _, X_test = _scores(X_test, U, C)
+    _, Y_test = _scores(Y_test, V, D)
+    # The starting point depends only on the deflated matrices, so it is shared by the grid
+    v0 = _leading_pair(X_resid, Y_resid, np.random.default_rng(seed))[1]
+    out = np.empty(len(grid))
+    for i, (kx, ky) in enumerate(grid):
+        u, v = _component(X_resid, Y_resid, kx, ky, v0)
+        out[i] = _correlation(X_test @ u, Y_test @ v)
+    return out
+
+
+def _cv_splits(n_samples: int, folds: int, repeats: int, seed):
+    """(train, test) index pairs for repeated K-fold, each with its own child seed."""
+    seeds = np.random.SeedSequence(seed).spawn(repeats)
+    splits = []
+    for ss in seeds:
+        order = np.random.default_rng(ss).permutation(n_samples)
+        for test in np.array_split(order, folds):
+            splits.append((np.setdiff1d(order, test), np.sort(test), ss.generate_state(1)[0]))
+    return splits
+
+
+def _run_folds(X: np.ndarray, Y: np.ndarray, splits, keep_x, keep_y, grid, n_jobs=None):
+    # Only worth the process start-up cost when the folds are big
+    work = len(splits) * len(grid) * X.shape[0] * (X.shape[1] + Y.shape[1])
+    if n_jobs == 1 or len(splits) == 1 or work < 5e8:
+        return np.array([_cv_fold(X, Y, train, test, keep_x, keep_y, grid, seed) for train, test, seed in splits])
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = [pool.submit(_cv_fold, X, Y, train, test, keep_x, keep_y, grid, seed) for train, test, seed in splits]
+        return np.array([f.result() for f in futures])
+
+
+def _screen(df: pd.DataFrame, max_features: int = None):
+    """Samples x features frame reduced to its max_features highest-variance, non-constant columns."""
+    var = df.var(axis=0).fillna(0.0)
+    var = var[var > 0].sort_values(ascending=False, kind='stable')
+    if max_features is not None:
+        var = var.head(max_features)
+    return df[var.index]
+
+
+def clr(abundance: pd.DataFrame, pseudocount: float = 1.0):
+    """Centred log-ratio of a Taxa x Samples count matrix, per sample."""
+    L = np.log(abundance.to_numpy(dtype=np.float64) + pseudocount)
+    return pd.DataFrame(L - L.mean(axis=0, keepdims=True), index=abundance.index, columns=abundance.columns)
+
+
+def _candidates(values, n_features: int, defaults):
+    values = sorted({int(v) for v in (values or defaults)})
+    if values[0] < 1:
+        # Dropping them would fall back to every feature, i.e. no sparsity at all
+        raise ValueError(f"Numbers of selected features must be at least 1, got {values[0]}")
+    return sorted({min(v, n_features) for v in values})
+
+
+def perform_spls_integration(transcriptomics: pd.DataFrame, taxa_abundance: pd.DataFrame, n_components: int = None,
+                             max_components: int = 3, keep_genes=None, keep_taxa=None, max_genes: int = 5000,
+                             max_taxa: int = 1000, folds: int = 4, repeats: int = 3, min_cv_correlation: float = 0.5,
+                             taxa_transform: str = 'clr', seed=42, n_jobs=None):
+    """
+    Sparse PLS (canonical mode, as mixOmics' spls) between genes and taxa.
+    transcriptomics: Genes x Samples, ideally log-CPM; taxa_abundance: Taxa x Samples counts.
+
+    Genes and taxa are first pre-screened to the max_genes / max_taxa most variable.
+    keep_genes / keep_taxa are candidate numbers of features with non-zero weight
+    per component; when there is more than one candidate, or n_components is not
+    given, they are chosen by repeated K-fold CV one component at a time. The
+    score for a candidate is the mean correlation between held-out gene and taxon
+    scores. Components are added while the best held-out correlation reaches
+    min_cv_correlation, up to max_components. Folds run in a process pool when
+    the problem is large enough to pay for it.
+
+    Returns a dict with 'scores' (Samples x comp{i}_x/comp{i}_y), 'gene_loadings'
+    and 'taxa_loadings' (selected features x comp{i}, zero where a feature was not
+    selected for that component), 'selected' per component, 'correlations' (score
+    correlation per component on all samples), 'params' and 'cv'.
+    Returns None if fewer than 5 samples are shared.
+    """
+    common = transcriptomics.columns.intersection(taxa_abundance.columns)
+    if len(common) < 5:
+        return None
+
+    with span("spls.screen"):
+        Y_df = clr(taxa_abundance[common]) if taxa_transform == 'clr' else taxa_abundance[common].astype(np.float64)
+        X_df = _screen(transcriptomics[common].T, max_genes)
+        Y_df = _screen(Y_df.T, max_taxa)
+        X, Y = X_df.to_numpy(dtype=np.float64), Y_df.to_numpy(dtype=np.float64)
+    n, p, q = X.shape[0], X.shape[1], Y.shape[1]
+    if p == 0 or q == 0:
+        raise ValueError("No variable genes or taxa across the shared samples")
+
+    gene_grid = _candidates(keep_genes, p, DEFAULT_KEEP_GENES)
+    taxa_grid = _candidates(keep_taxa, q, DEFAULT_KEEP_TAXA)
+    grid = [(kx, ky) for kx in gene_grid for ky in taxa_grid]
+    max_h = min(n_components or max_components, n - 1, p, q)
+    folds = max(2, min(folds, n // 2))
+
+    keep_x, keep_y, cv = [], [], None
+    if len(grid) == 1 and n_components is not None:
+        keep_x, keep_y = [gene_grid[0]] * max_h, [taxa_grid[0]] * max_h
+    else:
+        with span("spls.cv", folds=folds, repeats=repeats, candidates=len(grid)):
+            splits = _cv_splits(n, folds, repeats, seed)
+            cv = {'folds': folds, 'repeats': repeats, 'components': []}
+            for h in range(max_h):
+                scores = _run_folds(X, Y, splits, keep_x, keep_y, grid, n_jobs=n_jobs)
+                mean, sd = scores.mean(axis=0), scores.std(axis=0, ddof=1)
+                best = int(np.argmax(mean))
+                cv['components'].append({
+                    'component': h + 1,
+                    'best': {'keep_genes': grid[best][0], 'keep_taxa': grid[best][1], 'correlation': float(mean[best])},
+                    'grid': [{'keep_genes': kx, 'keep_taxa': ky, 'correlation': float(m), 'sd': float(s)}
+                             for (kx, ky), m, s in zip(grid, mean, sd)],
+                })
+                # An explicit n_components is kept; otherwise stop at the first component that doesn't generalize
+                if n_components is None and h > 0 and mean[best] < min_cv_correlation:
+                    break
+                keep_x.append(grid[best][0])
+                keep_y.append(grid[best][1])
+
+    with span("spls.fit", genes=p, taxa=q, components=len(keep_x)):
+        U, V, C, D, _, _ = _fit(_standardize(X), _standardize(Y), keep_x, keep_y, seed)
+        T, _ = _scores(_standardize(X), U, C)
+        S, _ = _scores(_standardize(Y), V, D)
+
+    comps = [f'comp{h + 1}' for h in range(U.shape[1])]
+    scores = pd.DataFrame(index=common)
+    for h, comp in enumerate(comps):
+        scores[f'{comp}_x'] = T[:, h]
+        scores[f'{comp}_y'] = S[:, h]
+
+    def loadings(W, labels):
+        df = pd.DataFrame(W, index=labels, columns=comps)
+        return df[(df != 0).any(axis=1)]
+
+    def selected(W, labels):
+        out = []
+        for h in range(W.shape[1]):
+            nz = np.nonzero(W[:, h])[0]
+            nz = nz[np.argsort(-np.abs(W[nz, h]), kind='stable')]
+            out.append([{'feature': str(labels[i]), 'loading': float(W[i, h])} for i in nz])
+        return out
+
+    return {
+        'scores': scores,
+        'gene_loadings': loadings(U, X_df.columns),
+        'taxa_loadings': loadings(V, Y_df.columns),
+        'selected': {'genes': selected(U, X_df.columns), 'taxa': selected(V, Y_df.columns)},
+        'correlations': [_correlation(T[:, h], S[:, h]) for h in range(T.shape[1])],
+        'params': {
+            'n_components': len(comps), 'keep_genes': keep_x, 'keep_taxa': keep_y,
+            'n_samples': n, 'genes_screened': p, 'genes_total': int(transcriptomics.shape[0]),
+            'taxa_screened': q, 'taxa_total': int(taxa_abundance.shape[0]), 'taxa_transform': taxa_transform,
+        },
+        'cv': cv,
+    }
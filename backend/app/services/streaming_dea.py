@@ -0,0 +1,114 @@
+import os
+import numpy as np
+import pandas as pd
+from app.services.analysis import GroupStatistics, _group_block_stats, _pair_cutoffs
+
+# Default working-set budget for one chunk of the count matrix
+DEFAULT_MEMORY_BUDGET_MB = float(os.environ.get("OMICS_DEA_MEMORY_MB", 256))
+
+# Float64 copies of a chunk alive at once while parsing and computing log-CPM and the
+# per-group deviations (parser buffer, counts, log-CPM, centered values, CPM mask)
+_COPIES_PER_CHUNK = 6
+
+
+def count_file_samples(path: str, sep: str = '\t'):
+    """Sample columns of a Genes x Samples count file, from its header alone."""
+    return pd.read_csv(path, sep=sep, index_col=0, nrows=0).columns
+
+
+def rows_per_chunk(n_samples: int, memory_budget_mb: float = None):
+    """How many gene rows of n_samples columns fit the memory budget."""
+    budget = (memory_budget_mb or DEFAULT_MEMORY_BUDGET_MB) * 1024 ** 2
+    return max(1, int(budget // (max(n_samples, 1) * 8 * _COPIES_PER_CHUNK)))
+
+
+def iter_count_chunks(path: str, samples=None, chunk_rows: int = 10000, sep: str = '\t'):
+    """
+    Yield the count file as Genes x Samples DataFrames of at most chunk_rows genes,
+    reading only the requested sample columns.
+    """
+    usecols = None
+    if samples is not None:
+        header = pd.read_csv(path, sep=sep, nrows=0).columns
+        wanted = set(samples)
+        # Positions rather than names: the index column's header is usually blank
+        usecols = [0] + [i for i, c in enumerate(header) if i > 0 and c in wanted]
+    reader = pd.read_csv(path, sep=sep, index_col=0, usecols=usecols, chunksize=chunk_rows)
+    with reader:
+        for chunk in reader:
+            yield chunk if samples is None else chunk[list(samples)]
+
+
+def library_sizes(path: str, samples=None, chunk_rows: int = 10000, sep: str = '\t'):
+    """Pass 1: total counts per sample, summed chunk by chunk."""
+    totals = None
+    for chunk in iter_count_chunks(path, samples, chunk_rows, sep):
+        part = chunk.to_numpy().sum(axis=0, dtype=np.float64)
+        totals = part if totals is None else totals + part
+    columns = samples if samples is not None else count_file_samples(path, sep)
+    return pd.Series(totals if totals is not None else 0.0, index=pd.Index(columns), dtype=np.float64)
+
+
+def _streaming_group_statistics(path: str, sample_groups: dict, min_count: float = 10,
+                                memory_budget_mb: float = None, sep: str = '\t'):
+    # streaming_group_statistics(), plus how many genes each chunk of the second pass held
+    groups = list(sample_groups)
+    samples = list(dict.fromkeys(s for g in groups for s in sample_groups[g]))
+    available = set(count_file_samples(path, sep))
+    missing = [s for s in samples if s not in available]
+    if missing:
+        raise ValueError(f"Samples not in count file: {', '.join(missing[:10])}")
+
+    chunk_rows = rows_per_chunk(len(samples), memory_budget_mb)
+    lib_sizes = library_sizes(path, samples, chunk_rows, sep).to_numpy()
+
+    columns = pd.Index(samples)
+    idx = [columns.get_indexer(sample_groups[g]) for g in groups]
+    # Same cutoffs as the in-memory GroupStatistics: per pair of groups, from their library sizes
+    cutoffs = _pair_cutoffs(lib_sizes, idx, min_count)
+
+    genes, blocks = [], []
+    for chunk in iter_count_chunks(path, samples, chunk_rows, sep):
+        raw = chunk.to_numpy()
+        values = np.log2(raw / lib_sizes * 1e6 + 1)
+        blocks.append(_group_block_stats(raw, values, lib_sizes, idx, cutoffs))
+        genes.append(chunk.index.to_numpy())
+    sizes = [len(g) for g in genes]
+    genes = np.concatenate(genes) if genes else np.array([], dtype=object)
+    return GroupStatistics.from_blocks(genes, sample_groups, min_count, blocks), sizes
+
+
+def streaming_group_statistics(path: str, sample_groups: dict, min_count: float = 10,
+                               memory_budget_mb: float = None, sep: str = '\t'):
+    """
+    GroupStatistics for a count file too large to load, in two passes over it:
+    library sizes first, then log-CPM and the per-group sums chunk by chunk.
+    Only one chunk of the matrix is held at a time; what is kept is O(genes x groups^2).
+    """
+    return _streaming_group_statistics(path, sample_groups, min_count, memory_budget_mb, sep)[0]
+
+
+def iter_streaming_dea(path: str, groups: dict, method: str = 'welch', min_count: float = 10,
+                       memory_budget_mb: float = None, sep: str = '\t'):
+    """
+    Out-of-core two-group DEA on a count file, yielded as one result DataFrame per
+    chunk of the second pass, in file order; together they are streaming_dea().
+
+    The BH adjustment (and the moderated test's prior) need every gene, so the first
+    block comes once the second pass has read the file; until then only the per-gene
+    sums are held, and the full result table is never built.
+    groups: {'group1': [col1, ...], 'group2': [col3, ...]}
+    """
+    stats, sizes = _streaming_group_statistics(path, groups, min_count=min_count, memory_budget_mb=memory_budget_mb, sep=sep)
+    yield from stats.iter_contrast('group1', 'group2', method=method, block_sizes=sizes)
+
+
+def streaming_dea(path: str, groups: dict, method: str = 'welch', min_count: float = 10,
+                  memory_budget_mb: float = None, sep: str = '\t'):
+    """
+    Out-of-core two-group DEA on a count file; same output as DEA_METHODS[method]
+    run on the loaded matrix.
+    groups: {'group1': [col1, ...], 'group2': [col3, ...]}
+    """
+    stats = streaming_group_statistics(path, groups, min_count=min_count, memory_budget_mb=memory_budget_mb, sep=sep)
+    return stats.contrast('group1', 'group2', method=method)
@@ -0,0 +1,214 @@
+import pandas as pd
+import numpy as np
+from app.services.tracing import span
+
+RANKS = ['Kingdom', 'Phylum', 'Class', 'Order', 'Family', 'Genus', 'Species']
+
+# Store a rank as CSR when fewer than this fraction of (taxon, sample) cells are non-zero.
+SPARSE_DENSITY_THRESHOLD = 0.5
+
+
+def _recode(codes, rows):
+    # Long-format row codes mapped through rows (old code -> merged position); -1 stays -1
+    codes = np.asarray(codes)
+    if not len(rows):
+        return np.full(len(codes), -1, dtype=np.int32)
+    return np.where(codes >= 0, rows[np.maximum(codes, 0)], -1).astype(np.int32)
+
+
+class TaxonomyMatrix:
+    """
+    Taxa x Samples abundance matrices for every taxonomic rank, built once from the
+    long-format metagenomics table (Sample, Abundance, Kingdom ... Species).
+
+    Lineage strings are kept as categorical codes; each rank's matrix is the
+    equivalent of pivot_table(index=rank, columns='Sample', aggfunc='sum').fillna(0).
+    """
+
+    def __init__(self, samples, categories: dict, codes: dict, matrices: dict, sample_totals: np.ndarray):
+        self.samples = pd.Index(samples, name='Sample')
+        self.categories = categories    # rank -> pd.Index of taxon labels
+        self.codes = codes              # rank -> int32 code per long-format row (-1 = unclassified)
+        self._matrices = matrices       # rank -> ndarray or csr_matrix, taxa x samples
+        self.sample_totals = pd.Series(sample_totals, index=self.samples)
+        self._dense = {}
+        self._relative = {}
+
+    @classmethod
+    def from_long(cls, df: pd.DataFrame):
+        from scipy import sparse
+        sample_cat = pd.Categorical(df['Sample'])
+        sample_codes = np.asarray(sample_cat.codes, dtype=np.int32)
+        n_samples = len(sample_cat.categories)
+        abundance = np.asarray(df['Abundance'], dtype=np.float64)
+
+        categories, codes, matrices = {}, {}, {}
+        for rank in RANKS:
+            if rank not in df.columns:
+                continue
+            labels = df[rank]
+            if rank == 'Species' and 'Genus' in df.columns:
+                # The Species column holds only the epithet; qualify it with the genus
+                # so e.g. "Streptococcus pneumoniae" and "Klebsiella pneumoniae" stay apart.
+                genus = df['Genus'].astype(object)
+                species = df['Species'].astype(object)
+                labels = pd.Series(np.where(genus.isna(), species, genus.astype(str) + ' ' + species.astype(str)), index=df.index).where(species.notna())
+            cat = pd.Categorical(labels)
+            rank_codes = np.asarray(cat.codes, dtype=np.int32)
+            n_taxa = len(cat.categories)
+
+            # Rows with no assignment at this rank are left out, as pivot_table does with NaN keys
+            mask = rank_codes >= 0
+            mat = sparse.coo_matrix(
+                (abundance[mask], (rank_codes[mask], sample_codes[mask])),
+                shape=(n_taxa, n_samples)
+            ).tocsr()
+            mat.sum_duplicates()
+            density = mat.nnz / max(n_taxa * n_samples, 1)
+
+            categories[rank] = pd.Index(cat.categories.astype(str), name=rank)
+            codes[rank] = rank_codes
+            matrices[rank] = mat if density < SPARSE_DENSITY_THRESHOLD else mat.toarray()
+
+        sample_totals = np.bincount(sample_codes, weights=abundance, minlength=n_samples)
+        return cls(sample_cat.categories.astype(str), categories, codes, matrices, sample_totals)
+
+    def append(self, df: pd.DataFrame):
+        """
+        A new TaxonomyMatrix with the samples of another long-format table added. Only
+        the new rows are pivoted; the existing matrices are re-indexed into the merged
+        (sorted) taxon and sample order, so the result holds the same values as
+        from_long() on both tables concatenated. Ranks this matrix doesn't have are ignored.
+        """
+        from scipy import sparse
+        added = TaxonomyMatrix.from_long(df)
+        overlap = self.samples.intersection(added.samples)
+        if len(overlap):
+            raise ValueError(f"Samples already present: {', '.join(overlap[:5])}")
+        # Sorted like the categories from_long() would build over the combined table
+        samples = pd.Index(pd.Categorical(self.samples.append(added.samples)).categories.astype(str))
+        old_cols, new_cols = samples.get_indexer(self.samples), samples.get_indexer(added.samples)
+
+        categories, codes, matrices = {}, {}, {}
+        for rank in self.ranks:
+            old_cats = self.categories[rank]
+            new_cats = added.categories.get(rank, pd.Index([], dtype=object))
+            cats = pd.Index(pd.Categorical(old_cats.append(new_cats)).categories.astype(str), name=rank)
+            old_rows, new_rows = cats.get_indexer(old_cats), cats.get_indexer(new_cats)
+
+            new_codes = added.codes.get(rank, np.full(len(df), -1, dtype=np.int32))
+            codes[rank] = np.concatenate([_recode(self.codes[rank], old_rows), _recode(new_codes, new_rows)])
+
+            blocks = [(self._matrices[rank], old_rows, old_cols)]
+            if rank in added._matrices:
+                blocks.append((added._matrices[rank], new_rows, new_cols))
+            shape = (len(cats), len(samples))
+            # A dense rank stays dense: its stored zeros, which from_long() counts, are gone
+            nnz = sum(m.nnz if sparse.issparse(m) else np.count_nonzero(m) for m, _, _ in blocks)
+            if sparse.issparse(self._matrices[rank]) and nnz / max(shape[0] * shape[1], 1) < SPARSE_DENSITY_THRESHOLD:
+                pieces = [sparse.coo_matrix(m) for m, _, _ in blocks]
+                mat = sparse.coo_matrix((
+                    np.concatenate([p.data for p in pieces]),
+                    (np.concatenate([rows[p.row] for p, (_, rows, _) in zip(pieces, blocks)]),
+                     np.concatenate([cols[p.col] for p, (_, _, cols) in zip(pieces, blocks)]))
+                ), shape=shape).tocsr()
+            else:
+                mat = np.zeros(shape)
+                for m, rows, cols in blocks:
+                    mat[np.ix_(rows, cols)] = m.toarray() if sparse.issparse(m) else m
+            categories[rank], matrices[rank] = cats, mat
+
+        totals = np.zeros(len(samples))
+        totals[old_cols] = self.sample_totals.to_numpy()
+        totals[new_cols] = added.sample_totals.to_numpy()
+        return TaxonomyMatrix(samples, categories, codes, matrices, totals)
+
+    def to_arrays(self, prefix: str = "taxonomy"):
+        """
+        Flatten into (arrays, labels) for shared_dataset.publish. Sparse ranks are
+        stored as their CSR components so they stay sparse once attached.
+        """
+        from scipy import sparse
+        arrays = {f"{prefix}/sample_totals": self.sample_totals.to_numpy()}
+        labels = {f"{prefix}/samples": list(self.samples)}
+        for rank in self.ranks:
+            mat = self._matrices[rank]
+            if sparse.issparse(mat):
+                arrays[f"{prefix}/{rank}/data"] = mat.data
+                arrays[f"{prefix}/{rank}/indices"] = mat.indices
+                arrays[f"{prefix}/{rank}/indptr"] = mat.indptr
+            else:
+                arrays[f"{prefix}/{rank}/dense"] = mat
+            arrays[f"{prefix}/{rank}/codes"] = self.codes[rank]
+            labels[f"{prefix}/{rank}"] = list(self.categories[rank])
+        return arrays, labels
+
+    @classmethod
+    def from_arrays(cls, arrays: dict, labels: dict, prefix: str = "taxonomy"):
+        """Rebuild from to_arrays() output (e.g. read-only maps from shared_dataset.attach)."""
+        from scipy import sparse
+        samples = labels[f"{prefix}/samples"]
+        categories, codes, matrices = {}, {}, {}
+        for rank in RANKS:
+            if f"{prefix}/{rank}" not in labels:
+                continue
+            categories[rank] = pd.Index(labels[f"{prefix}/{rank}"], name=rank)
+            codes[rank] = arrays[f"{prefix}/{rank}/codes"]
+            shape = (len(categories[rank]), len(samples))
+            if f"{prefix}/{rank}/dense" in arrays:
+                matrices[rank] = arrays[f"{prefix}/{rank}/dense"]
+            else:
+                matrices[rank] = sparse.csr_matrix(
+                    (arrays[f"{prefix}/{rank}/data"], arrays[f"{prefix}/{rank}/indices"], arrays[f"{prefix}/{rank}/indptr"]),
+                    shape=shape, copy=False
+                )
+        return cls(samples, categories, codes, matrices, arrays[f"{prefix}/sample_totals"])
+
+    @property
+    def ranks(self):
+        return [r for r in RANKS if r in self._matrices]
+
+    def _check_rank(self, rank: str):
+        if rank not in self._matrices:
+            raise KeyError(f"Unknown taxonomic rank '{rank}'. Available: {', '.join(self.ranks)}")
+
+    def is_sparse(self, rank: str):
+        from scipy import sparse
+        self._check_rank(rank)
+        return sparse.issparse(self._matrices[rank])
+
+    def raw(self, rank: str):
+        """Underlying taxa x samples array (ndarray or csr_matrix) for a rank."""
+        self._check_rank(rank)
+        return self._matrices[rank]
+
+    def abundance(self, rank: str = 'Genus'):
+        """Dense Taxa x Samples abundance DataFrame for a rank (cached, do not mutate)."""
+        from scipy import sparse
+        self._check_rank(rank)
+        if rank not in self._dense:
+            with span("pivot", rank=rank):
+                mat = self._matrices[rank]
+                values = mat.toarray() if sparse.issparse(mat) else mat
+                self._dense[rank] = pd.DataFrame(values, index=self.categories[rank], columns=self.samples)
+        return self._dense[rank]
+
+    def rank_totals(self, rank: str = 'Genus'):
+        """Per-sample total of reads classified at this rank."""
+        self._check_rank(rank)
+        totals = np.asarray(self._matrices[rank].sum(axis=0)).ravel()
+        return pd.Series(totals, index=self.samples)
+
+    def relative(self, rank: str = 'Genus'):
+        """Taxa x Samples relative abundance over reads classified at this rank (cached)."""
+        self._check_rank(rank)
+        if rank not in self._relative:
+            totals = self.rank_totals(rank).to_numpy()
+            with np.errstate(invalid='ignore', divide='ignore'):
+                rel = self.abundance(rank).to_numpy() / totals
+            self._relative[rank] = pd.DataFrame(np.nan_to_num(rel), index=self.categories[rank], columns=self.samples)
+        return self._relative[rank]
+
+    def top_taxa(self, rank: str = 'Genus', n: int = 20):
+        """Taxa with the highest mean relative abundance across samples."""
+        return self.relative(rank).mean(axis=1).sort_values(ascending=False).head(n).index
@@ -0,0 +1,260 @@
+import math
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+
+# Seconds; covers sub-millisecond cache hits up to minute-long analyses
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter with labels, in the Prometheus text format."""
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Histogram:
+    """Cumulative-bucket histogram with labels, in the Prometheus text format."""
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(set(buckets) | {math.inf}))
+        # label values -> [per-bucket counts, sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(s[0]), s[1], s[2]) for key, s in self._values.items()}
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield f"{self.name}_bucket", _format_labels(self.labelnames, key, [("le", _format_value(bound))]), cumulative
+            yield f"{self.name}_sum", _format_labels(self.labelnames, key), total
+            yield f"{self.name}_count", _format_labels(self.labelnames, key), count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric '{metric.name}' is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def register_collector(self, collect):
+        """
+        Add a callable read at scrape time, for values that already live elsewhere
+        (cache and job counts). It returns an iterable of
+        (name, type, help, [(labels dict, value), ...]).
+        """
+        with self._lock:
+            self._collectors.append(collect)
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in metric.samples())
+        for collect in collectors:
+            for name, kind, help, samples in collect():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "omics_stage_duration_seconds", "Time spent in an instrumented stage (load, pivot, normalize, test, fit, serialize)", ("stage",)
+))
+STAGE_ERRORS = REGISTRY.register(Counter(
+    "omics_stage_errors_total", "Instrumented stages that raised", ("stage",)
+))
+HTTP_REQUESTS = REGISTRY.register(Counter(
+    "omics_http_requests_total", "HTTP requests by route template and status", ("method", "route", "status")
+))
+HTTP_SECONDS = REGISTRY.register(Histogram(
+    "omics_http_request_duration_seconds", "Time from request to response headers, by route template", ("method", "route")
+))
+
+
+class Trace:
+    """The spans recorded while handling one request or job, in start order."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def to_dict(self):
+        total = time.perf_counter() - self.started
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        stages = {}
+        for s in spans:
+            agg = stages.setdefault(s.name, {"seconds": 0.0, "calls": 0})
+            agg["seconds"] += s.seconds
+            agg["calls"] += 1
+        top_level = sum(s.seconds for s in spans if s.depth == 0)
+        return {
+            "total_seconds": round(total, 6),
+            # Time outside any span: request parsing, validation, FastAPI's JSON encoding
+            "unattributed_seconds": round(max(total - top_level, 0.0), 6),
+            "stages": {name: {"seconds": round(a["seconds"], 6), "calls": a["calls"]} for name, a in stages.items()},
+            "spans": [s.to_dict() for s in spans],
+        }
+
+
+class Span:
+    __slots__ = ("name", "depth", "start", "seconds", "attrs", "error")
+
+    def __init__(self, name: str, depth: int, start: float, attrs: dict):
+        self.name = name
+        self.depth = depth
+        self.start = start
+        self.seconds = None
+        self.attrs = attrs
+        self.error = None
+
+    def to_dict(self):
+        return {"stage": self.name, "depth": self.depth, "seconds": round(self.seconds or 0.0, 6),
+                **({"error": self.error} if self.error else {}), **self.attrs}
+
+
+_trace = contextvars.ContextVar("omics_trace", default=None)
+_depth = contextvars.ContextVar("omics_span_depth", default=0)
+
+
+@contextmanager
+def trace():
+    """Collect the spans opened in this context (and threads/tasks started from it)."""
+    current = Trace()
+    token = _trace.set(current)
+    try:
+        yield current
+    finally:
+        _trace.reset(token)
+
+
+def current_trace():
+    return _trace.get()
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Time a stage. Always feeds the omics_stage_duration_seconds histogram; when a
+    trace is active the span is also recorded on it for ?profile=1. Yields the
+    Span, whose .seconds is set on exit.
+    """
+    depth = _depth.get()
+    record = Span(name, depth, time.perf_counter(), attrs)
+    token = _depth.set(depth + 1)
+    try:
+        yield record
+    except BaseException as e:
+        record.error = type(e).__name__
+        STAGE_ERRORS.inc(stage=name)
+        raise
+    finally:
+        _depth.reset(token)
+        record.seconds = time.perf_counter() - record.start
+        STAGE_SECONDS.observe(record.seconds, stage=name)
+        current = _trace.get()
+        if current is not None:
+            current.add(record)
+
+
+def traced(name: str):
+    """Decorator form of span() for a whole function."""
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def observe_profile(profile: dict):
+    """Feed stage timings recorded elsewhere (e.g. a job worker process) into this process's histograms."""
+    for s in profile.get("spans", []):
+        STAGE_SECONDS.observe(s["seconds"], stage=s["stage"])
+
+
+def server_timing(profile: dict):
+    """Server-Timing header value: total milliseconds per stage."""
+    parts = [f"{name.replace(' ', '_')};dur={agg['seconds'] * 1000:.2f}" for name, agg in profile["stages"].items()]
+    parts.append(f"total;dur={profile['total_seconds'] * 1000:.2f}")
+    return ", ".join(parts)
+
+
+def render():
+    return REGISTRY.render()
@@ -0,0 +1,313 @@
+"""
+Benchmark the analysis functions and API endpoints on synthetic data.
+
+Run from backend/:
+
+    python -m benchmarks.run                                  # quick preset
+    python -m benchmarks.run --preset full --output baseline.json
+    python -m benchmarks.run --compare baseline.json          # flag regressions
+
+Every case is warmed up, timed (wall clock, best and median of --repeat runs) and run once more
+under tracemalloc for its peak Python/NumPy allocation. Results go to a JSON file
+keyed by (kind, name, scale) so two runs can be compared.
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tracemalloc
+import statistics
+
+import numpy as np
+import pandas as pd
+
+from benchmarks import synthetic
+from app.services import analysis
+from app.services import rarefaction
+from app.services import spls
+from app.services.taxonomy import TaxonomyMatrix
+
+# (samples, genes, taxa) grids. quick fits in a few minutes; full spans 16 -> 1,000
+# samples, 36k -> 60k genes and hundreds -> 10k taxa.
+PRESETS = {
+    'quick': [
+        {'samples': 16, 'genes': 36000, 'taxa': 300},
+        {'samples': 100, 'genes': 36000, 'taxa': 2000},
+    ],
+    'full': [
+        {'samples': 16, 'genes': 36000, 'taxa': 300},
+        {'samples': 100, 'genes': 36000, 'taxa': 2000},
+        {'samples': 1000, 'genes': 36000, 'taxa': 2000},
+        {'samples': 100, 'genes': 60000, 'taxa': 2000},
+        {'samples': 100, 'genes': 36000, 'taxa': 10000},
+        {'samples': 1000, 'genes': 60000, 'taxa': 10000},
+    ],
+}
+
+DEFAULT_OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+class Dataset:
+    """One synthetic dataset plus the derived inputs the analyses take."""
+
+    def __init__(self, samples: int, genes: int, taxa: int, seed: int = 0):
+        self.scale = {'samples': samples, 'genes': genes, 'taxa': taxa}
+        self.counts = synthetic.negative_binomial_counts(genes, samples, seed=seed)
+        self.metadata = synthetic.sample_metadata(self.counts.columns)
+        self.long = synthetic.taxonomy_table(taxa, samples, seed=seed)
+        self.log_cpm = analysis.compute_log_cpm(self.counts)
+        self.taxonomy = TaxonomyMatrix.from_long(self.long)
+        self.genus = self.taxonomy.abundance('Genus')
+
+        severity = self.metadata.set_index('Title')['Disease severity']
+        self.group_names = list(severity.unique()[:2])
+        self.groups = {
+            'group1': severity.index[severity == self.group_names[0]].tolist(),
+            'group2': severity.index[severity == self.group_names[1]].tolist(),
+        }
+        self.grouping = severity
+        self.distances = analysis.calculate_distance_matrix(self.genus)
+
+
+def function_cases(ds: Dataset):
+    """(name, callable) for every analysis function, on this dataset."""
+    return [
+        ('compute_log_cpm', lambda: analysis.compute_log_cpm(ds.counts)),
+        ('perform_differential_expression', lambda: analysis.perform_differential_expression(ds.counts, ds.groups, log_cpm=ds.log_cpm)),
+        ('perform_moderated_dea', lambda: analysis.perform_moderated_dea(ds.counts, ds.groups, log_cpm=ds.log_cpm)),
+        ('GroupStatistics', lambda: analysis.GroupStatistics(ds.counts, ds.groups, log_cpm=ds.log_cpm)),
+        # Every rank pivoted at once, and the per-request pivot_table it replaced
+        ('TaxonomyMatrix.from_long', lambda: TaxonomyMatrix.from_long(ds.long)),
+        ('pivot_table_genus', lambda: ds.long.pivot_table(index='Genus', columns='Sample', values='Abundance', aggfunc='sum').fillna(0)),
+        ('calculate_diversity_indices', lambda: analysis.calculate_diversity_indices(ds.genus)),
+        ('calculate_distance_matrix', lambda: analysis.calculate_distance_matrix(ds.genus, metric='braycurtis')),
+        ('calculate_beta_diversity', lambda: analysis.calculate_beta_diversity(ds.genus)),
+        ('perform_permanova', lambda: analysis.perform_permanova(ds.distances, ds.grouping, permutations=199)),
+        ('perform_correlation_analysis', lambda: analysis.perform_correlation_analysis(ds.counts, ds.genus)),
+        ('spearman_correlation_screen', lambda: analysis.spearman_correlation_screen(ds.counts, ds.taxonomy.relative('Genus'), top_k=500)),
+        ('perform_pls_integration', lambda: analysis.perform_pls_integration(ds.counts, ds.genus)),
+        ('perform_spls_integration', lambda: spls.perform_spls_integration(ds.log_cpm, ds.genus)),
+        ('perform_spls_integration_fixed', lambda: spls.perform_spls_integration(ds.log_cpm, ds.genus, n_components=2, keep_genes=[50], keep_taxa=[10])),
+        ('rarefaction_curves', lambda: rarefaction.rarefaction_curves(ds.genus, iterations=10)),
+    ]
+
+
+def endpoint_cases(ds: Dataset):
+    """(name, path, params) for the data endpoints; run against ds installed in the DataLoader."""
+    g1, g2 = ds.group_names
+    dea = {'group1': g1, 'group2': g2}
+    return [
+        ('GET /summary', '/api/omics/summary', {}),
+        ('GET /transcriptomics/dea', '/api/omics/transcriptomics/dea', dea),
+        ('GET /transcriptomics/dea?method=moderated', '/api/omics/transcriptomics/dea', {**dea, 'method': 'moderated'}),
+        ('GET /metagenomics/diversity', '/api/omics/metagenomics/diversity', {}),
+        ('GET /metagenomics/rarefaction', '/api/omics/metagenomics/rarefaction', {}),
+        ('GET /metagenomics/alpha', '/api/omics/metagenomics/alpha', {}),
+        ('GET /metagenomics/pcoa', '/api/omics/metagenomics/pcoa', {}),
+        ('GET /metagenomics/permanova', '/api/omics/metagenomics/permanova', {'permutations': 199}),
+        ('GET /metagenomics/composition', '/api/omics/metagenomics/composition', {}),
+        ('GET /biomarkers/correlation', '/api/omics/biomarkers/correlation', {}),
+        ('GET /biomarkers/integration', '/api/omics/biomarkers/integration', {}),
+        ('GET /biomarkers/integration/spls', '/api/omics/biomarkers/integration/spls', {}),
+    ]
+
+
+def measure(func, repeat: int = 3, setup=None):
+    """
+    Wall time over repeat runs, then one extra run under tracemalloc for peak memory.
+    setup() runs before every call (e.g. to drop caches) and is not timed. An untimed
+    warm-up call goes first so one-off costs (lazy imports, BLAS init) aren't counted.
+    """
+    if setup is not None:
+        setup()
+    func()
+
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'wall_seconds': {'min': min(times), 'median': statistics.median(times), 'runs': times},
+        'peak_memory_mb': peak / 1024 ** 2,
+    }
+
+
+def _install_dataset(ds: Dataset):
+    """Point the app's default DataLoader at a synthetic dataset, as if load_data() had produced it."""
+    from app.services.datasets import registry
+    data_loader = registry.loader()
+    data_loader.metadata = ds.metadata
+    data_loader.transcriptomics = ds.counts
+    data_loader.metagenomics = ds.long
+    data_loader.taxonomy = ds.taxonomy
+    data_loader.log_cpm = ds.log_cpm
+    data_loader.version = "synthetic-{samples}x{genes}x{taxa}".format(**ds.scale)
+    data_loader.status = "ready"
+    return data_loader
+
+
+def _clear_caches(data_loader):
+    # Retiring the version drops every result derived from it, so each call runs cold
+    for callback in data_loader._retire_callbacks:
+        callback(data_loader.version)
+
+
+def run_scale(scale: dict, repeat: int, pattern, endpoints: bool, log):
+    results = []
+    start = time.perf_counter()
+    ds = Dataset(**scale)
+    log(f"  dataset built in {time.perf_counter() - start:.1f}s")
+
+    def record(kind, name, func, setup=None):
+        if pattern and not pattern.search(name):
+            return
+        entry = {'kind': kind, 'name': name, 'scale': scale}
+        try:
+            entry.update(measure(func, repeat=repeat, setup=setup))
+            entry['error'] = None
+            log(f"  {name:<45} {entry['wall_seconds']['median']:9.4f}s {entry['peak_memory_mb']:9.1f} MB")
+        except Exception as e:
+            entry['error'] = f"{type(e).__name__}: {e}"
+            log(f"  {name:<45} failed: {entry['error']}")
+        results.append(entry)
+
+    for name, func in function_cases(ds):
+        record('function', name, func)
+
+    if endpoints:
+        from fastapi.testclient import TestClient
+        from main import app
+        # No context manager: startup hooks (the real data load) are not run
+        client = TestClient(app)
+        data_loader = _install_dataset(ds)
+
+        def call(path, params):
+            resp = client.get(path, params=params)
+            if resp.status_code != 200:
+                raise RuntimeError(f"HTTP {resp.status_code}: {resp.text[:200]}")
+            return resp.content
+
+        for name, path, params in endpoint_cases(ds):
+            record('endpoint', name, lambda path=path, params=params: call(path, params), setup=lambda: _clear_caches(data_loader))
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def environment():
+    import scipy
+    import sklearn
+    return {
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        'git_commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'scipy': scipy.__version__,
+        'sklearn': sklearn.__version__,
+    }
+
+
+def _key(entry):
+    return (entry['kind'], entry['name'], json.dumps(entry['scale'], sort_keys=True))
+
+
+def compare(current: list, baseline: list, threshold: float = 1.25):
+    """
+    Print current vs baseline median wall time and peak memory per case.
+    Returns the cases slower or larger than baseline by more than threshold x.
+    """
+    base = {_key(e): e for e in baseline if not e.get('error')}
+    regressions = []
+    print(f"\n{'case':<60} {'time x':>8} {'mem x':>8}")
+    for entry in current:
+        old = base.get(_key(entry))
+        if old is None or entry.get('error'):
+            continue
+        t_ratio = entry['wall_seconds']['median'] / max(old['wall_seconds']['median'], 1e-9)
+        m_ratio = entry['peak_memory_mb'] / max(old['peak_memory_mb'], 1e-6)
+        flag = "  REGRESSION" if t_ratio > threshold or m_ratio > threshold else ""
+        label = "{} [{samples}x{genes}x{taxa}]".format(entry['name'], **entry['scale'])
+        print(f"{label:<60} {t_ratio:8.2f} {m_ratio:8.2f}{flag}")
+        if flag:
+            regressions.append({'case': label, 'time_ratio': t_ratio, 'memory_ratio': m_ratio})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark analysis functions and endpoints on synthetic omics data.")
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="quick")
+    parser.add_argument("--scale", action="append", metavar="SAMPLESxGENESxTAXA",
+                        help="custom scale, e.g. 500x60000x5000; repeatable, replaces the preset")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case")
+    parser.add_argument("--filter", help="only run cases whose name matches this regex")
+    parser.add_argument("--no-endpoints", action="store_true", help="benchmark functions only")
+    parser.add_argument("--output", help="JSON file to write (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--compare", help="baseline JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25, help="ratio above which a case counts as a regression")
+    args = parser.parse_args(argv)
+
+    if args.scale:
+        scales = []
+        for spec in args.scale:
+            samples, genes, taxa = (int(x) for x in spec.lower().split("x"))
+            scales.append({'samples': samples, 'genes': genes, 'taxa': taxa})
+    else:
+        scales = PRESETS[args.preset]
+    pattern = re.compile(args.filter) if args.filter else None
+
+    def log(msg):
+        print(msg, flush=True)
+
+    results = []
+    for scale in scales:
+        log("scale: {samples} samples x {genes} genes x {taxa} taxa".format(**scale))
+        results.extend(run_scale(scale, args.repeat, pattern, not args.no_endpoints, log))
+
+    report = {
+        'environment': environment(),
+        'config': {'preset': None if args.scale else args.preset, 'scales': scales, 'repeat': args.repeat, 'filter': args.filter},
+        'results': results,
+    }
+    output = args.output or os.path.join(DEFAULT_OUTPUT_DIR, time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    log(f"\nwrote {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            log(f"\n{len(regressions)} regression(s) over {args.threshold}x")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+"""
+Synthetic datasets shaped like the GSE186651 inputs, at arbitrary scale.
+
+- negative_binomial_counts: Genes x Samples RNA-seq counts (like GSE186651_datacount.txt.gz)
+- taxonomy_table: long-format Sample/Abundance/Kingdom..Species table with one row per
+  (sample, taxon), mostly zeros (like GSE186651_Abundance_rawdata.csv.gz)
+- sample_metadata: the metadata.xlsx columns the API groups by
+"""
+import numpy as np
+import pandas as pd
+
+RANKS = ['Kingdom', 'Phylum', 'Class', 'Order', 'Family', 'Genus', 'Species']
+
+# Distinct labels per rank relative to the number of species, roughly as in the real table
+# (28 phyla, 53 classes, 127 orders, 286 families, 788 genera for 1915 species)
+_RANK_FRACTIONS = {'Phylum': 0.015, 'Class': 0.028, 'Order': 0.066, 'Family': 0.15, 'Genus': 0.41}
+
+# Fraction of taxa whose label is missing at a rank (the real table has unassigned ranks)
+_MISSING_FRACTIONS = {'Class': 0.04, 'Order': 0.01, 'Family': 0.01, 'Genus': 0.02}
+
+
+def sample_names(n_samples: int, n_groups: int = 2):
+    """Sample IDs in the dataset's PATIENT_REPLICATE style, grouped round-robin."""
+    prefixes = ['AS', 'SY', 'MS', 'CT'][:n_groups]
+    names = []
+    for j in range(n_samples):
+        g, i = j % n_groups, j // n_groups
+        names.append(f"{prefixes[g]}{i // 4 + 1}_R{i % 4 + 1}")
+    return names
+
+
+def sample_metadata(samples, n_groups: int = 2):
+    """Metadata frame with the Title/Disease severity columns the endpoints use."""
+    levels = ['Asymptomatic', 'Mildly Symptomatic', 'Moderate', 'Control'][:n_groups]
+    prefixes = ['AS', 'SY', 'MS', 'CT'][:n_groups]
+    severity = [levels[prefixes.index(s[:2])] for s in samples]
+    return pd.DataFrame({
+        'Accession': [f"GSM{9000000 + j}" for j in range(len(samples))],
+        'Title': list(samples),
+        'Source name': 'nasopharyngeal swab',
+        'Disease severity': severity,
+        'Patient': [s.split('_')[0] for s in samples],
+    })
+
+
+def negative_binomial_counts(n_genes: int, n_samples: int, n_groups: int = 2, de_fraction: float = 0.05,
+                             zero_fraction: float = 0.3, seed: int = 0):
+    """
+    Genes x Samples int32 counts from a negative binomial with a mean-dispersion trend.
+
+    Gene means are log-normal, library sizes vary ~2x between samples, dispersion
+    falls with expression (phi = 0.05 + 1/sqrt(mu)), a zero_fraction of genes are
+    essentially unexpressed, and de_fraction of genes get a 2-8x fold change in one group.
+    """
+    rng = np.random.default_rng(seed)
+    samples = sample_names(n_samples, n_groups)
+    group = np.arange(n_samples) % n_groups
+
+    base = rng.lognormal(mean=2.0, sigma=2.0, size=n_genes)
+    base[rng.random(n_genes) < zero_fraction] = 0.01
+    size_factors = rng.lognormal(mean=0.0, sigma=0.35, size=n_samples)
+
+    fold = np.ones((n_genes, n_groups))
+    de = rng.random(n_genes) < de_fraction
+    n_de = int(de.sum())
+    fold[de, rng.integers(0, n_groups, n_de)] = (2.0 ** rng.uniform(1, 3, n_de)) ** rng.choice([-1, 1], n_de)
+
+    counts = np.empty((n_genes, n_samples), dtype=np.int32)
+    # Column by column keeps the float64 temporaries at O(genes)
+    for j in range(n_samples):
+        mu = base * fold[:, group[j]] * size_factors[j]
+        phi = 0.05 + 1.0 / np.sqrt(mu + 1.0)
+        # NB(mu, phi) as a gamma-Poisson mixture
+        lam = rng.gamma(shape=1.0 / phi, scale=mu * phi)
+        counts[:, j] = np.minimum(rng.poisson(lam), np.iinfo(np.int32).max)
+
+    genes = [f"GENE{i:06d}" for i in range(n_genes)]
+    return pd.DataFrame(counts, index=pd.Index(genes), columns=pd.Index(samples))
+
+
+def _lineage(n_taxa: int, rng):
+    """A random taxonomy tree: each label at a rank has one parent at the rank above."""
+    lineage = {'Kingdom': np.zeros(n_taxa, dtype=np.int64)}
+    parent = lineage['Kingdom']
+    n_parent = 1
+    for rank in RANKS[1:-1]:
+        n_labels = max(n_parent, int(round(n_taxa * _RANK_FRACTIONS[rank])))
+        # Every parent gets at least one child; the rest are attached at random
+        label_parent = np.concatenate([np.arange(n_parent), rng.integers(0, n_parent, n_labels - n_parent)])
+        # Assign taxa to labels whose parent matches the taxon's parent
+        codes = np.empty(n_taxa, dtype=np.int64)
+        children = pd.Series(np.arange(n_labels)).groupby(label_parent).apply(np.asarray)
+        for p in np.unique(parent):
+            members = np.nonzero(parent == p)[0]
+            codes[members] = rng.choice(children[p], size=members.size)
+        lineage[rank] = codes
+        parent, n_parent = codes, n_labels
+    return lineage
+
+
+def taxonomy_table(n_taxa: int, n_samples: int, n_groups: int = 2, reads_per_sample: int = 20000,
+                   include_zeros: bool = True, seed: int = 0):
+    """
+    Long-format metagenomics table: Sample, Abundance, Kingdom ... Species.
+
+    Taxon proportions follow a power law with per-sample log-normal noise and a
+    group effect on 10% of taxa; abundances are multinomial draws, so most cells are
+    zero. With include_zeros every (sample, taxon) pair gets a row, as in the real
+    file; otherwise only non-zero abundances are listed.
+    """
+    rng = np.random.default_rng(seed)
+    samples = sample_names(n_samples, n_groups)
+    group = np.arange(n_samples) % n_groups
+
+    lineage = _lineage(n_taxa, rng)
+    labels = {
+        'Kingdom': np.array(['Bacteria']),
+        'Phylum': np.array([f"Phylum{i}" for i in range(lineage['Phylum'].max() + 1)]),
+        'Class': np.array([f"Class{i}" for i in range(lineage['Class'].max() + 1)]),
+        'Order': np.array([f"Order{i}" for i in range(lineage['Order'].max() + 1)]),
+        'Family': np.array([f"Family{i}" for i in range(lineage['Family'].max() + 1)]),
+        'Genus': np.array([f"Genus{i}" for i in range(lineage['Genus'].max() + 1)]),
+    }
+    columns = {rank: labels[rank][lineage[rank]].astype(object) for rank in RANKS[:-1]}
+    columns['Species'] = np.array([f"species{i}" for i in range(n_taxa)], dtype=object)
+    for rank, frac in _MISSING_FRACTIONS.items():
+        columns[rank][rng.random(n_taxa) < frac] = np.nan
+
+    weights = 1.0 / np.arange(1, n_taxa + 1) ** 1.5
+    rng.shuffle(weights)
+    effect = np.ones((n_taxa, n_groups))
+    shifted = rng.random(n_taxa) < 0.1
+    effect[shifted, rng.integers(0, n_groups, shifted.sum())] = rng.lognormal(0, 1, shifted.sum())
+
+    abundance = np.empty((n_taxa, n_samples), dtype=np.int64)
+    for j in range(n_samples):
+        p = weights * effect[:, group[j]] * rng.lognormal(0, 1.0, n_taxa)
+        abundance[:, j] = rng.multinomial(reads_per_sample, p / p.sum())
+
+    taxon_idx, sample_idx = np.meshgrid(np.arange(n_taxa), np.arange(n_samples), indexing='ij')
+    taxon_idx, sample_idx = taxon_idx.ravel(), sample_idx.ravel()
+    values = abundance.ravel()
+    if not include_zeros:
+        keep = values > 0
+        taxon_idx, sample_idx, values = taxon_idx[keep], sample_idx[keep], values[keep]
+
+    table = {'Sample': np.asarray(samples, dtype=object)[sample_idx], 'Abundance': values}
+    for rank in RANKS:
+        table[rank] = columns[rank][taxon_idx]
+    return pd.DataFrame(table)
@@ -1,6 +1,14 @@
-from fastapi import FastAPI
+import json
+import logging
+import time
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
 from app.api.endpoints import omics
+from app.services.datasets import registry
+from app.services import tracing
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 
 app = FastAPI(title="Multi-Omics Analysis Platform", version="1.0.0")
 
@@ -16,10 +24,66 @@ app.add_middleware(
 # Include routers
 app.include_router(omics.router, prefix="/api/omics", tags=["omics"])
 
+def _route_template(request: Request):
+    # Route template rather than the raw path, so job IDs don't each become a series.
+    # Routes of included routers may report their path without the prefix; restore
+    # it from the request path, which has the same number of segments.
+    template = getattr(request.scope.get("route"), "path", None)
+    if template is None:
+        return "unmatched"
+    return request.scope["path"].rsplit("/", template.count("/"))[0] + template
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    # Every request gets a trace collecting the stage spans opened while handling it;
+    # ?profile=1 returns them inline, wrapping JSON bodies as {"result": ..., "profile": ...}
+    profile = request.query_params.get("profile") in ("1", "true")
+    start = time.perf_counter()
+    with tracing.trace() as trace:
+        response = await call_next(request)
+    route = _route_template(request)
+    tracing.HTTP_SECONDS.observe(time.perf_counter() - start, method=request.method, route=route)
+    tracing.HTTP_REQUESTS.inc(method=request.method, route=route, status=response.status_code)
+    if not profile:
+        return response
+
+    stages = trace.to_dict()
+    headers = {k: v for k, v in response.headers.items() if k.lower() not in ("content-length", "content-type")}
+    headers["Server-Timing"] = tracing.server_timing(stages)
+    if not response.headers.get("content-type", "").startswith("application/json"):
+        response.headers["Server-Timing"] = headers["Server-Timing"]
+        return response
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    content = b'{"result":' + (body or b"null") + b',"profile":' + json.dumps(stages).encode() + b'}'
+    return Response(content=content, status_code=response.status_code, headers=headers, media_type="application/json")
+
 @app.get("/")
 def read_root():
     return {"message": "Welcome to the Multi-Omics Analysis Platform API"}
 
+@app.get("/healthz")
+def healthz():
+    # Liveness: the process is up and serving, whether or not data has loaded
+    return {"status": "ok"}
+
+@app.get("/metrics")
+def metrics():
+    # Prometheus scrape target; each worker process reports its own series
+    return Response(content=tracing.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/readyz")
+def readyz():
+    # Readiness: the default dataset is loaded and endpoints can answer; other
+    # datasets load on demand and don't hold up readiness
+    loader = registry.peek()
+    if loader is None:
+        return JSONResponse(status_code=503, content={"status": "idle", "ready": False}, headers={"Retry-After": omics.RETRY_AFTER})
+    state = loader.state()
+    if loader.ready:
+        return {**state, "ready": True}
+    headers = {} if state["status"] == "failed" else {"Retry-After": omics.RETRY_AFTER}
+    return JSONResponse(status_code=503, content={**state, "ready": False}, headers=headers)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
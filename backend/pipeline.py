@@ -0,0 +1,148 @@
+"""
+Headless batch pipeline: compute every analysis the UI shows for a dataset and
+write the results to the versioned result store, which the API serves from.
+
+Run from backend/:
+
+    python pipeline.py                                   # default dataset, Genus
+    python pipeline.py --dataset GSE999999 --rank Genus --rank Phylum --workers 4
+    python pipeline.py --only dea --only diversity --force
+    python pipeline.py --list                            # stages, and which are stored
+
+Results are stored under the dataset's version (the fingerprint of its source
+files), so dropping in new files makes them stale and the API computes live again
+until the pipeline is rerun. A rerun only computes what isn't stored yet, unless
+--force. The stages are independent: with several workers they run in a process
+pool, each worker mapping the dataset's on-disk cache once and writing its results
+straight into the staging directory. The version is published when all stages
+have run; failed ones are left out (the API computes those live) and make the
+exit status 1.
+"""
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from app.services.datasets import registry
+from app.services.result_store import result_store, result_key, write_result
+
+
+def _init_worker(dataset: str):
+    # Workers compute; reading the store back would only copy the previous run
+    result_store.serving = False
+    registry.load(dataset)
+
+
+def run_stage(analysis: str, kwargs: dict, dataset: str, version: str, out_dir: str):
+    """
+    Compute one stage and write it to out_dir. Returns (seconds, None) or
+    (seconds, error message); exceptions are flattened, HTTPException doesn't pickle.
+    """
+    from app.api.endpoints import omics
+    start = time.perf_counter()
+    try:
+        loader = registry.peek(dataset)
+        if loader is None or loader.version != version:
+            loader = registry.load(dataset)
+        if loader.version != version:
+            raise RuntimeError(f"dataset changed during the run (now {loader.version})")
+        result = omics.PRECOMPUTED[analysis](**kwargs, dataset=dataset)
+        write_result(out_dir, result)
+    except Exception as e:
+        shutil.rmtree(out_dir, ignore_errors=True)
+        detail = getattr(e, 'detail', None) or f"{type(e).__name__}: {e}"
+        return time.perf_counter() - start, str(detail)
+    return time.perf_counter() - start, None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Precompute every analysis for a dataset into the result store.")
+    parser.add_argument("--dataset", help="dataset name (see /api/omics/datasets); the default dataset if omitted")
+    parser.add_argument("--rank", action="append", help="taxonomic rank for the metagenomic analyses; repeatable (default: Genus)")
+    parser.add_argument("--metric", action="append", help="beta-diversity metric; repeatable (default: braycurtis)")
+    parser.add_argument("--only", action="append", help="only run these analyses, e.g. dea, diversity; repeatable")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per CPU, up to the number of stages)")
+    parser.add_argument("--force", action="store_true", help="recompute results already stored for this version")
+    parser.add_argument("--keep", type=int, default=3, help="stored versions to keep per dataset")
+    parser.add_argument("--list", action="store_true", help="list the stages and whether each is stored, then exit")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    from app.api.endpoints import omics
+
+    def log(msg):
+        print(msg, flush=True)
+
+    if args.only:
+        unknown = set(args.only) - set(omics.PRECOMPUTED)
+        if unknown:
+            parser.error(f"unknown analyses: {', '.join(sorted(unknown))}. Available: {', '.join(omics.PRECOMPUTED)}")
+    result_store.serving = False
+    loader = registry.load(args.dataset)
+    if loader is None:
+        parser.error(f"unknown dataset '{args.dataset}'. Available: {', '.join(registry.names())}")
+    if not loader.ready:
+        log(f"dataset {loader.name} failed to load: {loader.error}")
+        return 1
+    ranks = args.rank or ['Genus']
+    bad_ranks = [r for r in ranks if r not in loader.taxonomy.ranks]
+    if bad_ranks:
+        parser.error(f"unknown ranks: {', '.join(bad_ranks)}. Available: {', '.join(loader.taxonomy.ranks)}")
+
+    stages = []
+    for analysis, kwargs in omics.precompute_stages(loader, ranks, args.metric or ['braycurtis']):
+        if not args.only or analysis in args.only:
+            stages.append((analysis, kwargs, result_key(analysis, omics.store_params(analysis, kwargs))))
+    name, version = loader.name, loader.version
+
+    if args.list:
+        stored = (result_store.index(name, version) or {}).get("results", {})
+        log(f"{name} @ {version}: {sum(key in stored for *_, key in stages)}/{len(stages)} stored")
+        for analysis, kwargs, key in stages:
+            log(f"  {'stored ' if key in stored else 'missing'}  {analysis:<12} {kwargs}")
+        return 0
+
+    staging, index = result_store.begin(name, version, reuse=not args.force)
+    pending = [s for s in stages if s[2] not in index["results"]]
+    workers = max(1, min(args.workers or os.cpu_count() or 1, len(pending) or 1))
+    log(f"{name} @ {version}: {len(pending)} of {len(stages)} stages to run on {workers} worker(s)")
+
+    def record(analysis, kwargs, key, seconds, error):
+        if error is None:
+            index["results"][key] = {"analysis": analysis, "params": omics.store_params(analysis, kwargs), "seconds": round(seconds, 4)}
+        else:
+            index["failed"][key] = {"analysis": analysis, "params": kwargs, "error": error}
+        log(f"  {'ok    ' if error is None else 'FAILED'} {seconds:8.2f}s  {analysis:<12} {kwargs}" + (f": {error}" if error else ""))
+
+    start = time.perf_counter()
+    try:
+        if workers == 1:
+            for analysis, kwargs, key in pending:
+                record(analysis, kwargs, key, *run_stage(analysis, kwargs, name, version, os.path.join(staging, key)))
+        else:
+            # spawn, like the job pool: workers start clean and map the cached dataset
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=_init_worker, initargs=(name,)) as pool:
+                futures = {
+                    pool.submit(run_stage, analysis, kwargs, name, version, os.path.join(staging, key)): (analysis, kwargs, key)
+                    for analysis, kwargs, key in pending
+                }
+                for future in as_completed(futures):
+                    record(*futures[future], *future.result())
+    except BaseException:
+        result_store.discard(staging)
+        raise
+
+    index["pipeline_seconds"] = round(time.perf_counter() - start, 4)
+    published = result_store.publish(staging, index, keep=args.keep)
+    log(f"published {len(index['results'])} results to {published} in {index['pipeline_seconds']:.1f}s"
+        + (f"; {len(index['failed'])} failed" if index["failed"] else ""))
+    return 1 if index["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+"""PERMANOVA and PERMDISP against hand-computed values."""
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+from scipy.spatial.distance import cdist
+
+from app.services import analysis
+
+
+def _euclidean(points, labels):
+    names = [f"s{i}" for i in range(len(points))]
+    points = np.asarray(points, dtype=float).reshape(len(points), -1)
+    return pd.DataFrame(cdist(points, points), index=names, columns=names), pd.Series(labels, index=names)
+
+
+def test_permanova_on_a_line_is_one_way_anova():
+    # Euclidean distances between scalars: pseudo-F is the ANOVA F.
+    # Means 2 and 7, grand mean 4.5: SS_between = 6 * 2.5^2 = 37.5, SS_within = 2 + 2 = 4,
+    # F = (37.5 / 1) / (4 / 4) = 37.5, R^2 = 37.5 / 41.5
+    D, groups = _euclidean([1, 2, 3, 6, 7, 8], ['a'] * 3 + ['b'] * 3)
+    result = analysis.perform_permanova(D, groups, permutations=99)
+    assert result['test_statistic'] == pytest.approx(37.5)
+    assert result['r_squared'] == pytest.approx(37.5 / 41.5)
+    assert result['groups'] == {'a': 3, 'b': 3}
+
+
+def test_permanova_matches_summed_sums_of_squares():
+    # In Euclidean space PERMANOVA's sums of squares are the per-axis ANOVA ones, summed
+    rng = np.random.default_rng(0)
+    points = rng.normal(size=(15, 3)) + np.repeat([[0, 0, 0], [1, 0, 0], [0, 2, 0]], 5, axis=0)
+    labels = np.repeat(['a', 'b', 'c'], 5)
+    D, groups = _euclidean(points, labels)
+    means = np.array([points[labels == g].mean(axis=0) for g in 'abc'])
+    ss_within = sum(((points[labels == g] - means[i]) ** 2).sum() for i, g in enumerate('abc'))
+    ss_total = ((points - points.mean(axis=0)) ** 2).sum()
+    f = ((ss_total - ss_within) / 2) / (ss_within / 12)
+
+    result = analysis.perform_permanova(D, groups, permutations=199)
+    assert result['test_statistic'] == pytest.approx(f)
+    assert result['r_squared'] == pytest.approx(1 - ss_within / ss_total)
+
+
+def test_permutation_p_values():
+    rng = np.random.default_rng(1)
+    permutations = 499
+    separated = _euclidean(np.concatenate([rng.normal(0, 1, 10), rng.normal(20, 1, 10)]), ['a'] * 10 + ['b'] * 10)
+    same = _euclidean(rng.normal(0, 1, 20), ['a'] * 10 + ['b'] * 10)
+    for test in (analysis.perform_permanova, analysis.perform_permdisp):
+        for D, groups in (separated, same):
+            p = test(D, groups, permutations=permutations)['p_value']
+            # (hits + 1) / (permutations + 1): never 0, at most 1, on that grid
+            assert 1 / (permutations + 1) <= p <= 1
+            assert (p * (permutations + 1)) == pytest.approx(round(p * (permutations + 1)))
+            assert test(D, groups, permutations=permutations)['p_value'] == p  # same seed, same p
+    assert analysis.perform_permanova(*separated, permutations=permutations)['p_value'] == 1 / (permutations + 1)
+    assert analysis.perform_permanova(*same, permutations=permutations)['p_value'] > 0.05
+
+
+def test_permdisp_centroid_in_euclidean_space():
+    # Distances to the group centroid, then their one-way ANOVA
+    rng = np.random.default_rng(2)
+    points = np.concatenate([rng.normal(0, 1, (8, 2)), rng.normal(5, 3, (8, 2))])
+    labels = np.repeat(['a', 'b'], 8)
+    D, groups = _euclidean(points, labels)
+    z = np.concatenate([np.linalg.norm(points[labels == g] - points[labels == g].mean(axis=0), axis=1) for g in 'ab'])
+
+    result = analysis.perform_permdisp(D, groups, permutations=199, type='centroid')
+    assert result['test_statistic'] == pytest.approx(stats.f_oneway(z[:8], z[8:]).statistic)
+    assert result['mean_dispersion'] == pytest.approx({'a': z[:8].mean(), 'b': z[8:].mean()})
+    assert result['p_value'] < 0.05
+
+
+def test_permdisp_median_of_symmetric_groups():
+    # Each group is a square around a point, so the spatial median is that point: distances 1 and 2
+    square = np.array([[1, 0], [0, 1], [-1, 0], [0, -1]], dtype=float)
+    points = np.concatenate([square, 2 * square + [10, 10]])
+    D, groups = _euclidean(points, ['a'] * 4 + ['b'] * 4)
+    result = analysis.perform_permdisp(D, groups, permutations=99)
+    assert result['type'] == 'median'
+    assert result['mean_dispersion'] == pytest.approx({'a': 1.0, 'b': 2.0})
+
+
+def test_permdisp_centroid_with_non_euclidean_distances():
+    # Bray-Curtis has negative PCoA eigenvalues. Distance to the centroid only needs the
+    # squared distances (Anderson 2006): z_i^2 = mean_j d_ij^2 - sum_jl d_jl^2 / (2 n^2), j, l in the group
+    rng = np.random.default_rng(3)
+    abundance = pd.DataFrame(rng.poisson(rng.lognormal(1, 1.5, (30, 1)), size=(30, 12)),
+                             columns=[f"s{i}" for i in range(12)])
+    D = analysis.calculate_distance_matrix(abundance, 'braycurtis')
+    labels = pd.Series(np.repeat(['a', 'b', 'c'], 4), index=D.index)
+    d2 = D.to_numpy() ** 2
+    z = np.empty(12)
+    for g in 'abc':
+        m = (labels == g).to_numpy()
+        block = d2[np.ix_(m, m)]
+        z[m] = np.sqrt(np.abs(block.mean(axis=1) - block.sum() / (2 * m.sum() ** 2)))
+
+    result = analysis.perform_permdisp(D, labels, permutations=99, type='centroid')
+    assert result['mean_dispersion'] == pytest.approx({g: z[(labels == g).to_numpy()].mean() for g in 'abc'})
+    assert result['test_statistic'] == pytest.approx(stats.f_oneway(*(z[(labels == g).to_numpy()] for g in 'abc')).statistic)
@@ -0,0 +1,85 @@
+"""The all-pairs Spearman screen behind /biomarkers/correlation?all_pairs=true."""
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+
+from app.api.endpoints import omics
+from app.services import analysis
+from app.services.taxonomy import TaxonomyMatrix
+
+
+def _depth_only_dataset(n_genes=400, n_taxa=12, n_samples=12, seed=2):
+    # Expression carries no signal besides library size, which spans 8x across samples;
+    # one taxon's share happens to rise with depth too
+    rng = np.random.default_rng(seed)
+    depth = np.geomspace(1, 8, n_samples)
+    samples = [f"S{j:02d}" for j in range(n_samples)]
+    base = rng.lognormal(3, 1, n_genes)
+    counts = pd.DataFrame(rng.poisson(np.outer(base, depth)), index=[f"G{i}" for i in range(n_genes)], columns=samples)
+
+    share = rng.dirichlet(np.ones(n_taxa), size=n_samples)
+    share[:, 0] = depth / depth.sum()
+    rows = [{'Sample': s, 'Abundance': int(v), 'Genus': f"Genus{t}"}
+            for j, s in enumerate(samples) for t, v in enumerate(rng.multinomial(20000, share[j] / share[j].sum()))]
+    taxonomy = TaxonomyMatrix.from_long(pd.DataFrame(rows))
+    return SimpleNamespace(name='synthetic', version='v', transcriptomics=counts,
+                           log_cpm=analysis.compute_log_cpm(counts), taxonomy=taxonomy)
+
+
+def test_sequencing_depth_alone_gives_no_pairs(monkeypatch):
+    ds = _depth_only_dataset()
+    monkeypatch.setattr(omics, '_require_data', lambda dataset=None: ds)
+    # Unwrapped: the result store must not answer
+    result = omics._correlation.__wrapped__('Genus', all_pairs=True, max_q=0.05, top_k=None)
+    assert result['n_tests'] > 0
+    assert len(result['pairs']) == 0
+
+    # Screening the raw counts would report the depth-tracking taxon against nearly every gene
+    raw = analysis.spearman_correlation_screen(ds.transcriptomics, ds.taxonomy.relative('Genus'), max_q=0.05)
+    assert (raw['taxon'] == 'Genus0').sum() > 300
+
+
+def test_matches_spearmanr_and_bh():
+    rng = np.random.default_rng(1)
+    n = 9
+    # Small integers: plenty of ties within rows
+    genes = pd.DataFrame(rng.integers(0, 5, size=(15, n)), index=[f"G{i}" for i in range(15)])
+    taxa = pd.DataFrame(rng.integers(0, 4, size=(6, n)), index=[f"T{i}" for i in range(6)])
+    genes.iloc[0] = 2  # constant: not tested
+    genes.iloc[1] = [0] * (n - 1) + [3]  # too sparse: not tested
+
+    result = analysis.spearman_correlation_screen(genes, taxa, min_samples=3)
+    tested_genes = [g for g in genes.index[2:] if np.count_nonzero(genes.loc[g]) >= 3]
+    tested_taxa = [t for t in taxa.index if np.ptp(taxa.loc[t]) > 0 and np.count_nonzero(taxa.loc[t]) >= 3]
+    assert result.attrs['n_tests'] == len(tested_genes) * len(tested_taxa) == len(result)
+
+    expected = []
+    for g in tested_genes:
+        for t in tested_taxa:
+            rho, p = stats.spearmanr(genes.loc[g], taxa.loc[t])
+            expected.append((g, t, rho, p))
+    expected = pd.DataFrame(expected, columns=['gene', 'taxon', 'rho', 'p_value'])
+    expected['q_value'] = stats.false_discovery_control(expected['p_value'])
+
+    merged = result.merge(expected, on=['gene', 'taxon'], suffixes=('', '_ref'))
+    assert len(merged) == len(result)
+    np.testing.assert_allclose(merged['rho'], merged['rho_ref'], atol=1e-6)
+    np.testing.assert_allclose(merged['p_value'], merged['p_value_ref'], rtol=1e-4)
+    np.testing.assert_allclose(merged['q_value'], merged['q_value_ref'], rtol=1e-4)
+    # Sorted strongest first
+    assert np.all(np.diff(np.abs(result['rho'])) <= 1e-7)
+
+
+@pytest.mark.parametrize("max_q, top_k", [(0.5, None), (None, 7), (0.5, 3)])
+def test_selection(max_q, top_k):
+    rng = np.random.default_rng(2)
+    genes = pd.DataFrame(rng.lognormal(size=(40, 10)))
+    taxa = pd.DataFrame(rng.lognormal(size=(5, 10)))
+    everything = analysis.spearman_correlation_screen(genes, taxa)
+    selected = analysis.spearman_correlation_screen(genes, taxa, max_q=max_q, top_k=top_k)
+    expected = everything[everything['q_value'] <= max_q] if max_q is not None else everything
+    expected = expected.head(top_k) if top_k is not None else expected
+    pd.testing.assert_frame_equal(selected.reset_index(drop=True), expected.reset_index(drop=True), check_dtype=False)
@@ -0,0 +1,30 @@
+"""The parsed-dataset cache: what comes back from disk is what was parsed."""
+import numpy as np
+import pandas as pd
+
+from app.services import dataset_cache
+
+
+def test_round_trip_keeps_values_and_dtypes(tmp_path):
+    metadata = pd.DataFrame({'Title': ['S1_R1', 'S2_R1'], 'Disease severity': ['Severe', 'Asymptomatic'], 'Age': [61, 34]})
+    transcriptomics = pd.DataFrame({'S1_R1': [0, 12, 3], 'S2_R1': [7, 0, 1]}, index=['A2M', 'AAMP', 'ABCA1'])
+    metagenomics = pd.DataFrame({
+        'Sample': ['S1_R1', 'S1_R1', 'S2_R1'],
+        'Abundance': np.array([5, 0, 9], dtype=np.int64),
+        'Depth': [1.5, 2.0, np.nan],
+        'Run': np.array([1, 1, 2], dtype=np.int64),
+        'Genus': ['Bacillus', None, 'Prevotella'],
+    })
+    dataset_cache.write_cache(str(tmp_path), 'k', metadata, transcriptomics, metagenomics)
+    cached_meta, cached_counts, cached_mg = dataset_cache.read_cache(str(tmp_path), 'k')
+
+    pd.testing.assert_frame_equal(cached_meta, metadata)
+    pd.testing.assert_frame_equal(cached_counts, transcriptomics, check_dtype=False, check_index_type=False,
+                                  check_column_type=False)
+    assert np.issubdtype(cached_counts.to_numpy().dtype, np.integer)
+
+    # Text columns come back categorical (the compact form), numeric ones exactly as parsed
+    for col in ('Sample', 'Genus'):
+        assert isinstance(cached_mg[col].dtype, pd.CategoricalDtype)
+    text = {col: metagenomics[col].dtype for col in ('Sample', 'Genus')}
+    pd.testing.assert_frame_equal(cached_mg.astype(text), metagenomics)
@@ -0,0 +1,105 @@
+"""The dataset registry: the memory budget, LRU eviction and shared-segment leases."""
+import json
+import os
+
+import pytest
+
+from app.services import data_loader as data_loader_module
+from app.services import shared_dataset
+from app.services.datasets import DatasetRegistry
+from benchmarks import synthetic
+
+
+def _write_dataset(root, name, seed):
+    counts = synthetic.negative_binomial_counts(200, 8, seed=seed)
+    counts.to_csv(root / f"{name}_counts.txt", sep='\t')
+    synthetic.taxonomy_table(40, 8, seed=seed).to_csv(root / f"{name}_abundance.csv", index=False)
+    synthetic.sample_metadata(counts.columns).to_csv(root / f"{name}_metadata.csv", index=False)
+    with open(root / f"{name}.json", "w") as f:
+        json.dump({'transcriptomics': f"{name}_counts.txt", 'metagenomics': f"{name}_abundance.csv",
+                   'metadata': f"{name}_metadata.csv"}, f)
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    monkeypatch.setenv("OMICS_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("OMICS_SHARED_DIR", str(tmp_path / "shm"))
+    monkeypatch.setattr(data_loader_module, "INGEST_DIR", str(tmp_path / "ingest"))
+    manifests = tmp_path / "datasets"
+    manifests.mkdir()
+    for seed, name in enumerate(['alpha', 'beta', 'gamma']):
+        _write_dataset(manifests, name, seed)
+    # 'alpha' stands in for the default dataset
+    return DatasetRegistry(manifest_dir=str(manifests), default='alpha')
+
+
+def _load(registry, *names):
+    for name in names:
+        assert registry.load(name).ready
+
+
+def _segments(tmp_path, name):
+    root = tmp_path / "shm" / name
+    return sorted(e for e in os.listdir(root) if not e.startswith('.')) if root.exists() else []
+
+
+def test_lru_dataset_is_evicted_over_budget(registry):
+    _load(registry, 'alpha', 'beta', 'gamma')
+    per_dataset = registry.peek('beta').memory_bytes
+    # Room for about two datasets
+    registry.memory_budget = int(per_dataset * 2.5)
+
+    registry.acquire('beta')
+    _load(registry, 'alpha')
+    assert registry.peek('gamma') is None
+    assert registry.peek('beta') is not None and registry.peek('alpha') is not None
+
+
+def test_default_is_never_evicted(registry):
+    _load(registry, 'alpha', 'beta')
+    registry.memory_budget = 1
+    _load(registry, 'gamma')
+    # Over budget with only the default and the dataset just loaded left
+    assert registry.peek('alpha') is not None and registry.peek('gamma') is not None
+    assert registry.peek('beta') is None
+    assert not registry.evict('alpha')
+    assert registry.evict('gamma') and not registry.evict('gamma')
+
+
+def test_stats(registry):
+    _load(registry, 'alpha', 'beta')
+    registry.evict('beta')
+    _load(registry, 'beta')
+    registry.acquire('beta')
+    stats = {d['name']: d for d in registry.stats()['datasets']}
+    assert stats['beta']['loads'] == 2 and stats['beta']['evictions'] == 1
+    assert stats['beta']['accesses'] == 1 and stats['beta']['status'] == 'ready'
+    assert stats['gamma']['status'] == 'idle' and stats['gamma']['memory_bytes'] == 0
+    assert registry.stats()['resident_bytes'] == stats['alpha']['memory_bytes'] + stats['beta']['memory_bytes']
+
+
+def test_eviction_keeps_segments_other_workers_hold(registry, tmp_path, monkeypatch):
+    _load(registry, 'beta')
+    [key] = _segments(tmp_path, 'beta')
+    # Another live worker has the same version mapped
+    lease_dir = tmp_path / "shm" / 'beta' / shared_dataset.LEASES / key
+    (lease_dir / "1").touch()
+    monkeypatch.setattr(shared_dataset, "_alive", lambda pid: True)
+    registry.evict('beta')
+    assert _segments(tmp_path, 'beta') == [key]
+
+    # Once it's gone too, the last one out unlinks it
+    monkeypatch.setattr(shared_dataset, "_alive", lambda pid: False)
+    _load(registry, 'beta')
+    registry.evict('beta')
+    assert _segments(tmp_path, 'beta') == []
+
+
+def test_segments_are_released_outside_the_registry_lock(registry, monkeypatch):
+    _load(registry, 'alpha', 'beta')
+    loader, held = registry.peek('beta'), []
+    # release_shared takes the cross-process build lock, which a loading worker may hold
+    monkeypatch.setattr(loader, "release_shared", lambda: held.append(registry._lock._is_owned()))
+    registry.memory_budget = 1
+    _load(registry, 'gamma')
+    assert held == [False]
@@ -0,0 +1,99 @@
+"""DEA engines: GroupStatistics contrasts against the single-pair functions."""
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks import synthetic
+from app.services import analysis, streaming_dea
+
+
+@pytest.fixture(scope="module")
+def three_groups():
+    counts = synthetic.negative_binomial_counts(2000, 18, n_groups=3, seed=5)
+    names = list(counts.columns)
+    groups = {'A': names[0::3], 'B': names[1::3], 'C': names[2::3]}
+    # One group sequenced 4x deeper moves the median library size of its contrasts only
+    counts[groups['C']] *= 4
+    return counts, groups
+
+
+def _pairs(groups):
+    names = list(groups)
+    return [(a, b) for i, a in enumerate(names) for b in names[i + 1:]]
+
+
+def _assert_same(got, expected):
+    assert list(got.index) == list(expected.index)
+    assert list(got.columns) == list(expected.columns)
+    np.testing.assert_allclose(got.to_numpy(), expected.to_numpy(), rtol=1e-8, atol=1e-12)
+
+
+@pytest.mark.parametrize("method", list(analysis.DEA_METHODS))
+def test_contrasts_match_single_pair_dea(three_groups, method):
+    counts, groups = three_groups
+    stats = analysis.GroupStatistics(counts, groups)
+    for a, b in _pairs(groups):
+        expected = analysis.DEA_METHODS[method](counts, {'group1': groups[a], 'group2': groups[b]})
+        _assert_same(stats.contrast(a, b, method), expected)
+        assert stats.contrast(a, b, method).attrs == pytest.approx(expected.attrs)
+
+
+def test_add_samples_matches_recompute(three_groups):
+    counts, groups = three_groups
+    first = {'A': groups['A'][:-2], 'B': groups['B']}
+    grown = analysis.GroupStatistics(counts, first).add_samples(counts, groups)
+    fresh = analysis.GroupStatistics(counts, groups)
+    for a, b in _pairs(groups):
+        _assert_same(grown.contrast(a, b, 'moderated'), fresh.contrast(a, b, 'moderated'))
+
+
+def test_streaming_matches_memory(three_groups, tmp_path):
+    counts, groups = three_groups
+    path = tmp_path / "counts.tsv"
+    counts.to_csv(path, sep="\t")
+    streamed = streaming_dea.streaming_group_statistics(str(path), groups, memory_budget_mb=0.05)
+    for a, b in _pairs(groups):
+        _assert_same(streamed.contrast(a, b, 'moderated'), analysis.perform_moderated_dea(counts, {'group1': groups[a], 'group2': groups[b]}))
+
+
+# Log-expression values and limma's eBayes(lmFit(x, ~group)) output for them
+# (computed with the inmoose port of limma; df.prior, s2.prior, and t/p of the group coefficient)
+LIMMA_X = [
+    [2.11, 3.07, 3.37, 4.24, 3.98, 5.3], [6.42, 5.88, 5.64, 4.18, 4.34, 3.85], [6.79, 6.96, 6.54, 7.33, 7.73, 7.69],
+    [4.26, 1.9, 2.52, 2.34, 1.46, 3.3], [4.35, 3.24, 5.09, 4.6, 4.43, 4.24], [9.25, 7.62, 9.01, 9.0, 7.31, 8.82],
+    [3.17, 4.22, 2.98, 3.4, 3.77, 2.53], [4.23, 3.7, 4.15, 3.39, 4.59, 4.23], [8.48, 9.44, 10.18, 10.81, 6.83, 9.73],
+    [6.92, 6.69, 6.32, 7.24, 6.22, 6.96], [6.2, 4.01, 4.99, 4.23, 5.4, 6.36], [7.45, 4.85, 5.68, 6.55, 7.15, 6.36],
+]
+LIMMA_DF_PRIOR = 4.073755593081168
+LIMMA_S2_PRIOR = 0.44205576537459956
+LIMMA_T = [-3.0197028415835936, 4.312404272541989, -2.0243276652154587, 0.7195236651099749, -0.3607259478797239,
+           0.38628675783271593, 0.41523558374030045, -0.09139492389836446, 0.24729032047695937, -0.3566801774271039,
+           -0.35990237694055666, -1.0134549310266645]
+LIMMA_P = [0.016391865558070602, 0.0025177853729947504, 0.07721296276202408, 0.49211763731600955, 0.7275602912261357,
+           0.7092651715124431, 0.6887850205629783, 0.9294057498898171, 0.8108560359444992, 0.7304735174359865,
+           0.7281529380981057, 0.34024780646500097]
+
+
+def test_moderated_matches_limma():
+    samples = [f"s{i}" for i in range(6)]
+    genes = [f"G{i}" for i in range(len(LIMMA_X))]
+    log_cpm = pd.DataFrame(LIMMA_X, index=genes, columns=samples)
+    # min_count=0 keeps every gene, so the values are tested as given
+    result = analysis.perform_moderated_dea(pd.DataFrame(1, index=genes, columns=samples),
+                                            {'group1': samples[:3], 'group2': samples[3:]}, log_cpm=log_cpm, min_count=0)
+    assert result.attrs['prior_df'] == pytest.approx(LIMMA_DF_PRIOR, rel=1e-9)
+    assert result.attrs['prior_var'] == pytest.approx(LIMMA_S2_PRIOR, rel=1e-9)
+    np.testing.assert_allclose(result.loc[genes, 't'], LIMMA_T, rtol=1e-9)
+    np.testing.assert_allclose(result.loc[genes, 'p_value'], LIMMA_P, rtol=1e-9)
+
+
+def test_trigamma_inverse():
+    from scipy.special import polygamma
+    x = np.array([1e-3, 0.05, 0.7, 3.0, 250.0, 1e5])
+    np.testing.assert_allclose(analysis._trigamma_inverse(polygamma(1, x)), x, rtol=1e-6)
+
+
+def test_no_excess_variability_gives_infinite_prior_df():
+    # Every gene with the same variance: nothing to shrink, limma's df.prior is Inf
+    d0, s0_sq = analysis._fit_f_dist(np.full(50, 0.3), 4)
+    assert np.isinf(d0) and s0_sq == pytest.approx(0.3)
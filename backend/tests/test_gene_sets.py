@@ -0,0 +1,52 @@
+"""Local gene-set enrichment: the hypergeometric tail and the library cache."""
+import os
+
+import numpy as np
+import pytest
+from scipy import stats
+
+from app.services import gene_sets
+
+
+def test_hypergeom_sf_matches_scipy():
+    rng = np.random.default_rng(0)
+    N = 2000
+    K = rng.integers(1, 400, 3000)
+    n = rng.integers(1, 300, 3000)
+    # Overlaps from 0 past the largest possible, on both sides of the mean
+    k = (rng.random(3000) * (np.minimum(K, n) + 2)).astype(int)
+    got = gene_sets.hypergeom_sf(k, N, K, n)
+    expected = stats.hypergeom.sf(k - 1, N, K, n)
+    np.testing.assert_allclose(got, expected, rtol=1e-9, atol=1e-300)
+
+
+@pytest.mark.parametrize("k, N, K, n", [
+    (0, 100, 10, 5),      # P(X >= 0) = 1
+    (6, 100, 10, 5),      # beyond min(K, n): 0
+    (5, 100, 10, 5),      # the last point of the support
+    (40, 20000, 50, 300),  # a vanishingly small tail
+    (1, 50, 50, 50),      # a set covering the whole universe
+])
+def test_hypergeom_sf_edges(k, N, K, n):
+    assert gene_sets.hypergeom_sf(k, N, K, n)[0] == pytest.approx(stats.hypergeom.sf(k - 1, N, K, n), rel=1e-9, abs=1e-300)
+
+
+def test_edited_gmt_is_reloaded(tmp_path):
+    path = tmp_path / "Tiny.gmt"
+    path.write_text("T1\t\tA\tB\n")
+    universe = ['A', 'B', 'C']
+    first = gene_sets.get_library('Tiny', universe, version='v', geneset_dir=str(tmp_path))
+    assert gene_sets.get_library('Tiny', universe, version='v', geneset_dir=str(tmp_path)) is first
+
+    path.write_text("T1\t\tA\tB\nT2\t\tC\n")
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    second = gene_sets.get_library('Tiny', universe, version='v', geneset_dir=str(tmp_path))
+    assert list(second.terms) == ['T1', 'T2']
+
+    # Same name in another directory is another library
+    other = tmp_path / "other"
+    other.mkdir()
+    (other / "Tiny.gmt").write_text("T9\t\tC\n")
+    assert list(gene_sets.get_library('Tiny', universe, version='v', geneset_dir=str(other)).terms) == ['T9']
+    gene_sets.clear_library_cache('v')
@@ -0,0 +1,178 @@
+"""ExternalClient and ResponseCache against a local stub server (no network)."""
+import time
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app.services import http_client
+from app.services.http_client import ExternalClient, ResponseCache
+
+
+class StubServer:
+    """
+    /flaky/<n>: 503 for the first n requests, then 200 (GET or POST)
+    /down:      always 503
+    /slow:      200 after 0.1s, recording the peak number of requests in flight
+    """
+
+    def __init__(self):
+        self.hits = {}
+        self.in_flight = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                self.do_GET()
+
+            def do_GET(self):
+                with stub._lock:
+                    stub.hits[self.path] = hits = stub.hits.get(self.path, 0) + 1
+                    stub.in_flight += 1
+                    stub.peak = max(stub.peak, stub.in_flight)
+                try:
+                    if self.path.startswith('/flaky/'):
+                        status = 503 if hits <= int(self.path.rsplit('/', 1)[1]) else 200
+                    elif self.path == '/down':
+                        status = 503
+                    else:
+                        time.sleep(0.1)
+                        status = 200
+                finally:
+                    with stub._lock:
+                        stub.in_flight -= 1
+                self.send_response(status)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub():
+    server = StubServer()
+    yield server
+    server.close()
+
+
+def _run(client, coro):
+    async def main():
+        try:
+            return await coro
+        finally:
+            await client.aclose()
+    return asyncio.run(main())
+
+
+def test_retries_with_backoff_until_success(stub, monkeypatch):
+    delays = []
+    real_sleep = asyncio.sleep
+
+    async def sleep(seconds):
+        delays.append(seconds)
+        await real_sleep(0)
+    monkeypatch.setattr(http_client.asyncio, 'sleep', sleep)
+
+    client = ExternalClient(retries=3, backoff=0.5)
+    resp = _run(client, client.get(f"{stub.url}/flaky/2"))
+    assert resp.status_code == 200
+    assert stub.hits['/flaky/2'] == 3
+    # Exponential with +-50% jitter: 0.5 * 2**attempt * [0.5, 1.5)
+    assert len(delays) == 2
+    assert 0.25 <= delays[0] < 0.75 and 0.5 <= delays[1] < 1.5
+
+
+def test_gives_up_after_retries(stub):
+    client = ExternalClient(retries=2, backoff=0.001)
+    resp = _run(client, client.get(f"{stub.url}/down"))
+    assert resp.status_code == 503
+    assert stub.hits['/down'] == 3
+
+
+def test_transport_errors_are_retried_then_raised(stub):
+    import httpx
+    url = stub.url
+    stub.close()
+    client = ExternalClient(retries=1, backoff=0.001)
+    with pytest.raises(httpx.TransportError):
+        _run(client, client.get(f"{url}/slow"))
+
+
+def test_post_is_not_resent_after_reaching_the_server(stub):
+    client = ExternalClient(retries=3, backoff=0.001)
+    resp = _run(client, client.post(f"{stub.url}/flaky/1", data={'list': 'A'}))
+    assert resp.status_code == 503
+    assert stub.hits['/flaky/1'] == 1
+
+
+def test_post_retries_when_opted_in(stub):
+    client = ExternalClient(retries=3, backoff=0.001)
+    resp = _run(client, client.post(f"{stub.url}/flaky/1", data={'q': 'A'}, idempotent=True))
+    assert resp.status_code == 200
+    assert stub.hits['/flaky/1'] == 2
+
+
+def test_post_retries_connection_errors(monkeypatch):
+    import httpx
+    client = ExternalClient(retries=2, backoff=0.001)
+    calls = []
+
+    async def refuse(method, url, **kwargs):
+        calls.append(method)
+        raise httpx.ConnectError("refused")
+    monkeypatch.setattr(client._ensure_client(), 'request', refuse)
+    with pytest.raises(httpx.ConnectError):
+        _run(client, client.post("http://127.0.0.1:9/addList", data={}))
+    assert calls == ['POST'] * 3
+
+    async def time_out(method, url, **kwargs):
+        calls.append(method)
+        raise httpx.ReadTimeout("slow")
+    calls.clear()
+    monkeypatch.setattr(client._ensure_client(), 'request', time_out)
+    with pytest.raises(httpx.ReadTimeout):
+        _run(client, client.post("http://127.0.0.1:9/addList", data={}))
+    assert calls == ['POST']
+
+
+def test_semaphore_caps_concurrent_requests(stub):
+    client = ExternalClient(max_concurrency=2, backoff=0.001)
+
+    async def burst():
+        return await asyncio.gather(*(client.get(f"{stub.url}/slow") for _ in range(6)))
+
+    responses = _run(client, burst())
+    assert [r.status_code for r in responses] == [200] * 6
+    assert stub.peak == 2
+
+
+def test_response_cache_ttl(tmp_path, monkeypatch):
+    cache = ResponseCache(str(tmp_path), ttl=60)
+    now = [1000.0]
+    monkeypatch.setattr(http_client.time, 'time', lambda: now[0])
+
+    assert cache.get('enrichr', ['B', 'A'], 'KEGG') is None
+    cache.set('enrichr', ['A', 'B'], {'terms': [1]}, 'KEGG')
+    # Keyed by the sorted gene list and the library
+    assert cache.get('enrichr', ['B', 'A'], 'KEGG') == {'terms': [1]}
+    assert cache.get('enrichr', ['A', 'B'], 'GO') is None
+    assert cache.get('string', ['A', 'B']) is None
+
+    now[0] += 59
+    assert cache.get('enrichr', ['A', 'B'], 'KEGG') == {'terms': [1]}
+    now[0] += 2
+    assert cache.get('enrichr', ['A', 'B'], 'KEGG') is None
@@ -0,0 +1,198 @@
+"""Sample ingestion: the batch log, and appending batches against a full reload."""
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.services import analysis, data_loader, ingestion
+from app.services.taxonomy import TaxonomyMatrix
+from benchmarks import synthetic
+
+
+@pytest.fixture
+def batch():
+    return ingestion.SampleBatch.from_payload(
+        [{'Title': 'NEW1_R1', 'Disease severity': 'Asymptomatic', 'Age': 41.5, 'Notes': None}],
+        {'NEW1_R1': {'GENE000000': 3, 'GENE000001': 0}},
+        [{'Sample': 'NEW1_R1', 'Abundance': 12, 'Genus': 'Prevotella'}],
+    )
+
+
+def test_batch_log_round_trip(tmp_path, batch):
+    first = ingestion.save_batch(str(tmp_path), batch)
+    second = ingestion.save_batch(str(tmp_path), ingestion.SampleBatch(batch.metadata, batch.counts))
+    assert [d for _, d in ingestion.batch_files(str(tmp_path))] == [first, second]
+    assert sorted(os.listdir(tmp_path)) == [f"00001-{first}.json", f"00002-{second}.json"]
+
+    back = ingestion.load_batch(ingestion.batch_files(str(tmp_path))[0][0])
+    for name in ('metadata', 'counts', 'abundance'):
+        pd.testing.assert_frame_equal(getattr(back, name), getattr(batch, name))
+    assert ingestion.load_batch(ingestion.batch_files(str(tmp_path))[1][0]).abundance.empty
+
+
+def test_pickled_batches_are_not_read(tmp_path, batch):
+    pd.to_pickle({'metadata': batch.metadata}, tmp_path / "00001-0123456789abcdef.pkl")
+    assert ingestion.batch_files(str(tmp_path)) == []
+    assert ingestion.pickled_batches(str(tmp_path)) == [str(tmp_path / "00001-0123456789abcdef.pkl")]
+
+
+# apply_batch against loading the concatenated tables in one go
+
+def _frames(counts, long, metadata):
+    return metadata, counts, long, TaxonomyMatrix.from_long(long), analysis.compute_log_cpm(counts)
+
+
+@pytest.fixture(scope="module")
+def split_dataset():
+    counts = synthetic.negative_binomial_counts(300, 12, n_groups=3, seed=4)
+    long = synthetic.taxonomy_table(50, 12, n_groups=3, seed=4)
+    # taxonomy_table names its samples the same way as the count matrix
+    metadata = synthetic.sample_metadata(counts.columns, n_groups=3)
+    new = list(counts.columns[-3:])
+    base = _frames(counts.drop(columns=new), long[~long['Sample'].isin(new)].reset_index(drop=True),
+                   metadata[~metadata['Title'].isin(new)].reset_index(drop=True))
+    batch = ingestion.SampleBatch(metadata[metadata['Title'].isin(new)].reset_index(drop=True), counts[new],
+                                  long[long['Sample'].isin(new)].reset_index(drop=True))
+    return base, batch, _frames(counts, long, metadata)
+
+
+def test_apply_batch_matches_full_load(split_dataset):
+    base, batch, full = split_dataset
+    batch.validate(base, 'Title')
+    metadata, counts, long, taxonomy, log_cpm = ingestion.apply_batch(base, batch, 'Title')
+    pd.testing.assert_frame_equal(metadata, full[0])
+    pd.testing.assert_frame_equal(counts, full[1])
+    np.testing.assert_allclose(log_cpm.to_numpy(), full[4].to_numpy())
+    assert list(log_cpm.columns) == list(full[4].columns)
+    assert len(long) == len(full[2])
+    for rank in full[3].ranks:
+        expected = full[3].abundance(rank)
+        got = taxonomy.abundance(rank).reindex(index=expected.index, columns=expected.columns)
+        pd.testing.assert_frame_equal(got, expected, check_dtype=False)
+    # The inputs are left alone
+    assert base[1].shape[1] == 9 and len(base[0]) == 9
+
+
+def test_group_statistics_extend_to_full_load(split_dataset):
+    base, batch, full = split_dataset
+    _, counts, _, _, log_cpm = ingestion.apply_batch(base, batch, 'Title')
+    groups = lambda meta, cols: {g: [s for s in t if s in cols] for g, t in meta.groupby('Disease severity', sort=False)['Title']}
+    grown = analysis.GroupStatistics(base[1], groups(base[0], set(base[1].columns)), log_cpm=base[4])
+    grown = grown.add_samples(counts, groups(full[0], set(counts.columns)), log_cpm=log_cpm)
+    fresh = analysis.GroupStatistics(full[1], groups(full[0], set(full[1].columns)), log_cpm=full[4])
+    for a, b in [('Asymptomatic', 'Moderate'), ('Mildly Symptomatic', 'Moderate')]:
+        expected = fresh.contrast(a, b, 'moderated')
+        np.testing.assert_allclose(grown.contrast(a, b, 'moderated').to_numpy(), expected.to_numpy(), rtol=1e-8, atol=1e-12)
+
+
+def test_rejects_known_samples_and_genes(split_dataset):
+    base, batch, full = split_dataset
+    with pytest.raises(ValueError, match="already in the dataset"):
+        batch.validate(full, 'Title')
+    unknown = ingestion.SampleBatch(batch.metadata, batch.counts.rename(index={batch.counts.index[0]: 'NOPE'}))
+    with pytest.raises(ValueError, match="unknown genes"):
+        unknown.validate(base, 'Title')
+
+
+# What _carry_over keeps for the new version
+
+@pytest.fixture
+def caches():
+    from app.api.endpoints import omics
+    kept = (omics.dea_cache, omics.group_stats_cache, omics.distance_cache, omics.rarefaction_cache)
+    for cache in kept:
+        cache.clear()
+    yield omics
+    for cache in kept:
+        cache.clear()
+
+
+def _grown_dataset(base, batch):
+    metadata, counts, long, taxonomy, log_cpm = ingestion.apply_batch(base, batch, 'Title')
+    return SimpleNamespace(name='demo', version='v2', metadata=metadata, transcriptomics=counts, log_cpm=log_cpm,
+                           manifest=SimpleNamespace(sample_column='Title', group_column='Disease severity'))
+
+
+def test_carry_over_keeps_unaffected_contrasts(split_dataset, caches):
+    base, batch, _ = split_dataset
+    # Only the Moderate group gains counted samples
+    moderate = batch.metadata[batch.metadata['Disease severity'] == 'Moderate']
+    batch = ingestion.SampleBatch(moderate, batch.counts[list(moderate['Title'])])
+    old = SimpleNamespace(metadata=base[0], transcriptomics=base[1], manifest=SimpleNamespace(sample_column='Title'))
+    stats = analysis.GroupStatistics(base[1], caches._sample_groups(old, 'Disease severity'), log_cpm=base[4])
+    caches.dea_cache.put(('dea', 'v1', 'Asymptomatic', 'Mildly Symptomatic', 'welch'), 'kept')
+    caches.dea_cache.put(('dea', 'v1', 'Asymptomatic', 'Moderate', 'welch'), 'stale')
+    caches.group_stats_cache.put(('group_stats', 'v1', 'Disease severity', 10), stats)
+    caches.distance_cache.put(('distance', 'v1', 'Genus', 'braycurtis'), 'distances')
+
+    ds = _grown_dataset(base, batch)
+    caches._carry_over(ds, 'v1', batch)
+    assert [k[2:] for k, _ in caches.dea_cache.entries('v2')] == [('Asymptomatic', 'Mildly Symptomatic', 'welch')]
+    # Group statistics are extended rather than dropped
+    [(_, grown)] = caches.group_stats_cache.entries('v2')
+    assert grown.sample_groups['Moderate'] == caches._sample_groups(ds, 'Disease severity')['Moderate']
+    # No abundance rows, so distances still hold
+    assert caches.distance_cache.get(('distance', 'v2', 'Genus', 'braycurtis')) == 'distances'
+
+
+def test_carry_over_abundance_only(split_dataset, caches):
+    base, batch, _ = split_dataset
+    batch = ingestion.SampleBatch(batch.metadata, abundance=batch.abundance)
+    caches.dea_cache.put(('dea', 'v1', 'Asymptomatic', 'Moderate', 'welch'), 'kept')
+    caches.distance_cache.put(('distance', 'v1', 'Genus', 'braycurtis'), 'stale')
+    caches.rarefaction_cache.put(('rarefaction', 'v1', 'Genus', (1, 10), 10, 42), 'stale')
+    caches._carry_over(_grown_dataset(base, batch), 'v1', batch)
+    assert caches.dea_cache.get(('dea', 'v2', 'Asymptomatic', 'Moderate', 'welch')) == 'kept'
+    assert caches.distance_cache.entries('v2') == [] and caches.rarefaction_cache.entries('v2') == []
+
+
+# Two workers sharing one ingestion log
+
+@pytest.fixture
+def workers(tmp_path, monkeypatch):
+    monkeypatch.setenv("OMICS_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("OMICS_SHARED_DIR", str(tmp_path / "shm"))
+    monkeypatch.setattr(data_loader, "INGEST_DIR", str(tmp_path / "ingest"))
+    counts = synthetic.negative_binomial_counts(100, 6, seed=1)
+    counts.to_csv(tmp_path / "counts.txt", sep='\t')
+    synthetic.taxonomy_table(30, 6, seed=1).to_csv(tmp_path / "abundance.csv", index=False)
+    synthetic.sample_metadata(counts.columns).to_csv(tmp_path / "metadata.csv", index=False)
+    manifest = data_loader.Manifest('demo', str(tmp_path / "counts.txt"), str(tmp_path / "abundance.csv"), str(tmp_path / "metadata.csv"))
+    loaders = [data_loader.DataLoader(manifest) for _ in range(2)]
+    for loader in loaders:
+        assert loader.load_data()
+    return loaders
+
+
+def _new_samples(loader, *titles):
+    counts = pd.DataFrame({t: np.arange(len(loader.transcriptomics)) % 7 for t in titles}, index=loader.transcriptomics.index)
+    return ingestion.SampleBatch(synthetic.sample_metadata(list(titles)), counts)
+
+
+def test_other_workers_replay_new_batches(workers):
+    first, second = workers
+    version = first.version
+    first.ingest(_new_samples(first, 'AS9_R1'))
+    assert second.version == version
+    # current_version() is what precomputed lookups key on
+    assert second.current_version() == first.version
+    assert list(second.transcriptomics.columns) == list(first.transcriptomics.columns)
+    np.testing.assert_array_equal(second.log_cpm.to_numpy(), first.log_cpm.to_numpy())
+    assert not second.sync()
+
+
+def test_stale_worker_catches_up_before_logging(workers):
+    first, second = workers
+    first.ingest(_new_samples(first, 'AS9_R1'))
+    # second hasn't seen the first batch: it is applied before the new one is numbered
+    second.ingest(_new_samples(second, 'SY9_R1'))
+    names = [os.path.basename(p)[:5] for p, _ in ingestion.batch_files(first.ingest_dir(first._source_key))]
+    assert names == ['00001', '00002']
+    assert second.ingested == ['AS9_R1', 'SY9_R1']
+    first.sync()
+    assert first.version == second.version == first.fingerprint()
+
+    with pytest.raises(ValueError, match="already in the dataset"):
+        first.ingest(_new_samples(first, 'AS9_R1'))
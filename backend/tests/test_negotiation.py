@@ -0,0 +1,71 @@
+"""Content negotiation, ETags and 304s through the omics router."""
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from app.api import negotiation
+from app.api.endpoints import omics
+
+XML = {'Accept': 'application/xml'}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    ds = SimpleNamespace(
+        name='demo', version='v1', ready=True,
+        manifest=SimpleNamespace(group_column='Group'),
+        metadata=pd.DataFrame({'Group': ['A', 'B']}),
+        transcriptomics=None, metagenomics=None,
+    )
+    monkeypatch.setattr(omics, '_require_data', lambda dataset=None: ds)
+    monkeypatch.setattr(negotiation.registry, 'peek', lambda name=None: ds)
+    negotiation.response_cache.clear()
+    yield SimpleNamespace(http=TestClient(main.app), ds=ds)
+    negotiation.response_cache.clear()
+
+
+def test_if_none_match_gets_304(client):
+    first = client.http.get('/api/omics/summary')
+    assert first.status_code == 200 and first.json()['samples'] == 2
+    etag = first.headers['etag']
+
+    again = client.http.get('/api/omics/summary', headers={'If-None-Match': etag})
+    assert again.status_code == 304 and again.headers['etag'] == etag and not again.content
+    assert client.http.get('/api/omics/summary', headers={'If-None-Match': 'W/' + etag}).status_code == 304
+
+
+def test_etag_tracks_version_format_and_params(client):
+    etag = client.http.get('/api/omics/summary').headers['etag']
+    assert client.http.get('/api/omics/summary?format=msgpack').headers['etag'] != etag
+    assert client.http.get('/api/omics/summary?dataset=demo').headers['etag'] != etag
+
+    client.ds.version = 'v2'
+    resp = client.http.get('/api/omics/summary', headers={'If-None-Match': etag})
+    assert resp.status_code == 200 and resp.headers['etag'] != etag
+
+
+def test_profile_bypasses_etag(client):
+    etag = client.http.get('/api/omics/summary').headers['etag']
+    profiled = client.http.get('/api/omics/summary?profile=1', headers={'If-None-Match': etag})
+    assert profiled.status_code == 200 and 'etag' not in profiled.headers
+    # ...and isn't part of the tag either
+    assert client.http.get('/api/omics/summary?profile=0').headers['etag'] == etag
+
+
+def test_unacceptable_format_is_406(client):
+    assert client.http.get('/api/omics/summary', headers=XML).status_code == 406
+
+
+def test_plain_routes_ignore_accept(client):
+    # Only Payload responses are negotiated; the rest answer whatever was asked
+    assert client.http.get('/api/omics/jobs', headers=XML).status_code == 200
+    assert client.http.get('/api/omics/jobs/nope', headers=XML).status_code == 404
+
+
+def test_app_routes_ignore_accept():
+    http = TestClient(main.app)
+    assert http.get('/healthz', headers=XML).status_code == 200
+    assert http.get('/metrics', headers=XML).status_code == 200
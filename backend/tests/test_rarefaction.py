@@ -0,0 +1,83 @@
+"""Rarefaction curves against indices computed directly from the counts."""
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.special import gammaln
+
+from app.services.rarefaction import default_depth, rarefaction_curves, rarefied_alpha_diversity
+from benchmarks import synthetic
+
+
+@pytest.fixture
+def abundance():
+    long = synthetic.taxonomy_table(60, 6, reads_per_sample=500, seed=3)
+    return long.pivot_table(index='Species', columns='Sample', values='Abundance', aggfunc='sum', fill_value=0)
+
+
+def _observed_indices(column):
+    x = column[column > 0].to_numpy(dtype=np.float64)
+    p = x / x.sum()
+    f1, f2 = (x == 1).sum(), (x == 2).sum()
+    return {
+        'observed': len(x),
+        'shannon': -(p * np.log(p)).sum(),
+        'simpson': 1 - (p ** 2).sum(),
+        'chao1': len(x) + f1 * (f1 - 1) / (2 * (f2 + 1)),
+    }
+
+
+def test_full_depth_reproduces_observed_indices(abundance):
+    totals = abundance.sum(axis=0)
+    curves = rarefaction_curves(abundance, depths=sorted(totals.unique()), iterations=3)
+    for sample, reads in totals.items():
+        # Drawing every read leaves nothing to chance
+        row = curves[(curves['Sample'] == sample) & (curves['depth'] == reads)].iloc[0]
+        for index, expected in _observed_indices(abundance[sample]).items():
+            assert row[index] == pytest.approx(expected)
+            assert row[f'{index}_sd'] == pytest.approx(0, abs=1e-9)
+
+
+def test_mean_richness_matches_expectation(abundance):
+    # E[observed at depth n] = sum over taxa of 1 - C(N - N_i, n) / C(N, n)
+    sample = abundance.columns[0]
+    x = abundance[sample].to_numpy()
+    N, n = x.sum(), 50
+    log_choose = lambda a, b: gammaln(a + 1) - gammaln(b + 1) - gammaln(a - b + 1)
+    absent = np.where(N - x >= n, np.exp(log_choose(N - x, n) - log_choose(N, n)), 0.0)
+    expected = (1 - absent)[x > 0].sum()
+
+    curves = rarefaction_curves(abundance[[sample]], depths=[n], iterations=400, seed=1)
+    row = curves.iloc[0]
+    assert row['observed'] == pytest.approx(expected, abs=4 * row['observed_sd'] / np.sqrt(400))
+
+
+def test_empty_sample_is_dropped(abundance):
+    abundance = abundance.assign(EMPTY=0)
+    curves = rarefaction_curves(abundance, iterations=2)
+    assert 'EMPTY' not in set(curves['Sample'])
+    assert curves.attrs['reads']['EMPTY'] == 0
+    assert default_depth(abundance) == int(abundance.drop(columns='EMPTY').sum().min())
+
+    depth = default_depth(abundance)
+    at_depth = rarefied_alpha_diversity(rarefaction_curves(abundance, depths=[depth], iterations=2), depth)
+    assert at_depth.attrs['excluded'] == ['EMPTY']
+    assert list(at_depth.index) == [s for s in abundance.columns if s != 'EMPTY']
+
+
+def test_all_empty_has_no_default_depth(abundance):
+    with pytest.raises(ValueError):
+        default_depth(abundance * 0)
+
+
+def test_same_seed_same_curves(abundance):
+    first = rarefaction_curves(abundance, iterations=15, seed=7)
+    pd.testing.assert_frame_equal(first, rarefaction_curves(abundance, iterations=15, seed=7))
+    other = rarefaction_curves(abundance, iterations=15, seed=8)
+    assert not np.allclose(first['shannon'], other['shannon'])
+
+
+def test_rejects_non_counts(abundance):
+    with pytest.raises(ValueError):
+        rarefaction_curves(abundance / 2.5)
+    with pytest.raises(ValueError):
+        rarefaction_curves(abundance, iterations=0)
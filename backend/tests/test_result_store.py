@@ -0,0 +1,51 @@
+"""The result store: Parquet round trips, and nothing but Parquet is read back."""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.services.result_store import ResultStore, read_result, result_key, write_result
+
+pytest.importorskip("pyarrow")
+
+
+def _publish(store, result, params):
+    staging, index = store.begin('ds', 'v1')
+    key = result_key('dea', params)
+    write_result(os.path.join(staging, key), result)
+    index['results'][key] = {}
+    store.publish(staging, index)
+    return os.path.join(store.version_dir('ds', 'v1'), key)
+
+
+def test_round_trip(tmp_path):
+    table = pd.DataFrame({'gene': ['A2M', 'AAMP'], 'logFC': [1.5, -0.25]})
+    result = {'results': table, 'scores': pd.Series([0.5, 1.0], name='score'), 'coords': np.eye(2), 'n': np.int64(2)}
+    write_result(str(tmp_path), result)
+    assert not [f for f in os.listdir(tmp_path) if f.endswith('.pkl')]
+    back = read_result(str(tmp_path))
+    pd.testing.assert_frame_equal(back['results'], table)
+    pd.testing.assert_series_equal(back['scores'], result['scores'])
+    assert np.array_equal(back['coords'], np.eye(2)) and back['n'] == 2
+
+
+def test_unparquetable_table_fails(tmp_path):
+    with pytest.raises(Exception):
+        write_result(str(tmp_path), {'results': pd.DataFrame({'mixed': [1, 'a']})})
+
+
+def test_pickle_entries_are_refused(tmp_path):
+    store = ResultStore(root=str(tmp_path))
+    params = {'group1': 'A', 'group2': 'B'}
+    entry = _publish(store, {'results': pd.DataFrame({'x': [1.0]})}, params)
+    assert store.get('ds', 'v1', 'dea', params)['results']['x'].tolist() == [1.0]
+
+    # Someone with write access to the store swaps in a pickle
+    pd.DataFrame({'x': [2.0]}).to_pickle(os.path.join(entry, 't0.pkl'))
+    with open(os.path.join(entry, 'result.json'), 'w') as f:
+        json.dump({'results': {'__table__': 't0.pkl'}}, f)
+    with pytest.raises(ValueError):
+        read_result(entry)
+    assert ResultStore(root=str(tmp_path)).get('ds', 'v1', 'dea', params) is None
@@ -0,0 +1,69 @@
+"""Round trips through every response encoder and content encoding."""
+import gzip
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.api import serialization
+
+
+@pytest.fixture
+def payload():
+    table = pd.DataFrame({
+        'gene': ['A2M', 'AAMP', 'ABCA1'],
+        'logFC': [1.5, -0.25, np.nan],
+        'count': np.array([3, 0, 7], dtype=np.int64),
+    })
+    return {'total': np.int64(3), 'method': 'welch', 'scores': np.array([0.5, 1.0]), 'results': table}
+
+
+def _records(table):
+    return [{k: (None if isinstance(v, float) and np.isnan(v) else v) for k, v in row.items()}
+            for row in table.to_dict(orient='records')]
+
+
+def test_json_round_trip(payload):
+    decoded = json.loads(serialization.encode_json(payload))
+    assert decoded == {'total': 3, 'method': 'welch', 'scores': [0.5, 1.0], 'results': _records(payload['results'])}
+
+
+def test_msgpack_round_trip(payload):
+    msgpack = pytest.importorskip("msgpack")
+    decoded = msgpack.unpackb(serialization.encode_msgpack(payload), raw=False)
+    assert decoded['total'] == 3 and decoded['method'] == 'welch' and decoded['scores'] == [0.5, 1.0]
+    rows = decoded['results']
+    assert [r['gene'] for r in rows] == ['A2M', 'AAMP', 'ABCA1']
+    assert [r['count'] for r in rows] == [3, 0, 7]
+    assert rows[0]['logFC'] == 1.5 and np.isnan(rows[2]['logFC'])
+
+
+def test_arrow_round_trip(payload):
+    pa = pytest.importorskip("pyarrow")
+    body = serialization.encode_arrow(payload)
+    table = pa.ipc.open_stream(body).read_all()
+    pd.testing.assert_frame_equal(table.to_pandas(), payload['results'], check_dtype=False)
+    # Everything but the table travels as JSON in the schema metadata
+    assert json.loads(table.schema.metadata[b'omics']) == {'total': 3, 'method': 'welch', 'scores': [0.5, 1.0]}
+
+
+def test_arrow_needs_a_single_table(payload):
+    pytest.importorskip("pyarrow")
+    with pytest.raises(ValueError):
+        serialization.encode_arrow({'a': payload['results'], 'b': payload['results']})
+
+
+def test_compression_round_trip():
+    body = serialization.encode_json({'genes': ['GENE%d' % i for i in range(2000)]})
+    assert gzip.decompress(serialization.compress(body, 'gzip')) == body
+    # Stable bytes, so strong ETags stay valid
+    assert serialization.compress(body, 'gzip') == serialization.compress(body, 'gzip')
+    brotli = pytest.importorskip("brotli")
+    assert brotli.decompress(serialization.compress(body, 'br')) == body
+
+
+def test_requirements_enable_every_format():
+    assert serialization.available_formats() == list(serialization.MEDIA_TYPES)
+    assert serialization.negotiate_format('application/msgpack') == 'msgpack'
+    assert serialization.negotiate_format('', 'arrow') == 'arrow'
@@ -0,0 +1,99 @@
+"""Sparse PLS: feature selection, CV and parameter validation."""
+import numpy as np
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+
+from app.services import spls
+
+
+@pytest.fixture(scope="module")
+def planted():
+    # Genes G0-G9 and taxa T0-T4 follow one latent factor; everything else is noise
+    rng = np.random.default_rng(0)
+    n = 24
+    samples = [f"S{i}" for i in range(n)]
+    latent = rng.normal(size=n)
+    genes = rng.normal(size=(200, n))
+    genes[:10] += 3 * latent
+    counts = rng.poisson(20, size=(40, n)).astype(float)
+    counts[:5] *= np.exp(0.8 * latent)
+    expression = pd.DataFrame(genes, index=[f"G{i}" for i in range(200)], columns=samples)
+    abundance = pd.DataFrame(np.round(counts), index=[f"T{i}" for i in range(40)], columns=samples)
+    return expression, abundance
+
+
+def test_selects_the_planted_features(planted):
+    expression, abundance = planted
+    result = spls.perform_spls_integration(expression, abundance, n_components=1, keep_genes=[10], keep_taxa=[5])
+    genes = {f['feature'] for f in result['selected']['genes'][0]}
+    taxa = {f['feature'] for f in result['selected']['taxa'][0]}
+    assert genes == {f"G{i}" for i in range(10)}
+    assert taxa == {f"T{i}" for i in range(5)}
+    assert result['correlations'][0] > 0.9
+    assert result['cv'] is None
+    assert list(result['scores'].columns) == ['comp1_x', 'comp1_y']
+
+
+def test_selected_counts_per_component(planted):
+    expression, abundance = planted
+    result = spls.perform_spls_integration(expression, abundance, n_components=2, keep_genes=[7], keep_taxa=[3])
+    assert result['params']['n_components'] == 2
+    assert [len(s) for s in result['selected']['genes']] == [7, 7]
+    assert [len(s) for s in result['selected']['taxa']] == [3, 3]
+    loadings = result['gene_loadings']
+    assert ((loadings != 0).sum(axis=0) == 7).all()
+    # Sorted by absolute loading
+    first = [abs(f['loading']) for f in result['selected']['genes'][0]]
+    assert first == sorted(first, reverse=True)
+
+
+def test_cross_validation_picks_from_the_grid(planted):
+    expression, abundance = planted
+    result = spls.perform_spls_integration(expression, abundance, n_components=1, keep_genes=[5, 10, 50],
+                                           keep_taxa=[2, 5], folds=3, repeats=2)
+    component = result['cv']['components'][0]
+    assert len(component['grid']) == 6
+    best = max(component['grid'], key=lambda c: c['correlation'])
+    assert component['best']['keep_genes'] == best['keep_genes'] == result['params']['keep_genes'][0]
+    assert len(result['selected']['genes'][0]) == result['params']['keep_genes'][0]
+    # Deterministic for a seed
+    again = spls.perform_spls_integration(expression, abundance, n_components=1, keep_genes=[5, 10, 50],
+                                          keep_taxa=[2, 5], folds=3, repeats=2)
+    assert again['cv'] == result['cv']
+
+
+def test_screen_limits(planted):
+    expression, abundance = planted
+    result = spls.perform_spls_integration(expression, abundance, n_components=1, keep_genes=[500], keep_taxa=[5],
+                                           max_genes=30)
+    assert result['params']['genes_screened'] == 30
+    # A candidate above the screened count keeps them all
+    assert result['params']['keep_genes'] == [30]
+
+
+def test_too_few_samples(planted):
+    expression, abundance = planted
+    assert spls.perform_spls_integration(expression.iloc[:, :4], abundance) is None
+
+
+@pytest.mark.parametrize("values", [[0], [5, -1], [0, 10]])
+def test_candidates_must_be_positive(values):
+    with pytest.raises(ValueError):
+        spls._candidates(values, 100, spls.DEFAULT_KEEP_GENES)
+
+
+def test_candidates_are_capped_and_deduplicated():
+    assert spls._candidates([50, 10, 500, 400], 100, spls.DEFAULT_KEEP_GENES) == [10, 50, 100]
+    assert spls._candidates(None, 30, spls.DEFAULT_KEEP_GENES) == [10, 25, 30]
+
+
+@pytest.mark.parametrize("query", [
+    "keep_genes=0", "keep_taxa=-3", "keep_genes=10&keep_genes=0",
+    "max_genes=0", f"max_genes={spls.MAX_SCREENED_GENES + 1}",
+])
+def test_route_rejects_invalid_parameters(query):
+    import main
+    # Rejected by validation, before any dataset is touched
+    resp = TestClient(main.app).get(f"/api/omics/biomarkers/integration/spls?{query}")
+    assert resp.status_code == 422
@@ -0,0 +1,45 @@
+"""The out-of-core DEA engine against the in-memory one, on a synthetic count file."""
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks import synthetic
+from app.services import analysis, streaming_dea
+
+
+@pytest.fixture(scope="module")
+def count_file(tmp_path_factory):
+    counts = synthetic.negative_binomial_counts(3000, 12, seed=3)
+    path = tmp_path_factory.mktemp("counts") / "counts.tsv"
+    counts.to_csv(path, sep="\t")
+    names = list(counts.columns)
+    groups = {'group1': names[0::2], 'group2': names[1::2]}
+    return str(path), counts, groups
+
+
+# A budget this small reads the file in many chunks
+BUDGET_MB = 0.05
+
+
+@pytest.mark.parametrize("method", list(analysis.DEA_METHODS))
+def test_stream_matches_memory(count_file, method):
+    path, counts, groups = count_file
+    assert streaming_dea.rows_per_chunk(12, BUDGET_MB) < len(counts) // 4
+
+    memory = analysis.DEA_METHODS[method](counts, groups)
+    stream = streaming_dea.streaming_dea(path, groups, method=method, memory_budget_mb=BUDGET_MB)
+
+    assert list(stream.index) == list(memory.index)
+    assert list(stream.columns) == list(memory.columns)
+    np.testing.assert_allclose(stream.to_numpy(), memory.to_numpy(), rtol=1e-9, atol=1e-12)
+    assert stream.attrs == pytest.approx(memory.attrs)
+
+
+@pytest.mark.parametrize("method", list(analysis.DEA_METHODS))
+def test_blocks_concatenate_to_the_full_result(count_file, method):
+    path, _, groups = count_file
+    full = streaming_dea.streaming_dea(path, groups, method=method, memory_budget_mb=BUDGET_MB)
+    blocks = list(streaming_dea.iter_streaming_dea(path, groups, method=method, memory_budget_mb=BUDGET_MB))
+
+    assert len(blocks) > 1
+    pd.testing.assert_frame_equal(pd.concat(blocks), full)
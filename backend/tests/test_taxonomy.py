@@ -0,0 +1,61 @@
+"""TaxonomyMatrix against the pivot_table calls it replaced."""
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.services.taxonomy import RANKS, TaxonomyMatrix
+
+
+def _long_table(n_samples, n_genera, rows_per_sample, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for s in range(n_samples):
+        for g in rng.choice(n_genera, size=rows_per_sample, replace=True):
+            lineage = {rank: f"{rank[0]}{g % (i + 2)}" for i, rank in enumerate(RANKS[:-2])}
+            rows.append({'Sample': f"S{s}", 'Abundance': int(rng.integers(0, 50)), **lineage,
+                         'Genus': f"G{g}", 'Species': f"sp{g % 3}"})
+    df = pd.DataFrame(rows)
+    # Unassigned ranks, a species without a genus, and an epithet shared across genera
+    df.loc[::7, 'Species'] = np.nan
+    df.loc[3::11, 'Genus'] = np.nan
+    df.loc[5::13, 'Family'] = np.nan
+    return df
+
+
+def _expected(df, rank, samples):
+    if rank == 'Species':
+        df = df.assign(Species=np.where(df['Genus'].isna(), df['Species'], df['Genus'] + ' ' + df['Species']))
+    pivot = df.pivot_table(index=rank, columns='Sample', values='Abundance', aggfunc='sum').fillna(0)
+    # pivot_table drops a sample with nothing classified at the rank; the matrix keeps it as zeros
+    return pivot.reindex(columns=samples, fill_value=0)
+
+
+@pytest.mark.parametrize("n_genera, rows_per_sample, sparse", [(400, 20, True), (6, 30, False)])
+def test_matches_pivot_table(n_genera, rows_per_sample, sparse):
+    df = _long_table(12, n_genera, rows_per_sample)
+    tm = TaxonomyMatrix.from_long(df)
+    assert tm.is_sparse('Genus') == sparse
+    assert 'Streptococcus pneumoniae' not in tm.categories['Species']  # labels are genus-qualified
+    for rank in RANKS:
+        expected = _expected(df, rank, tm.samples)
+        got = tm.abundance(rank)
+        assert list(got.index) == [str(x) for x in expected.index]
+        np.testing.assert_array_equal(got.to_numpy(), expected.to_numpy())
+
+        totals = expected.sum(axis=0).to_numpy()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            relative = np.nan_to_num(expected.to_numpy() / totals)
+        np.testing.assert_allclose(tm.relative(rank).to_numpy(), relative)
+    np.testing.assert_array_equal(tm.sample_totals.to_numpy(), df.groupby('Sample')['Abundance'].sum().reindex(tm.samples))
+
+
+def test_species_labels_are_genus_qualified():
+    df = pd.DataFrame({
+        'Sample': ['S1', 'S1', 'S2', 'S2'], 'Abundance': [3, 4, 5, 6],
+        'Genus': ['Streptococcus', 'Klebsiella', np.nan, 'Klebsiella'],
+        'Species': ['pneumoniae', 'pneumoniae', 'sp.', np.nan],
+    })
+    tm = TaxonomyMatrix.from_long(df)
+    assert list(tm.categories['Species']) == ['Klebsiella pneumoniae', 'Streptococcus pneumoniae', 'sp.']
+    assert tm.abundance('Species').loc['Klebsiella pneumoniae'].tolist() == [4, 0]
+    assert tm.rank_totals('Species').tolist() == [7, 5]